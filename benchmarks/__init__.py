@@ -0,0 +1,12 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+
+Benchmarks of watermarking, folders scanning and optimization hot paths.
+Run them with `python -m benchmarks --help`.
+"""
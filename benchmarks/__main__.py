@@ -0,0 +1,74 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import json
+import sys
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List, Optional
+
+from .compare import compare, report
+from .corpus import PROFILES, generate
+from .suite import BENCHMARKS, run_all
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    """Run benchmarks, and compare results to a baseline.
+    The exit code is 1 when there is a regression.
+    """
+    parser = ArgumentParser(prog="python -m benchmarks", description="Watermark benchmarks.")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick", help="the corpus profile")
+    parser.add_argument(
+        "--corpus",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "watermark-benchmarks",
+        help="where the corpus is generated, and kept for next runs",
+    )
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of each benchmark")
+    parser.add_argument("--tinify-latency", type=float, default=0.0, help="latency of the Tinify stand-in, seconds")
+    parser.add_argument("-o", "--output", type=Path, help="save results to this JSON file")
+    parser.add_argument("--results", type=Path, help="compare these results instead of running benchmarks")
+    parser.add_argument("--baseline", type=Path, help="compare results to these baseline ones")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change flagged as a regression")
+    options = parser.parse_args(args)
+
+    if options.results:
+        results = json.loads(options.results.read_text(encoding="utf-8"))
+    else:
+        corpus = options.corpus / options.profile
+        print(f"Generating the {options.profile!r} corpus into {corpus} ...", file=sys.stderr)
+        files = generate(corpus, profile=options.profile)
+
+        print(f"Running {', '.join(options.only)} on {len(files)} files ...", file=sys.stderr)
+        results = run_all(
+            files,
+            options.only,
+            repeat=options.repeat,
+            profile=options.profile,
+            tinify_latency=options.tinify_latency,
+        )
+
+    if options.output:
+        options.output.write_text(json.dumps(results, indent=2), encoding="utf-8")
+    else:
+        print(json.dumps(results, indent=2))
+
+    if not options.baseline:
+        return 0
+
+    baseline = json.loads(options.baseline.read_text(encoding="utf-8"))
+    rows = compare(results, baseline, threshold=options.threshold)
+    print(report(rows), file=sys.stderr)
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
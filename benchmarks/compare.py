@@ -0,0 +1,59 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+__all__ = ("METRICS", "compare", "report")
+
+# Compared metrics: their path in results, and whether a higher value is better
+METRICS = (
+    (("throughput",), True),
+    (("latency", "p50"), False),
+    (("latency", "p90"), False),
+    (("peak_rss",), False),
+)
+
+# A compared metric: benchmark, metric, baseline value, current value, relative change, regression
+Row = Tuple[str, str, float, float, float, bool]
+
+
+def _value(result: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    value: Any = result
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.1) -> List[Row]:
+    """Compare benchmark *results* to the *baseline* ones.
+    A metric is a regression when it is worse than the baseline by more than *threshold*.
+    Benchmarks missing from one side are ignored.
+    """
+    rows = []
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if not base:
+            continue
+        for path, higher_is_better in METRICS:
+            old, new = _value(base, path), _value(result, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regression = -change > threshold if higher_is_better else change > threshold
+            rows.append((name, ".".join(path), old, new, change, regression))
+    return rows
+
+
+def report(rows: List[Row]) -> str:
+    """Format compared metrics as a table."""
+    lines = [f"{'benchmark':<18} {'metric':<12} {'baseline':>12} {'current':>12} {'change':>8}"]
+    for name, metric, old, new, change, regression in rows:
+        flag = "  REGRESSION" if regression else ""
+        lines.append(f"{name:<18} {metric:<12} {old:>12.4f} {new:>12.4f} {change:>+8.1%}{flag}")
+    return "\n".join(lines)
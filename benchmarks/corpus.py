@@ -0,0 +1,83 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import random
+import zlib
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+__all__ = ("PROFILES", "RATIOS", "generate", "generate_image", "image_size")
+
+# Aspect ratios of generated images
+RATIOS = {"1x1": (1, 1), "3x2": (3, 2), "4x3": (4, 3), "16x9": (16, 9), "2x3": (2, 3)}
+
+# Corpus profiles: megapixels, aspect ratios, formats and number of images of each kind
+PROFILES: Dict[str, Dict] = {
+    "quick": {"megapixels": (1, 4), "ratios": ("3x2", "16x9", "2x3"), "formats": ("jpg", "png"), "count": 1},
+    "standard": {"megapixels": (1, 12, 24), "ratios": tuple(RATIOS), "formats": ("jpg", "png"), "count": 1},
+    "full": {"megapixels": (1, 12, 24, 50, 100), "ratios": tuple(RATIOS), "formats": ("jpg", "png"), "count": 2},
+}
+
+
+def image_size(megapixels: float, ratio: str) -> Tuple[int, int]:
+    """Get the size of an image of given *megapixels* and *ratio*."""
+    width, height = RATIOS[ratio]
+    unit = (megapixels * 1_000_000 / (width * height)) ** 0.5
+    return int(width * unit), int(height * unit)
+
+
+def generate_image(size: Tuple[int, int], seed: int) -> Image.Image:
+    """Generate a photo-like image: smooth colors with some fine grain.
+    The same *seed* always gives the same image.
+    """
+    rng = random.Random(seed)
+
+    def noise(width: int, height: int) -> Image.Image:
+        data = bytes(rng.getrandbits(8) for _ in range(width * height * 3))
+        return Image.frombytes("RGB", (width, height), data)
+
+    img = noise(16, 12).resize(size, Image.Resampling.BICUBIC)
+
+    grain = noise(128, 128)
+    texture = Image.new("RGB", size)
+    for x in range(0, size[0], grain.size[0]):
+        for y in range(0, size[1], grain.size[1]):
+            texture.paste(grain, (x, y))
+
+    return Image.blend(img, texture, 0.15)
+
+
+def generate(folder: Path, profile: str = "quick") -> List[Path]:
+    """Generate the corpus of the given *profile* into *folder*, one sub-folder per aspect ratio.
+    Files already generated are kept.
+    """
+    settings = PROFILES[profile]
+    files = []
+    for ratio in settings["ratios"]:
+        for megapixels in settings["megapixels"]:
+            for ext in settings["formats"]:
+                for n in range(settings["count"]):
+                    # Stems must differ, outputs of all formats have the same extension
+                    file = folder / ratio / f"{megapixels:03d}mp-{ext}-{n}.{ext}"
+                    files.append(file)
+                    if file.is_file():
+                        continue
+
+                    file.parent.mkdir(parents=True, exist_ok=True)
+                    seed = zlib.crc32(f"{ratio}/{megapixels}/{n}".encode("utf-8"))
+                    img = generate_image(image_size(megapixels, ratio), seed)
+                    tmp = file.with_name(f"{file.name}.part")
+                    if ext == "jpg":
+                        img.save(tmp, "JPEG", quality=90)
+                    else:
+                        img.save(tmp, "PNG", compress_level=1)
+                    tmp.replace(file)
+    return files
@@ -0,0 +1,305 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import multiprocessing
+import platform
+import time
+from contextlib import suppress
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import PIL
+from PIL import Image
+
+__all__ = ("BENCHMARKS", "peak_rss", "run", "run_all", "summarize")
+
+# Watermarks used by benchmarks
+TEXT = "© Tiger-222"
+PICTURE = str(Path(__file__).parent.parent / "watermark" / "tests" / "data" / "arresto-momentum.png")
+
+# Latencies of processed items, and the number of pixels processed
+Measures = Tuple[List[float], int]
+
+
+def peak_rss() -> Optional[float]:
+    """Get the peak resident set size of the current process, in MiB."""
+    # On GNU/Linux, the rusage one is kept across exec(), so it would be the parent process one
+    with suppress(OSError):
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return rss / (1024 * 1024 if platform.system() == "Darwin" else 1024)
+
+
+def percentile(values: List[float], rank: float) -> float:
+    """Get the nearest-rank percentile of sorted *values*."""
+    index = max(0, min(len(values) - 1, int(round(rank / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies: List[float], pixels: int) -> Dict[str, Any]:
+    """Get statistics of a benchmark run, only measured *latencies* are taken into account."""
+    values = sorted(latencies)
+    elapsed = sum(values)
+    return {
+        "items": len(values),
+        "elapsed": elapsed,
+        "throughput": len(values) / elapsed if elapsed else 0.0,
+        "megapixels_per_second": pixels / 1_000_000 / elapsed if elapsed else 0.0,
+        "latency": {
+            "mean": sum(values) / len(values) if values else 0.0,
+            "p50": percentile(values, 50) if values else 0.0,
+            "p90": percentile(values, 90) if values else 0.0,
+            "p99": percentile(values, 99) if values else 0.0,
+            "max": values[-1] if values else 0.0,
+        },
+    }
+
+
+def _outputs(files: List[Path], pattern: str) -> None:
+    """Remove outputs of previous runs."""
+    for folder in {file.parent for file in files}:
+        for output in folder.glob(pattern):
+            output.unlink()
+
+
+def bench_layer(files: List[Path], repeat: int, func: Callable, watermark: str) -> Measures:
+    """Apply a watermark on decoded images, decoding is not measured."""
+    latencies = []
+    pixels = 0
+    for file in files:
+        with Image.open(file) as img:
+            img = img.convert("RGB")
+        for _ in range(repeat):
+            copy = img.copy()
+            start = time.perf_counter()
+            func(copy, watermark)
+            latencies.append(time.perf_counter() - start)
+            pixels += img.size[0] * img.size[1]
+    return latencies, pixels
+
+
+def bench_text(files: List[Path], repeat: int) -> Measures:
+    """add_text_watermark() on decoded images."""
+    from watermark.watermark import add_text_watermark
+
+    return bench_layer(files, repeat, add_text_watermark, TEXT)
+
+
+def bench_picture(files: List[Path], repeat: int) -> Measures:
+    """add_picture_watermark() on decoded images."""
+    from watermark.watermark import add_picture_watermark
+
+    return bench_layer(files, repeat, add_picture_watermark, PICTURE)
+
+
+def bench_add_watermark(files: List[Path], repeat: int) -> Measures:
+    """add_watermark() end to end: decode, watermark, encode and write."""
+    from watermark.watermark import add_watermark
+
+    latencies = []
+    pixels = 0
+    for _ in range(repeat):
+        for file in files:
+            start = time.perf_counter()
+            add_watermark(file, text=TEXT, picture=PICTURE, overwrite=True)
+            latencies.append(time.perf_counter() - start)
+            with Image.open(file) as img:
+                pixels += img.size[0] * img.size[1]
+    _outputs(files, "*-w.*")
+    return latencies, pixels
+
+
+def bench_apply_watermarks(files: List[Path], repeat: int) -> Measures:
+    """apply_watermarks() over the corpus folder tree, the latency is the time between two results."""
+    from watermark.watermark import apply_watermarks
+
+    root = Path(*files[0].parts[:-2]) if files else Path()
+    sizes = {}
+    for file in files:
+        with Image.open(file) as img:
+            sizes[file] = img.size[0] * img.size[1]
+
+    latencies = []
+    pixels = 0
+    for _ in range(repeat):
+        _outputs(files, "*-w.*")
+        start = time.perf_counter()
+        for file, _ in apply_watermarks([root], TEXT, PICTURE):
+            now = time.perf_counter()
+            latencies.append(now - start)
+            start = now
+            pixels += sizes.get(file, 0)
+    _outputs(files, "*-w.*")
+    return latencies, pixels
+
+
+def bench_optimize(files: List[Path], repeat: int, latency: float = 0.0) -> Measures:
+    """optimize() against a local Tinify stand-in, waiting *latency* seconds per request."""
+    from watermark.optimizer import optimize
+    from watermark.testing import TinifyServer
+    from watermark.watermark import add_watermark
+
+    outputs = [add_watermark(file, text=TEXT, overwrite=True) for file in files]
+    latencies = []
+    pixels = 0
+    with TinifyServer(latency=latency):
+        for _ in range(repeat):
+            _outputs(files, "*-wo.*")
+            for file, output in zip(files, outputs):
+                if not output:
+                    continue
+                start = time.perf_counter()
+                optimize(output)
+                latencies.append(time.perf_counter() - start)
+                with Image.open(file) as img:
+                    pixels += img.size[0] * img.size[1]
+    _outputs(files, "*-w*.*")
+    return latencies, pixels
+
+
+def bench_optimize_all(files: List[Path], repeat: int, latency: float = 0.0, workers: int = 4) -> Measures:
+    """optimize_all() against a local Tinify stand-in, using *workers* concurrent uploads."""
+    from watermark.optimizer import optimize_all
+    from watermark.testing import TinifyServer
+    from watermark.watermark import add_watermark
+
+    outputs = [add_watermark(file, text=TEXT, overwrite=True) for file in files]
+    sizes = {}
+    for file, output in zip(files, outputs):
+        if output:
+            with Image.open(file) as img:
+                sizes[output] = img.size[0] * img.size[1]
+
+    latencies = []
+    pixels = 0
+    with TinifyServer(latency=latency):
+        for _ in range(repeat):
+            _outputs(files, "*-wo.*")
+            start = time.perf_counter()
+            for output, _ in optimize_all(list(sizes), workers=workers):
+                now = time.perf_counter()
+                latencies.append(now - start)
+                start = now
+                pixels += sizes[output]
+    _outputs(files, "*-w*.*")
+    return latencies, pixels
+
+
+def bench_pipeline(files: List[Path], repeat: int, latency: float = 0.0) -> Measures:
+    """apply_watermarks() using the "pipeline" backend, optimizing against a local Tinify stand-in,
+    the latency is the time between two results.
+    """
+    from watermark.optimizer import TinifyClient
+    from watermark.testing import TinifyServer
+    from watermark.watermark import apply_watermarks
+
+    root = Path(*files[0].parts[:-2]) if files else Path()
+    sizes = {}
+    for file in files:
+        with Image.open(file) as img:
+            sizes[file] = img.size[0] * img.size[1]
+
+    latencies = []
+    pixels = 0
+    with TinifyServer(latency=latency), TinifyClient() as client:
+        for _ in range(repeat):
+            _outputs(files, "*-w*.*")
+            start = time.perf_counter()
+            for file, _ in apply_watermarks([root], TEXT, PICTURE, backend="pipeline", optimizer=client):
+                now = time.perf_counter()
+                latencies.append(now - start)
+                start = now
+                pixels += sizes.get(file, 0)
+    _outputs(files, "*-w*.*")
+    return latencies, pixels
+
+
+def bench_optimize_local(files: List[Path], repeat: int) -> Measures:
+    """LocalOptimizer.optimize(), searching the JPEG quality."""
+    from watermark.optimizer import LocalOptimizer
+    from watermark.watermark import add_watermark
+
+    optimizer = LocalOptimizer()
+    outputs = [add_watermark(file, text=TEXT, overwrite=True) for file in files]
+    latencies = []
+    pixels = 0
+    for _ in range(repeat):
+        _outputs(files, "*-wo.*")
+        for file, output in zip(files, outputs):
+            if not output:
+                continue
+            start = time.perf_counter()
+            optimizer.optimize(output)
+            latencies.append(time.perf_counter() - start)
+            with Image.open(file) as img:
+                pixels += img.size[0] * img.size[1]
+    _outputs(files, "*-w*.*")
+    return latencies, pixels
+
+
+# Available benchmarks
+BENCHMARKS: Dict[str, Callable[..., Measures]] = {
+    "text": bench_text,
+    "picture": bench_picture,
+    "add_watermark": bench_add_watermark,
+    "apply_watermarks": bench_apply_watermarks,
+    "optimize": bench_optimize,
+    "optimize_all": bench_optimize_all,
+    "optimize_local": bench_optimize_local,
+    "pipeline": bench_pipeline,
+}
+
+
+def run(name: str, files: List[str], repeat: int, **kwargs: Any) -> Dict[str, Any]:
+    """Run one benchmark, and get its statistics.
+    Default watermark options are used, whatever the user configuration.
+    """
+    from watermark.conf import CONF, default_config
+
+    vars(CONF).update(default_config())
+
+    latencies, pixels = BENCHMARKS[name]([Path(file) for file in files], repeat, **kwargs)
+    result = summarize(latencies, pixels)
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def run_all(
+    files: List[Path], names: List[str], repeat: int = 3, profile: str = "", tinify_latency: float = 0.0
+) -> Dict[str, Any]:
+    """Run given benchmarks on *files*.
+    Each benchmark runs in its own process, so that its peak memory usage is its own.
+    """
+    results: Dict[str, Any] = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "profile": profile,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "benchmarks": {},
+    }
+    ctx = multiprocessing.get_context("spawn")
+    for name in names:
+        kwargs = {"latency": tinify_latency} if name in ("optimize", "optimize_all", "pipeline") else {}
+        with ctx.Pool(1) as pool:
+            results["benchmarks"][name] = pool.apply(run, (name, [str(file) for file in files], repeat), kwargs)
+    return results
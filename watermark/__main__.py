@@ -8,15 +8,27 @@ You can always get the latest version of this module at:
 If that URL should fail, try contacting the author.
 """
 import sys
+from typing import List
 
-from PyQt5.QtWidgets import QApplication
-from tendo.singleton import SingleInstance, SingleInstanceException
-from watermark.conf import save_config
-from watermark.gui.app import MainWindow
 
+def main(args: List[str]) -> int:
+    """Entry point.
+    The "batch" subcommand runs without the GUI, and without importing Qt at all.
+    """
+    if args[:1] == ["batch"]:
+        from watermark.cli import main as batch
+
+        return batch(args[1:])
+    return gui()
+
+
+def gui() -> int:
+    """Start the GUI."""
+    from PyQt5.QtWidgets import QApplication
+    from tendo.singleton import SingleInstance, SingleInstanceException
+    from watermark.conf import save_config
+    from watermark.gui.app import MainWindow
 
-def main() -> int:
-    """Entry point."""
     # Allow only one instance
     try:
         me = SingleInstance()  # noqa
@@ -33,4 +45,4 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(main(sys.argv[1:]))
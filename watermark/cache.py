@@ -0,0 +1,138 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import hashlib
+import json
+import os
+import time
+from contextlib import suppress
+from os.path import expandvars
+from pathlib import Path
+from threading import Lock, get_ident
+from typing import Any, Dict, Optional, Tuple
+
+from .constants import CONF_DIR
+
+__all__ = ("CACHE_DIR", "OptimizationCache", "get_cache")
+
+# The default folder of cached optimization results
+CACHE_DIR = f"{CONF_DIR}/cache"
+
+
+class OptimizationCache:
+    """Content-addressed cache of optimized files, stored into *folder*.
+
+    Results are keyed by the SHA-256 of the content to optimize and of the optimizer settings,
+    so that identical contents are optimized once, wherever they come from.
+    When the cache is bigger than *max_size* bytes, least recently used results are evicted.
+    """
+
+    def __init__(self, folder: Path = Path(CACHE_DIR), max_size: int = 512 * 1024 * 1024) -> None:
+        self.folder = Path(expandvars(str(folder))).expanduser()
+        self.max_size = max_size
+        self.size = 0
+        self._lock = Lock()
+
+        # Entries: key -> (size, last use)
+        self._entries: Dict[str, Tuple[int, float]] = {}
+        self.folder.mkdir(parents=True, exist_ok=True)
+        for bucket in self.folder.iterdir():
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket):
+                if entry.name.endswith(".part"):
+                    continue
+                stat = entry.stat()
+                self._entries[entry.name] = (stat.st_size, stat.st_mtime)
+                self.size += stat.st_size
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Copies, used by worker processes, track the cache size on their own."""
+        state = dict(vars(self))
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        vars(self).update(state)
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(data: bytes, settings: Dict[str, Any]) -> str:
+        """Get the key of a given content *data*, optimized using given *settings*."""
+        sha = hashlib.sha256(data)
+        sha.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+        return sha.hexdigest()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Get the cached result of a given *key*, if any."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            size, _ = self._entries[key]
+            self._entries[key] = (size, time.time())
+
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            self._forget(key)
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Cache the result *data* of a given *key*, then evict least recently used results if needed."""
+        if len(data) > self.max_size:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}-{get_ident()}.part")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            old_size, _ = self._entries.get(key, (0, 0.0))
+            self._entries[key] = (len(data), time.time())
+            self.size += len(data) - old_size
+            if self.size <= self.max_size:
+                return
+            evicted = []
+            for old_key, _ in sorted(self._entries.items(), key=lambda item: item[1][1]):
+                if self.size <= self.max_size:
+                    break
+                if old_key != key:
+                    self.size -= self._entries.pop(old_key)[0]
+                    evicted.append(old_key)
+
+        for old_key in evicted:
+            with suppress(FileNotFoundError):
+                self._path(old_key).unlink()
+
+    def _forget(self, key: str) -> None:
+        """Forget a result that is no longer in the cache folder."""
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[0]
+
+    def _path(self, key: str) -> Path:
+        """Get the file of a given *key*."""
+        return self.folder / key[:2] / key
+
+
+def get_cache(folder: str = "", size: int = 0) -> Optional[OptimizationCache]:
+    """Get the cache stored into *folder*, or the default one, up to *size* MiB.
+    There is no cache when the *size* is 0.
+    """
+    if not size:
+        return None
+    return OptimizationCache(Path(folder or CACHE_DIR), max_size=size * 1024 * 1024)
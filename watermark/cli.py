@@ -0,0 +1,251 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import sys
+from argparse import ArgumentParser, Namespace
+from contextlib import ExitStack
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from .conf import CONF, OPTIMIZERS, OUTPUT_FORMATS
+from .metrics import METRICS
+from .pipeline import STAGES
+from .profiling import ENV_VAR, Profiler, profile_folder
+from .watermark import BACKENDS, apply_watermarks, is_final
+
+if TYPE_CHECKING:
+    from .manifest import Manifest  # noqa: F401
+    from .optimizer import Optimizer  # noqa: F401
+
+__all__ = ("get_parser", "main")
+
+
+def quality(value: str) -> Union[int, str]:
+    """Validate the *value* of the --quality argument."""
+    if value == "keep":
+        return value
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if not 1 <= number <= 100:
+        raise ValueError(value)
+    return number
+
+
+def stage(value: str) -> Tuple[str, int]:
+    """Validate the *value* of the --stage argument, as NAME=THREADS."""
+    name, _, threads = value.partition("=")
+    if name not in STAGES or not threads.isdigit() or int(threads) < 1:
+        raise ValueError(value)
+    return name, int(threads)
+
+
+def get_parser() -> ArgumentParser:
+    """Get the command line arguments parser."""
+    parser = ArgumentParser(
+        prog="python -m watermark batch",
+        description="Watermark pictures without the GUI.",
+    )
+    parser.add_argument("paths", nargs="+", type=Path, help="files and folders to watermark")
+
+    group = parser.add_argument_group("watermark")
+    group.add_argument("-t", "--text", default=CONF.text, help="the watermark text")
+    group.add_argument("-p", "--picture", default=CONF.picture, help="the watermark picture")
+    group.add_argument("--font", default=CONF.font, help="the font file used for the text")
+    group.add_argument("--color", default=CONF.text_color, help="the text color, as #rrggbb")
+    group.add_argument("--opacity", type=float, default=CONF.opacity, help="the watermark opacity, from 0 to 1")
+    group.add_argument("--pattern", action="store_true", default=CONF.pattern, help="repeat the text over images")
+
+    group = parser.add_argument_group("output")
+    group.add_argument("--format", choices=sorted(OUTPUT_FORMATS), default=CONF.output_format, help="output format")
+    group.add_argument("--quality", type=quality, default=CONF.quality, help="encoder quality, 1-100 or keep")
+    group.add_argument("--max-size", type=int, default=0, help="downscale images to fit in a square of that size")
+    group.add_argument("--optimize", action="store_true", help="optimize outputs")
+    group.add_argument("--optimizer", choices=OPTIMIZERS, default=CONF.optimizer, help="how outputs are optimized")
+    group.add_argument(
+        "--optimize-workers",
+        type=int,
+        default=4,
+        help="number of files processed in parallel when optimizing without -j, or optimize stage threads",
+    )
+    group.add_argument("--tinify-key", default=CONF.tinify_key, help="the Tinify API key")
+    group.add_argument("--tinify-usage", default="", help="where Tinify compressions made this month are kept")
+    group.add_argument(
+        "--max-error", type=float, default=CONF.optimizer_max_error, help="local optimizer error budget, luma RMS"
+    )
+    group.add_argument(
+        "--target-size", type=int, default=CONF.optimizer_target_size, help="local optimizer target size, bytes"
+    )
+    group.add_argument("--cache-dir", default=CONF.cache_dir, help="where optimized outputs are cached")
+    group.add_argument("--cache-size", type=int, default=CONF.cache_size, help="optimized outputs cache size, MiB")
+
+    group = parser.add_argument_group("processing")
+    group.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="number of files processed in parallel, 1 by default, or --optimize-workers when optimizing",
+    )
+    group.add_argument("--backend", choices=BACKENDS, default="thread", help="how files are processed in parallel")
+    group.add_argument(
+        "--stage",
+        type=stage,
+        action="append",
+        default=[],
+        help=f"number of threads of a pipeline stage, as NAME=THREADS ({', '.join(STAGES)})",
+    )
+    group.add_argument("--tile-threads", type=int, default=1, help="number of threads working on one image")
+    group.add_argument("--scan-threads", type=int, default=1, help="number of threads scanning folders")
+    group.add_argument("--memory-budget", type=int, default=CONF.memory_budget, help="watermark memory budget, MiB")
+    group.add_argument("--manifest", type=Path, help="only process files changed since the run using this manifest")
+    group.add_argument("--metrics", type=Path, help="save metrics to this file, as JSON, or OpenMetrics if *.prom")
+    group.add_argument("--profile", default="", help=f"profile the run, and save reports to this folder ({ENV_VAR})")
+    group.add_argument("--profile-slowest", type=int, default=5, help="report allocations of the N slowest pictures")
+    group.add_argument("-q", "--quiet", action="store_true", help="only print failures")
+    return parser
+
+
+def main(args: Optional[List[str]] = None) -> int:
+    """Watermark files given on the command line.
+    Outputs of previous runs are skipped.
+    Results are printed for each file, the exit code is 1 if any file failed.
+    """
+    parser = get_parser()
+    options = parser.parse_args(args)
+    if not (options.text or options.picture):
+        print("Nothing to do: no watermark text nor picture.", file=sys.stderr)
+        return 2
+    if options.picture:
+        try:
+            with Image.open(options.picture):
+                pass
+        except OSError as exc:
+            parser.error(f"invalid watermark picture: {exc}")
+
+    # Watermark settings are read from the configuration, that is not saved back
+    CONF.font = options.font
+    CONF.text_color = options.color
+    CONF.opacity = options.opacity
+    CONF.pattern = options.pattern
+    CONF.memory_budget = options.memory_budget
+
+    if options.optimize and options.optimizer == "tinify":
+        # Tinify is only imported when needed
+        from .optimizer import validate_key
+
+        if not validate_key(options.tinify_key):
+            print("Invalid Tinify API key.", file=sys.stderr)
+            return 2
+
+    if options.metrics:
+        METRICS.enabled = True
+        METRICS.reset()
+
+    profile = profile_folder(options.profile)
+    if profile and ((options.workers or 1) > 1 or options.tile_threads > 1 or options.backend == "pipeline"):
+        # Only the current thread is profiled
+        print("Profiling: pictures are processed one by one, using one thread.", file=sys.stderr)
+        options.workers = options.tile_threads = options.optimize_workers = 1
+        if options.backend == "pipeline":
+            options.backend = "thread"
+
+    manifest = None
+    if options.manifest:
+        from .manifest import Manifest
+
+        manifest = Manifest(options.manifest)
+    try:
+        with ExitStack() as stack:
+            profiler = stack.enter_context(Profiler(profile, slowest=options.profile_slowest)) if profile else None
+            failures = process(options, manifest)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        if options.metrics:
+            save_metrics(options.metrics)
+
+    if profiler:
+        for report in profiler.reports.values():
+            print(f"Profiling report saved to {report}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def save_metrics(file: Path) -> None:
+    """Save metrics of the run to the given *file*."""
+    if file.suffix == ".prom":
+        file.write_text(METRICS.to_openmetrics(), encoding="utf-8")
+    else:
+        file.write_text(METRICS.to_json(), encoding="utf-8")
+
+
+def process(options: Namespace, manifest: Optional["Manifest"]) -> int:
+    """Watermark, and optimize, files. Return the number of failures."""
+    failures = 0
+    workers = options.workers
+    stages = dict(options.stage)
+    with ExitStack() as stack:
+        optimizer = None
+        if options.optimize:
+            optimizer = stack.enter_context(get_optimizer(options))
+            # Uploads wait for the network, more files can be processed meanwhile
+            if options.backend == "pipeline":
+                stages.setdefault("optimize", options.optimize_workers)
+            elif workers is None:
+                workers = options.optimize_workers
+
+        results = apply_watermarks(
+            options.paths,
+            options.text,
+            options.picture,
+            workers=workers or 1,
+            backend=options.backend,
+            scan_threads=options.scan_threads,
+            max_size=options.max_size,
+            output_format=options.format,
+            encoder={"quality": options.quality},
+            manifest=manifest,
+            tile_threads=options.tile_threads,
+            optimizer=optimizer,
+            stages=stages,
+            skip_outputs=True,
+        )
+        for file, output in results:
+            if not output:
+                failures += 1
+                print(f"FAIL {file}", file=sys.stderr)
+            elif optimizer is not None and output != file and not is_final(output, optimizer):
+                if file in optimizer.skipped:
+                    if not options.quiet:
+                        print(f"SKIP {file} -> {output} (no Tinify compressions left)")
+                else:
+                    failures += 1
+                    print(f"FAIL {file} -> {output} (not optimized)", file=sys.stderr)
+            elif not options.quiet:
+                print(f"OK   {file} -> {output}")
+
+    return failures
+
+
+def get_optimizer(options: Namespace) -> "Optimizer":
+    """Get the optimizer set up on the command line."""
+    # Optimizers are only imported when needed
+    from . import optimizer
+    from .cache import get_cache
+    from .quota import QuotaUsage
+
+    settings: Dict[str, Any] = {"cache": get_cache(options.cache_dir, options.cache_size)}
+    if options.optimizer == "local":
+        settings.update(max_error=options.max_error, target_size=options.target_size)
+    else:
+        settings["usage"] = QuotaUsage(Path(options.tinify_usage)) if options.tinify_usage else QuotaUsage()
+    return optimizer.get_optimizer(options.optimizer, **settings)
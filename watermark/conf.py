@@ -10,16 +10,27 @@ If that URL should fail, try contacting the author.
 import re
 from os.path import expandvars, isfile
 from pathlib import Path
+from threading import Lock
 from types import SimpleNamespace
 from typing import Any, Dict
 
-import yaml
-
 from .constants import CONF_DIR, DATA_DIR
 
 
 Options = Dict[str, Any]
 
+# Supported output formats and their file extension
+OUTPUT_FORMATS = {"jpeg": "jpg", "png": "png", "webp": "webp", "avif": "avif"}
+
+# Available optimizers
+OPTIMIZERS = ("local", "tinify")
+
+# Default encoder quality, same as Pillow one
+DEFAULT_QUALITY = 75
+
+# The configuration is read by the first thread accessing it, others wait
+_LOCK = Lock()
+
 
 def default_font() -> str:
     """Get the default font file."""
@@ -29,12 +40,26 @@ def default_font() -> str:
 def default_config() -> Options:
     """Get default options."""
     return {
+        "cache_dir": "",
+        "cache_size": 512,
         "extensions": ("jpg", "png"),
         "font": default_font(),
         "lang": "",
+        "memory_budget": 0,
         "opacity": 0.25,
         "optimize": False,
+        "optimize_encoding": False,
+        "optimizer": "tinify",
+        "optimizer_max_error": 4.0,
+        "optimizer_target_size": 0,
+        "output_format": "jpeg",
+        "pattern": False,
         "picture": "",
+        "png_compress_level": 6,
+        "profile_dir": "",
+        "progressive": False,
+        "quality": DEFAULT_QUALITY,
+        "subsampling": -1,
         "text": "",
         "text_color": "#ffffff",
         "tinify_key": "",
@@ -44,6 +69,8 @@ def default_config() -> Options:
 
 def read_config(folder: str = CONF_DIR) -> SimpleNamespace:
     """Read the configugration file."""
+    import yaml
+
     file = Path(expandvars(folder)).expanduser() / "config.yml"
     file.parent.mkdir(parents=True, exist_ok=True)
 
@@ -69,16 +96,80 @@ def read_config(folder: str = CONF_DIR) -> SimpleNamespace:
     if not re.fullmatch(r"#[0-9a-fA-F]{6}", config["text_color"]):
         config["text_color"] = "#ffffff"
 
+    # Ensure the output format is known
+    if config["output_format"] not in OUTPUT_FORMATS:
+        config["output_format"] = "jpeg"
+
+    # Ensure the optimizer is known
+    if config["optimizer"] not in OPTIMIZERS:
+        config["optimizer"] = "tinify"
+
+    # Ensure the quality is a percentage, or "keep" to reuse the JPEG source one
+    quality = config["quality"]
+    if quality != "keep" and (
+        not isinstance(quality, int) or not 1 <= quality <= 100
+    ):
+        config["quality"] = DEFAULT_QUALITY
+
     return SimpleNamespace(**config)
 
 
+def encoder_settings(**overrides: Any) -> Options:
+    """Get encoder settings from the configuration, with optional *overrides*."""
+    settings = {
+        "quality": CONF.quality,
+        "progressive": CONF.progressive,
+        "optimize": CONF.optimize_encoding,
+        "subsampling": CONF.subsampling,
+        "compress_level": CONF.png_compress_level,
+    }
+    settings.update(overrides)
+    return settings
+
+
 def save_config(folder: str = CONF_DIR) -> None:
     """Save options to the configugration file."""
+    import yaml
+
     file = Path(expandvars(folder)).expanduser() / "config.yml"
     file.parent.mkdir(parents=True, exist_ok=True)
 
     with file.open(mode="w", encoding="utf-8") as fh:
-        yaml.safe_dump(vars(CONF), fh)
-
-
-CONF = read_config()
+        yaml.safe_dump(vars(CONF.load()), fh)
+
+
+class Config(SimpleNamespace):
+    """Options, read from the configuration file in *folder* on first access to any of them.
+    Options set before that are kept.
+    """
+
+    __slots__ = ("_folder", "_loaded")
+
+    def __init__(self, folder: str = CONF_DIR) -> None:
+        super().__init__()
+        self._folder = folder
+        self._loaded = False
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for options not yet read
+        if name.startswith("_") or self._loaded:
+            raise AttributeError(name)
+        self.load()
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def load(self) -> "Config":
+        """Read the configuration file, if not already done."""
+        if not self._loaded:
+            with _LOCK:
+                if not self._loaded:
+                    options = vars(read_config(self._folder))
+                    options.update(self.__dict__)
+                    self.__dict__.update(options)
+                    self._loaded = True
+        return self
+
+
+CONF = Config()
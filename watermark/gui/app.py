@@ -9,9 +9,10 @@ If that URL should fail, try contacting the author.
 """
 from pathlib import Path
 from threading import Thread
+from typing import TYPE_CHECKING, Any, Dict, Optional
 
-from PyQt5.QtCore import QEvent, QTimer, Qt, QCoreApplication
-from PyQt5.QtGui import QColor, QIcon, QPixmap
+from PyQt5.QtCore import QEvent, QTimer, Qt
+from PyQt5.QtGui import QCloseEvent, QColor, QIcon, QPixmap
 from PyQt5.QtWidgets import (
     QAction,
     QColorDialog,
@@ -30,17 +31,19 @@ from PyQt5.QtWidgets import (
     QWidget,
     qApp,
 )
-import tinify
 
 from .settings import Settings
 from .utils import set_cursor, set_style
+from .worker import BatchWorker
 from ..translator import TR
 from .. import __version__
 from ..conf import CONF
+from ..metrics import METRICS
 from ..constants import COMPANY, FREEZER, RES_DIR, TITLE, WINDOWS
-from ..optimizer import optimize, validate_key
-from ..watermark import apply_watermarks
-from ..utils import sizeof_fmt
+from ..utils import duration_fmt, sizeof_fmt
+
+if TYPE_CHECKING:
+    from ..optimizer import Optimizer  # noqa: F401
 
 
 class MainWindow(QMainWindow):
@@ -79,15 +82,22 @@ class MainWindow(QMainWindow):
         self.timer.start(100)
 
         # Keep track of some metrics
-        self.stats = {"count": 0, "size_before": 0, "size_after": 0}
+        self.stats = {"count": 0, "size_before": 0, "size_after": 0, "skipped": 0}
+
+        # The batch being processed, and its progress
+        self._worker: Optional[BatchWorker] = None
+        self._progress: Dict[str, Any] = {}
 
         # Used to check if picture optimization is enabled and the provided key valid
         self._use_optimization = None
         self._old_key = None
         self._old_state = None
+        self._old_optimizer = None
+
+        # The settings window is created on first use
+        self._settings: Optional[Settings] = None
 
         # Init the GUI
-        self._settings = Settings()
         self._toolbar()
         self.addToolBar(self.toolbar)
         self._status_bar()
@@ -106,19 +116,31 @@ class MainWindow(QMainWindow):
             self._use_optimization is None
             or CONF.tinify_key != self._old_key
             or CONF.optimize != self._old_state
+            or CONF.optimizer != self._old_optimizer
         ):
             self._old_key = CONF.tinify_key
             self._old_state = CONF.optimize
-            self._use_optimization = CONF.optimize and validate_key(self._old_key)
+            self._old_optimizer = CONF.optimizer
+            self._use_optimization = False
+            if CONF.optimize and CONF.optimizer == "local":
+                self._use_optimization = True
+            elif CONF.optimize:
+                # Tinify is only imported when needed
+                from ..optimizer import validate_key
+
+                self._use_optimization = validate_key(self._old_key)
         return self._use_optimization
 
     def button_ok_state(self) -> None:
         """Handle the state of the OK button. It should be enabled when particular criterias are met."""
 
-        self.buttons.setEnabled(
+        self.buttons.button(QDialogButtonBox.Ok).setEnabled(
             bool(self.text.text() or self.picture.text())
             and self.paths_list.count() > 0
+            and self._worker is None
         )
+        self.btn_pause.setVisible(self._worker is not None)
+        self.btn_cancel.setVisible(self._worker is not None)
 
     def _check_for_update(self) -> None:
         """Check for a new update."""
@@ -148,6 +170,12 @@ class MainWindow(QMainWindow):
             self.picture.setText(path)
             CONF.picture = path
 
+    def _show_settings(self) -> None:
+        """Open the settings window."""
+        if self._settings is None:
+            self._settings = Settings()
+        self._settings.exec_()
+
     def _status_bar(self) -> None:
         """Create the status bar."""
         self.status_bar = QStatusBar()
@@ -156,14 +184,29 @@ class MainWindow(QMainWindow):
     def _status_msg(self, msg: str = "") -> None:
         """Display statistics in the status bar."""
         if not msg:
-            win = self.stats["size_before"] - self.stats["size_after"]
-            values = [str(self.stats["count"]), sizeof_fmt(win, suffix=TR.get("BYTE"))]
+            # Statistics of previous batches, and of the current one
+            stats = {key: value + self._progress.get(key, 0) for key, value in self.stats.items()}
+            win = stats["size_before"] - stats["size_after"]
+            values = [str(stats["count"]), sizeof_fmt(win, suffix=TR.get("BYTE"))]
             msg = TR.get("STATISTICS", values)
-            if self.use_optimization:
+            if stats["count"]:
+                msg += TR.get("STATISTICS_SPEED", [f"{METRICS.rate('files_processed'):.1f}"])
+            if stats["skipped"]:
+                msg += TR.get("STATISTICS_SKIPPED", [str(stats["skipped"])])
+            if self._worker is not None and self._progress:
+                eta = self._progress["eta"]
+                values = [
+                    str(self._progress["done"]),
+                    str(self._progress["total"]),
+                    "?" if eta is None else duration_fmt(eta),
+                ]
+                msg += TR.get("STATISTICS_PROGRESS", values)
+            if self.use_optimization and CONF.optimizer == "tinify":
+                import tinify
+
                 msg += TR.get("STATISTICS_TINIFY", [tinify.compression_count])
 
         self.status_bar.showMessage(msg)
-        QCoreApplication.processEvents()  # Important, keep it!
 
     def _toolbar(self) -> QToolBar:
         """Create the toolbar."""
@@ -175,7 +218,7 @@ class MainWindow(QMainWindow):
         settings_action = QAction(
             QIcon(str(RES_DIR / "settings.svg")), TR.get("TB_SETTINGS"), self
         )
-        settings_action.triggered.connect(self._settings.exec_)
+        settings_action.triggered.connect(self._show_settings)
         self.toolbar.addAction(settings_action)
 
         # Icon: about
@@ -292,8 +335,16 @@ class MainWindow(QMainWindow):
         # Buttons
         self.buttons = QDialogButtonBox()
         self.buttons.setStandardButtons(QDialogButtonBox.Ok)
-        self.buttons.clicked.connect(self._process_all)
+        self.buttons.button(QDialogButtonBox.Ok).clicked.connect(self._process_all)
         set_cursor(self.buttons.button(QDialogButtonBox.Ok))
+
+        # Buttons to pause, and cancel, the batch being processed
+        self.btn_pause = self.buttons.addButton(TR.get("PAUSE"), QDialogButtonBox.ActionRole)
+        self.btn_pause.clicked.connect(self._pause)
+        set_cursor(self.btn_pause)
+        self.btn_cancel = self.buttons.addButton(TR.get("CANCEL"), QDialogButtonBox.RejectRole)
+        self.btn_cancel.clicked.connect(self._cancel)
+        set_cursor(self.btn_cancel)
         layout.addWidget(self.buttons)
 
         self.resize(640, 480)
@@ -307,37 +358,85 @@ class MainWindow(QMainWindow):
         paths = [
             Path(self.paths_list.item(i).text()) for i in range(self.paths_list.count())
         ]
-        if not paths:
+        if not paths or self._worker is not None:
             return
 
-        # Add watermark(s) to all files
-        for path_orig, path_new in apply_watermarks(paths, CONF.text, CONF.picture):
-            if not path_new:
-                continue
-
-            # Optimize the picture
-            if self.use_optimization:
-                path_new_optimized = optimize(path_new)
-                if path_new_optimized:
-                    # Delete the "-w.jpg"
-                    path_new.unlink()
-                    # Keep the new "-wo.jpg"
-                    path_new = path_new_optimized
-
-            # Update statistics
-            self.stats["count"] += 1
-            self.stats["size_before"] += path_orig.stat().st_size
-            self.stats["size_after"] += path_new.stat().st_size
-
-            # Update the status bar message
-            self._status_msg()
-            QCoreApplication.processEvents()  # Important, keep it!
+        # Measure the processing speed of this batch
+        METRICS.enabled = True
+        METRICS.reset()
+
+        # Files are processed in another thread, so that the window stays responsive
+        optimizer = self._optimizer() if self.use_optimization else None
+        self._worker = BatchWorker(paths, optimizer=optimizer, parent=self)
+        self._worker.progress.connect(self._on_progress)
+        self._worker.finished.connect(self._on_finished)
+        self._progress = {}
+        self.btn_pause.setText(TR.get("PAUSE"))
+        self.btn_cancel.setEnabled(True)
+        self.button_ok_state()
+        self._worker.start()
 
-        # Empty the paths to handle
-        self.paths_list.clear()
+    def _on_progress(self, progress: Dict[str, Any]) -> None:
+        """Display the progress of the batch, sent a few times per second by the worker."""
+        self._progress = progress
+        self._status_msg()
 
-        # And update the OK button state
+    def _on_finished(self) -> None:
+        """Keep statistics of the batch once it is done, or cancelled."""
+        for key in self.stats:
+            self.stats[key] += self._progress.get(key, 0)
+        self._progress = {}
+        cancelled = False
+        if self._worker is not None:
+            cancelled = self._worker.cancelled
+            self._worker.deleteLater()
+            self._worker = None
+
+        # Empty the paths to handle, they are kept when cancelled: processed files will be skipped next time
+        if not cancelled:
+            self.paths_list.clear()
+
+        # And update the buttons state
         self.button_ok_state()
+        self._status_msg()
+
+    def _pause(self) -> None:
+        """Pause, or resume, the batch."""
+        if self._worker is None:
+            return
+        if self._worker.paused:
+            self._worker.resume()
+            self.btn_pause.setText(TR.get("PAUSE"))
+        else:
+            self._worker.pause()
+            self.btn_pause.setText(TR.get("RESUME"))
+
+    def _cancel(self) -> None:
+        """Cancel the batch, files being processed are completed."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self.btn_cancel.setEnabled(False)
+
+    def closeEvent(self, event: QCloseEvent) -> None:
+        """Stop the batch before closing the window, not to leave partial outputs."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker.wait()
+        super().closeEvent(event)
+
+    def _optimizer(self) -> "Optimizer":
+        """Get the optimizer set up in the configuration."""
+        from ..cache import get_cache
+        from ..optimizer import get_optimizer
+
+        settings: Dict[str, Any] = {"cache": get_cache(CONF.cache_dir, CONF.cache_size)}
+        if CONF.optimizer == "local":
+            settings.update(max_error=CONF.optimizer_max_error, target_size=CONF.optimizer_target_size)
+        else:
+            from ..quota import QuotaUsage
+
+            settings["usage"] = QuotaUsage()
+        return get_optimizer(CONF.optimizer, **settings)
 
 
 class DroppableQList(QListWidget):
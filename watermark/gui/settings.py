@@ -9,6 +9,7 @@ If that URL should fail, try contacting the author.
 """
 
 from functools import partial
+from types import SimpleNamespace
 
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QIcon
@@ -44,7 +45,7 @@ class Settings(QDialog):
         self.setWindowTitle(TR.get("TITLE_SETTINGS", [TITLE]))
         self.setWindowIcon(QIcon(str(RES_DIR / "logo.svg")))
 
-        self.conf = type(CONF)(**vars(CONF).copy())
+        self.conf = SimpleNamespace(**vars(CONF.load()))
 
         layout = QVBoxLayout()
         tabs = QTabWidget(self)
@@ -71,6 +72,11 @@ class Settings(QDialog):
         if value:
             self.conf.lang = key
 
+    def _on_optimizer_toggled(self, key: str, value: bool) -> None:
+        """Signal triggered when the optimizer radio buttons are toggled."""
+        if value:
+            self.conf.optimizer = key
+
     def _tab_general(self) -> QWidget:
         """Generate the General tab."""
         tab = QWidget()
@@ -164,6 +170,13 @@ class Settings(QDialog):
         box = QVBoxLayout()
         box.setSizeConstraint(QLayout.SetMinAndMaxSize)
         groupbox.setLayout(box)
+        for key in ("local", "tinify"):
+            radio = QRadioButton(TR.get(f"OPTIMIZE_{key.upper()}"))
+            set_cursor(radio)
+            box.addWidget(radio)
+            radio.toggled.connect(partial(self._on_optimizer_toggled, key))
+            if CONF.optimizer == key:
+                radio.setChecked(True)
         label = QLabel(TR.get("OPTIMIZE_INFO"))
         box.addWidget(label)
         label.setTextFormat(Qt.RichText)
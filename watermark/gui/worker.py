@@ -0,0 +1,115 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+from contextlib import ExitStack
+from pathlib import Path
+from threading import Event
+from typing import TYPE_CHECKING, List, Optional
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+from ..conf import CONF
+from ..profiling import Profiler, profile_folder
+from ..progress import Progress
+from ..watermark import apply_watermarks, iter_files
+
+if TYPE_CHECKING:
+    from ..optimizer import Optimizer  # noqa: F401
+
+
+class BatchWorker(QThread):
+    """Watermark, and optimize using the *optimizer*, given *paths* out of the GUI thread.
+
+    The progress of the batch, see `Progress.snapshot()`, is sent through the `progress` signal
+    at most every *interval* seconds. The batch can be paused, and cancelled: files being
+    processed are completed, others are not started.
+    The *optimizer* is closed when the batch is done.
+    """
+
+    progress = pyqtSignal(dict)
+
+    def __init__(
+        self,
+        paths: List[Path],
+        optimizer: Optional["Optimizer"] = None,
+        interval: float = 0.25,
+        parent: Optional[QObject] = None,
+    ) -> None:
+        super().__init__(parent)
+        self.paths = paths
+        self.optimizer = optimizer
+        self.interval = interval
+
+        self._cancelled = Event()
+        self._resumed = Event()
+        self._resumed.set()
+
+    @property
+    def cancelled(self) -> bool:
+        """Tell if the batch was cancelled."""
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self) -> bool:
+        """Tell if the batch is paused."""
+        return not self._resumed.is_set()
+
+    def cancel(self) -> None:
+        """Stop the batch, as soon as files being processed are done."""
+        self._cancelled.set()
+        self._resumed.set()
+
+    def pause(self) -> None:
+        """Pause the batch, once files being processed are done."""
+        self._resumed.clear()
+
+    def resume(self) -> None:
+        """Resume a paused batch."""
+        self._resumed.set()
+
+    def run(self) -> None:
+        """Process the batch, in the worker thread."""
+        # Only the current thread is profiled, files are then processed one by one
+        profile = profile_folder()
+        with ExitStack() as stack:
+            if self.optimizer is not None:
+                stack.enter_context(self.optimizer)
+            if profile:
+                stack.enter_context(Profiler(profile))
+            self._process("thread" if profile else "pipeline")
+
+    def _process(self, backend: str) -> None:
+        """Watermark, and optimize, files using the given *backend*."""
+        # Files are listed first, the remaining time is estimated from their number
+        files = list(iter_files(self.paths))
+        progress = Progress(total=len(files), interval=self.interval)
+        self.progress.emit(progress.snapshot())
+
+        # Add watermark(s) to all files, optimized pictures are written directly
+        results = apply_watermarks(files, CONF.text, CONF.picture, backend=backend, optimizer=self.optimizer)
+        try:
+            for path_orig, path_new in results:
+                skipped = self.optimizer is not None and path_orig in self.optimizer.skipped
+                progress.add(path_orig, path_new, skipped=skipped)
+                if progress.due():
+                    self.progress.emit(progress.snapshot())
+
+                if self.paused:
+                    # Other stages stop once their queues are full
+                    progress.pause()
+                    self.progress.emit(progress.snapshot())
+                    self._resumed.wait()
+                    progress.resume()
+                if self._cancelled.is_set():
+                    break
+        finally:
+            # Stop processing files, when cancelled
+            results.close()
+
+        self.progress.emit(progress.snapshot())
@@ -0,0 +1,164 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Optional
+
+__all__ = ("MANIFEST_NAME", "Manifest", "file_hash", "params_hash")
+
+# The manifest file name, at the root of processed folders
+MANIFEST_NAME = ".watermark-manifest.db"
+
+
+def file_hash(file: Path, chunk_size: int = 1024 * 1024) -> str:
+    """Compute the SHA-256 of a given *file*."""
+    sha = hashlib.sha256()
+    with file.open("rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def params_hash(params: Dict[str, Any]) -> str:
+    """Compute the hash of given watermark *params*.
+    Files passed as parameters (font, picture) are identified by their path, size and modification time.
+    """
+    values = dict(params)
+    for key in ("font", "picture"):
+        if values.get(key):
+            stat = os.stat(values[key])
+            values[key] = [values[key], stat.st_size, stat.st_mtime_ns]
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class Manifest:
+    """Keep track of processed files into a SQLite database stored at *path*.
+
+    For each source file, the manifest records its size, modification time and hash,
+    the hash of watermark parameters used, and the output file size and hash.
+    Writes are committed every *commit_every* records, and when the manifest is closed.
+    It can be used from several threads, the pipeline backend looks up files from its own thread.
+    """
+
+    def __init__(self, path: Path, commit_every: int = 100) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._lock = Lock()
+
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " source TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime INTEGER NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " params TEXT NOT NULL,"
+            " output TEXT NOT NULL,"
+            " output_size INTEGER NOT NULL,"
+            " output_hash TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    @classmethod
+    def for_folder(cls, folder: Path, **kwargs: Any) -> "Manifest":
+        """Get the manifest of a given *folder*."""
+        return cls(folder / MANIFEST_NAME, **kwargs)
+
+    def __enter__(self) -> "Manifest":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Commit pending records and close the database."""
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def lookup(self, source: Path, params: str) -> Optional[Path]:
+        """Return the output of a given *source* file if it is up-to-date, without opening the source.
+
+        The output is up-to-date when watermark *params* are the same, the source did not change,
+        and the output file still has the recorded size and hash. When only the source
+        modification time changed, its content hash is checked.
+        The output is returned next to the *source*, as it is when the source is processed (see `utils.guess_output()`).
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime, hash, params, output, output_size, output_hash FROM files WHERE source = ?",
+                (str(source.absolute()),),
+            ).fetchone()
+        if not row:
+            return None
+
+        size, mtime, source_hash, old_params, recorded, output_size, output_hash = row
+        if old_params != params:
+            return None
+
+        output = source.with_name(Path(recorded).name)
+        try:
+            stat = source.stat()
+            if output.stat().st_size != output_size:
+                return None
+        except OSError:
+            return None
+
+        if stat.st_size != size:
+            return None
+
+        if stat.st_mtime_ns != mtime:
+            # Touched, but maybe not modified
+            if file_hash(source) != source_hash:
+                return None
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE files SET mtime = ? WHERE source = ?",
+                    (stat.st_mtime_ns, str(source.absolute())),
+                )
+                self._changed()
+
+        # Modified in place, e.g. by an image editor
+        if file_hash(output) != output_hash:
+            return None
+
+        return output
+
+    def record(self, source: Path, params: str, output: Path) -> None:
+        """Record the *output* of a given *source* file, processed with the given watermark *params*."""
+        stat = source.stat()
+        values = (
+            str(source.absolute()),
+            stat.st_size,
+            stat.st_mtime_ns,
+            file_hash(source),
+            params,
+            str(output.absolute()),
+            output.stat().st_size,
+            file_hash(output),
+        )
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values)
+            self._changed()
+
+    def _changed(self) -> None:
+        """Commit pending changes from time to time, called with the lock held."""
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self._conn.commit()
+            self._uncommitted = 0
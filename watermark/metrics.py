@@ -0,0 +1,220 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import json
+import time
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from typing import IO, Any, Callable, Dict, List
+
+__all__ = ("BUCKETS", "METRICS", "Histogram", "Registry", "TimedWriter")
+
+# Upper bounds of latency histograms buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Prefix of exported metrics names
+PREFIX = "watermark"
+
+
+class Histogram:
+    """Latencies distribution in *buckets*, plus their count and sum."""
+
+    def __init__(self, buckets: tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add a *value*."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[int]:
+        """Get the number of values lower than or equal to each bucket bound, then the total."""
+        result = []
+        total = 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class _Timer:
+    """Time a stage, and record it into the *registry*."""
+
+    __slots__ = ("registry", "stage", "start")
+
+    def __init__(self, registry: "Registry", stage: str) -> None:
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.registry.observe(self.stage, time.perf_counter() - self.start)
+
+
+class _NoTimer:
+    """Do nothing, used when metrics are disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoTimer":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+class TimedWriter:
+    """Wrap a file object *fh* opened for writing, and sum the time spent writing into it.
+    The file descriptor is not exposed, so that Pillow encoders write through this object.
+    """
+
+    def __init__(self, fh: IO[bytes]) -> None:
+        self._fh = fh
+        self.elapsed = 0.0
+
+    def write(self, data: bytes) -> int:
+        start = time.perf_counter()
+        try:
+            return self._fh.write(data)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def flush(self) -> None:
+        start = time.perf_counter()
+        try:
+            self._fh.flush()
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def seek(self, *args: Any) -> int:
+        return self._fh.seek(*args)
+
+    def tell(self) -> int:
+        return self._fh.tell()
+
+
+class Registry:
+    """Counters and per-stage latency histograms of a run.
+
+    Nothing is recorded until the registry is *enabled*, timers are then no-op.
+    Metrics can be dumped as JSON or OpenMetrics text.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget all metrics, and restart the clock."""
+        with self._lock:
+            self.counters: Dict[str, float] = {}
+            self.histograms: Dict[str, Histogram] = {}
+            self.started = time.monotonic()
+
+    def inc(self, name: str, value: float = 1) -> None:
+        """Increment the counter *name* by *value*."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """Record the duration of a *stage*."""
+        if not self.enabled:
+            return
+        with self._lock:
+            try:
+                histogram = self.histograms[stage]
+            except KeyError:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, stage: str) -> Any:
+        """Get a context manager timing a *stage*."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, stage)
+
+    def timed(self, stage: str) -> Callable[[Callable], Callable]:
+        """Decorator timing all calls of a function as a *stage*."""
+
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Timer(self, stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def rate(self, name: str) -> float:
+        """Get the increase of the counter *name* per second, since the start of the run."""
+        elapsed = time.monotonic() - self.started
+        return self.counters.get(name, 0) / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get all metrics."""
+        with self._lock:
+            return {
+                "elapsed": time.monotonic() - self.started,
+                "counters": dict(self.counters),
+                "stages": {
+                    stage: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                        "buckets": dict(zip([*map(str, histogram.buckets), "+Inf"], histogram.cumulative())),
+                    }
+                    for stage, histogram in self.histograms.items()
+                },
+            }
+
+    def to_json(self) -> str:
+        """Get all metrics as JSON."""
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_openmetrics(self) -> str:
+        """Get all metrics as OpenMetrics text."""
+        metrics = self.to_dict()
+        lines = []
+        for name, value in sorted(metrics["counters"].items()):
+            lines.append(f"# TYPE {PREFIX}_{name} counter")
+            lines.append(f"{PREFIX}_{name}_total {value}")
+
+        if metrics["stages"]:
+            family = f"{PREFIX}_stage_seconds"
+            lines.append(f"# TYPE {family} histogram")
+            lines.append(f"# UNIT {family} seconds")
+            for stage, values in sorted(metrics["stages"].items()):
+                for bound, count in values["buckets"].items():
+                    lines.append(f'{family}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{family}_count{{stage="{stage}"}} {values["count"]}')
+                lines.append(f'{family}_sum{{stage="{stage}"}} {values["sum"]}')
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics of the current run
+METRICS = Registry()
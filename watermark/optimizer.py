@@ -7,12 +7,56 @@ You can always get the latest version of this module at:
     https://github.com/BoboTiG/watermark-me
 If that URL should fail, try contacting the author.
 """
+import logging
+import math
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Sized
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from pathlib import Path
-from typing import Optional
+from threading import Lock, local
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urljoin
 
+import requests
 import tinify
+from PIL import Image, ImageChops, ImageMath
 
+from .cache import OptimizationCache
+from .conf import OPTIMIZERS, OUTPUT_FORMATS
+from .metrics import METRICS
+from .quota import QuotaUsage, plan_quota
 from .utils import guess_output
+from .watermark import is_supported
+
+__all__ = (
+    "EXTENSIONS",
+    "OPTIMIZERS",
+    "LocalOptimizer",
+    "Optimizer",
+    "TinifyClient",
+    "bisect",
+    "compression_count",
+    "get_optimizer",
+    "optimize",
+    "optimize_all",
+    "validate_key",
+)
+
+# File extensions Tinify can optimize
+EXTENSIONS = ("jpg", "png", "webp")
+
+# Monthly compressions of a free account
+FREE_COMPRESSIONS = 500
+
+# Results of an optimization batch: the source file and the optimized one, if any
+Results = Generator[Tuple[Path, Optional[Path]], None, None]
+
+# Compression counts are shared by all clients, and the GUI
+_COUNT_LOCK = Lock()
 
 
 def validate_key(key: str) -> bool:
@@ -27,28 +71,532 @@ def validate_key(key: str) -> bool:
         return False
 
 
-def optimize(file: Path, retry: int = 3) -> Optional[Path]:
-    """Optimize a given *file* using the Tinify API."""
+def compression_count() -> int:
+    """Get the number of compressions made this month, as last reported by Tinify."""
+    with _COUNT_LOCK:
+        return tinify.compression_count or 0
+
+
+def _update_compression_count(value: Optional[str]) -> None:
+    """Update the number of compressions from a response header.
+    Responses of concurrent requests can be received in any order, the count can only increase.
+    """
+    if not value:
+        return
+    with _COUNT_LOCK:
+        tinify.compression_count = max(int(value), tinify.compression_count or 0)
+
+
+class Optimizer(ABC):
+    """Optimize files, each optimizer handles files with given *extensions*.
+    Optimized files are written next to given ones, with the "-wo" suffix.
+    Results are reused from the *cache*, if any, for contents already optimized with the same settings.
+    Files not optimized on purpose are kept into `skipped`.
+    """
+
+    name = ""
+    extensions: Tuple[str, ...] = ()
+
+    def __init__(self, cache: Optional[OptimizationCache] = None) -> None:
+        self.cache = cache
+        self.skipped: Set[Path] = set()
+
+    def __enter__(self) -> "Optimizer":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release resources."""
+
+    @abstractmethod
+    def compress_file(self, file: Path, data: bytes) -> Optional[bytes]:
+        """Get the optimized content of a given *file*, whose content is *data*, None on failure."""
+
+    def settings(self) -> Dict[str, Any]:
+        """Get settings changing optimization results."""
+        return {"optimizer": self.name}
+
+    def changes(self) -> Dict[str, Any]:
+        """Get, and forget, side effects of optimizations made since the last call.
+        Copies used by worker processes send them to the parent process, see `merge()`.
+        """
+        skipped, self.skipped = self.skipped, set()
+        return {"skipped": skipped}
+
+    def merge(self, changes: Dict[str, Any]) -> None:
+        """Add side effects of optimizations made by a copy of the optimizer, see `changes()`."""
+        self.skipped.update(changes.get("skipped", ()))
+
+    def plan(
+        self, files: Iterable[Any], output_format: str = "", encoder: Optional[Dict[str, Any]] = None
+    ) -> Iterable[Any]:
+        """Plan the optimization of a batch of *files*, before processing them.
+        When an *output_format* is given, files are sources to watermark first, and to encode as *output_format*
+        using *encoder* settings; outputs of previous runs are then ignored.
+        Return files to process, all of them, whether they will be optimized or not.
+        """
+        return files
 
-    # Last retry, all previous attemps failed
-    if retry < 0:
-        return None
+    def optimize(self, file: Path) -> Optional[Path]:
+        """Optimize a given *file*, get the optimized file on success."""
+        # Unsupported format
+        ext = file.suffix[1:].lower()
+        if ext not in self.extensions:
+            return None
 
-    output = guess_output(file, optimized=True)
+        output = guess_output(file, optimized=True, ext=ext)
 
-    # Already processed
-    if output.is_file():
+        # Already processed
+        if output.is_file():
+            return output
+
+        optimized = self.optimize_data(file, file.read_bytes())
+        if optimized is None:
+            return None
+
+        tmp = output.with_name(f"{output.name}.part")
+        tmp.write_bytes(optimized)
+        os.replace(tmp, output)
         return output
 
-    # No enough credits for this month :/
-    # Note: this is for the free account only.
-    if tinify.compression_count > 500:
-        return None
+    def optimize_data(self, file: Path, data: bytes) -> Optional[bytes]:
+        """Get the optimized content *data* of a given *file*, None on failure.
+        The *file* is not read, it may not exist yet.
+        """
+        cache = self.cache
+        key = cache.key(data, self.settings()) if cache is not None else ""
+        optimized = cache.get(key) if cache is not None else None
+        if optimized is not None:
+            METRICS.inc("cache_hits")
+        else:
+            optimized = self.compress_file(file, data)
+            if optimized is None:
+                return None
+            if cache is not None:
+                METRICS.inc("cache_misses")
+                cache.put(key, optimized)
+
+        METRICS.inc("files_optimized")
+        return optimized
+
+    def optimize_all(self, files: Iterable[Path], workers: int = 4) -> Results:
+        """Optimize *files* using *workers* threads, results are yielded in the files order."""
+        files = self.plan(files)
+        if workers <= 1:
+            for file in files:
+                yield file, self.optimize(file)
+            return
+
+        pending: Dict[Any, Path] = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="optimizer") as executor:
+            for file in files:
+                pending[executor.submit(self.optimize, file)] = file
+                if len(pending) >= workers * 2:
+                    future = next(iter(pending))
+                    yield pending.pop(future), future.result()
+            for future, file in pending.items():
+                yield file, future.result()
+
+
+class TinifyClient(Optimizer):
+    """Optimize files using the Tinify API, with the given *key*, or the one set by `validate_key()`.
+
+    Each thread uses its own HTTP session, so connections are kept alive and reused.
+    Server and network errors are retried up to *retries* times, waiting between attempts
+    for an exponential delay, starting at *backoff* seconds and up to *max_backoff*, with jitter;
+    the initial delay defaults to the one of the Tinify client.
+    When Tinify asks to slow down, all threads wait for the given delay before the next request.
+    No file is sent once *limit* compressions were made this month; when there are not enough
+    compressions left for a batch, files with the largest expected savings are sent first (see `plan()`).
+    Compressions made this month are kept into the *usage* file, if any, across sessions.
+    """
+
+    name = "tinify"
+    extensions = EXTENSIONS
+
+    def __init__(
+        self,
+        key: str = "",
+        retries: int = 3,
+        backoff: Optional[float] = None,
+        max_backoff: float = 30.0,
+        limit: int = FREE_COMPRESSIONS,
+        endpoint: str = "",
+        cache: Optional[OptimizationCache] = None,
+        usage: Optional[QuotaUsage] = None,
+    ) -> None:
+        super().__init__(cache)
+        self.key = key or tinify.key or ""
+        self.retries = retries
+        self.backoff = tinify.Client.RETRY_DELAY / 1000 if backoff is None else backoff
+        self.max_backoff = max_backoff
+        self.limit = limit
+        self.endpoint = endpoint or tinify.Client.API_ENDPOINT
+        self.usage = usage
+
+        # Compressions made in previous sessions, and in this one, and files planned to be sent
+        self._used = usage.used(self.key) if usage is not None else 0
+        self._made = 0
+        self._planned: Optional[Set[Path]] = None
+
+        self._local = local()
+        self._sessions: List[requests.Session] = []
+        self._lock = Lock()
+        self._resume_at = 0.0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Copies, used by worker processes, get their own HTTP sessions."""
+        state = dict(vars(self))
+        for attr in ("_local", "_sessions", "_lock"):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        vars(self).update(state)
+        self._local = local()
+        self._sessions = []
+        self._lock = Lock()
+
+    def close(self) -> None:
+        """Close HTTP sessions of all threads, and keep the number of compressions made this month."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+        if self.usage is not None and self.used():
+            self.usage.record(self.key, self.used())
+
+    def changes(self) -> Dict[str, Any]:
+        changes = super().changes()
+        with self._lock:
+            made, self._made = self._made, 0
+            self._used += made
+        changes["compressions"] = made
+        changes["compression_count"] = compression_count()
+        return changes
+
+    def merge(self, changes: Dict[str, Any]) -> None:
+        super().merge(changes)
+        with self._lock:
+            self._made += changes.get("compressions", 0)
+        _update_compression_count(str(changes.get("compression_count") or ""))
+
+    def used(self) -> int:
+        """Get the number of compressions made this month, as reported by Tinify, or as counted."""
+        return max(compression_count(), self._used + self._made)
+
+    def remaining(self) -> int:
+        """Get the number of compressions left this month."""
+        return max(0, self.limit - self.used())
+
+    def plan(
+        self, files: Iterable[Any], output_format: str = "", encoder: Optional[Dict[str, Any]] = None
+    ) -> Iterable[Any]:
+        """Spend remaining compressions on the files with the largest expected savings (see `quota.plan_quota()`),
+        others are skipped. Files are streamed through when there are enough compressions for all of them,
+        they are only listed, and ranked, when there are not.
+        All sources to watermark are candidates when their output can be optimized, see `Optimizer.plan()`.
+        """
+        self._planned = None
+        remaining = self.remaining()
+        if output_format:
+            if not is_supported(output_format):
+                output_format = "jpeg"
+            if OUTPUT_FORMATS[output_format] not in self.extensions:
+                # Nothing to optimize
+                return files
+
+        def is_candidate(file: Any) -> bool:
+            if not isinstance(file, Path):
+                return False
+            if output_format:
+                return not file.stem.endswith(("-w", "-wo"))
+            return file.suffix[1:].lower() in self.extensions and not file.stem.endswith("-wo")
+
+        if isinstance(files, Sized) and len(files) <= remaining:
+            return files
+        if not remaining:
+            self._planned = set()
+            return files
+
+        # Look ahead until there are more candidates than remaining compressions
+        listed: List[Any] = []
+        iterator = iter(files)
+        count = 0
+        for file in iterator:
+            listed.append(file)
+            count += is_candidate(file)
+            if count > remaining:
+                break
+        else:
+            return listed
+
+        listed.extend(iterator)
+        candidates = [file for file in listed if is_candidate(file)]
+        planned = plan_quota(candidates, remaining, output_format=output_format, encoder=encoder)
+        self._planned = set(planned)
+        skipped = len(candidates) - len(planned)
+        logging.info(f"Not enough Tinify compressions left, skipping {skipped} file(s) with the lowest savings")
+        return listed
+
+    @property
+    def session(self) -> requests.Session:
+        """The HTTP session of the current thread."""
+        try:
+            return self._local.session
+        except AttributeError:
+            session = requests.Session()
+            session.auth = ("api", self.key)
+            session.headers["User-Agent"] = tinify.Client.USER_AGENT
+            session.verify = os.path.join(os.path.dirname(tinify.__file__), "data", "cacert.pem")
+            with self._lock:
+                self._sessions.append(session)
+            self._local.session = session
+            return session
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """Send a request, waiting and retrying on rate limiting, server and network errors.
+        Raise tinify.Error when the request cannot succeed.
+        """
+        attempt = 0
+        while True:
+            self._wait()
+            try:
+                response = self.session.request(method, urljoin(self.endpoint, url), **kwargs)
+            except requests.RequestException as exc:
+                error: tinify.Error = tinify.ConnectionError(f"Error while connecting: {exc}", cause=exc)
+                delay = None
+            else:
+                _update_compression_count(response.headers.get("Compression-Count"))
+                if response.ok:
+                    return response
+                error = self._error(response)
+                delay = self._retry_after(response)
+                if not (response.status_code >= 500 or delay is not None):
+                    raise error
+
+            if attempt >= self.retries:
+                raise error
+            METRICS.inc("tinify_retries")
+            if delay is None:
+                # Full jitter
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            else:
+                self._slow_down(delay)
+            logging.info(f"Tinify request failed ({error}), retrying in {delay:.2f} seconds")
+            time.sleep(delay)
+            attempt += 1
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress given image *data*."""
+        response = self.request("POST", "/shrink", data=data)
+        return self.request("GET", response.headers["Location"]).content
+
+    def compress_file(self, file: Path, data: bytes) -> Optional[bytes]:
+        # No enough credits for this month :/
+        if not self.remaining() or (self._planned is not None and file not in self._planned):
+            self.skipped.add(file)
+            METRICS.inc("files_skipped_quota")
+            return None
+
+        try:
+            with METRICS.timer("tinify"):
+                optimized = self.compress(data)
+            with self._lock:
+                self._made += 1
+            return optimized
+        except tinify.Error as exc:
+            METRICS.inc("tinify_errors")
+            logging.warning(f"Cannot optimize {file}: {exc}")
+            return None
+
+    @staticmethod
+    def _error(response: requests.Response) -> tinify.Error:
+        """Convert an error *response* to a Tinify error."""
+        try:
+            details = response.json()
+        except ValueError:
+            details = {"error": "ParseError", "message": "Error while parsing response"}
+        return tinify.Error.create(details.get("message"), details.get("error"), response.status_code)
+
+    @staticmethod
+    def _retry_after(response: requests.Response) -> Optional[float]:
+        """Get the delay before the next request, when rate limited.
+        Without delay, the monthly limit is reached and there is no point retrying.
+        """
+        if response.status_code not in (429, 503):
+            return None
+        try:
+            return max(0.0, float(response.headers["Retry-After"]))
+        except (KeyError, ValueError):
+            return None
+
+    def _slow_down(self, delay: float) -> None:
+        """Make all threads wait for *delay* seconds before sending their next request."""
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+    def _wait(self) -> None:
+        """Wait until requests are allowed again."""
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class LocalOptimizer(Optimizer):
+    """Optimize files without network, by searching the lowest encoder quality that is good enough.
+
+    The search is a bisection between *min_quality* and *max_quality*, done on a proxy of the
+    image, downscaled to fit in a square of *proxy_size*, and the file is then encoded once.
+    The quality is good enough when the error, the root mean square of the luma difference in the
+    worst block of *block* pixels, is lower than *max_error*; or, when *target_size* is set, when
+    the file would be at most that many bytes.
+    The original content is kept when nothing is won.
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        max_error: float = 4.0,
+        target_size: int = 0,
+        min_quality: int = 30,
+        max_quality: int = 95,
+        proxy_size: int = 512,
+        block: int = 16,
+        cache: Optional[OptimizationCache] = None,
+    ) -> None:
+        super().__init__(cache)
+        self.max_error = max_error
+        self.target_size = target_size
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.proxy_size = proxy_size
+        self.block = block
+        self.extensions = tuple(ext for ext, fmt in (("jpg", "jpeg"), ("webp", "webp")) if is_supported(fmt))
+
+    def compress_file(self, file: Path, data: bytes) -> Optional[bytes]:
+        try:
+            with METRICS.timer("local_optimize"):
+                with Image.open(BytesIO(data)) as img:
+                    fmt = img.format
+                    img = img.convert("RGB")
+                proxy = img.copy()
+                proxy.thumbnail((self.proxy_size, self.proxy_size))
+
+                # Encoded sizes are roughly proportional to the number of pixels
+                scale = (img.size[0] * img.size[1]) / (proxy.size[0] * proxy.size[1])
+                quality = self.quality(proxy, fmt, scale)
+                optimized = self.encode(img, fmt, quality)
+
+                if self.target_size:
+                    # Details are denser in the proxy, correct the estimation using the real size
+                    scale = len(optimized) / len(self.encode(proxy, fmt, quality))
+                    corrected = self.quality(proxy, fmt, scale)
+                    if corrected != quality:
+                        quality = corrected
+                        optimized = self.encode(img, fmt, quality)
+                    while len(optimized) > self.target_size and quality > self.min_quality:
+                        quality = max(self.min_quality, quality - 5)
+                        optimized = self.encode(img, fmt, quality)
+        except OSError as exc:
+            logging.warning(f"Cannot optimize {file}: {exc}")
+            return None
+
+        logging.info(f"Optimized {file} using quality {quality}: {len(data):,} -> {len(optimized):,} bytes")
+        return optimized if len(optimized) < len(data) else data
+
+    def quality(self, proxy: Image.Image, fmt: str, scale: float = 1.0) -> int:
+        """Search the lowest good enough quality to encode the *proxy* of an image as *fmt*.
+        When targeting a size, sizes of the encoded proxy are multiplied by *scale*.
+        """
+        if self.target_size:
+            too_big = bisect(
+                self.min_quality,
+                self.max_quality + 1,
+                lambda quality: len(self.encode(proxy, fmt, quality)) * scale > self.target_size,
+            )
+            return max(self.min_quality, too_big - 1)
+
+        luma = proxy.convert("L")
+        return bisect(
+            self.min_quality,
+            self.max_quality,
+            lambda quality: self.error(luma, self.encode(proxy, fmt, quality)) <= self.max_error,
+        )
+
+    def error(self, luma: Image.Image, data: bytes) -> float:
+        """Get the error of the encoded *data*, compared to the original *luma*."""
+        with Image.open(BytesIO(data)) as img:
+            diff = ImageChops.difference(luma, img.convert("L"))
+        squared = ImageMath.eval("float(a) * float(a)", a=diff)
+        size = (math.ceil(diff.size[0] / self.block), math.ceil(diff.size[1] / self.block))
+        worst = squared.resize(size, Image.Resampling.BOX).getextrema()[1]
+        return math.sqrt(worst)
+
+    def settings(self) -> Dict[str, Any]:
+        return {
+            "optimizer": self.name,
+            "formats": self.extensions,
+            "max_error": self.max_error,
+            "target_size": self.target_size,
+            "min_quality": self.min_quality,
+            "max_quality": self.max_quality,
+            "proxy_size": self.proxy_size,
+            "block": self.block,
+            "pillow": Image.__version__,
+        }
+
+    @staticmethod
+    def encode(img: Image.Image, fmt: str, quality: int) -> bytes:
+        """Encode a given *img* as *fmt*, with the given *quality*."""
+        buffer = BytesIO()
+        if fmt == "JPEG":
+            img.save(buffer, fmt, quality=quality, optimize=True)
+        else:
+            img.save(buffer, fmt, quality=quality)
+        return buffer.getvalue()
+
+
+def bisect(low: int, high: int, predicate: Callable[[int], bool]) -> int:
+    """Get the lowest value between *low* and *high* for which the *predicate* is true,
+    assuming it is true for all higher values. *high* is returned, without being tested, if there is none.
+    """
+    while low < high:
+        middle = (low + high) // 2
+        if predicate(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def get_optimizer(name: str = "tinify", **options: Any) -> Optimizer:
+    """Get the optimizer *name*, created with given *options*.
+    The Tinify one uses the key set by `validate_key()`.
+    """
+    if name not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer {name!r}")
+
+    if name == "local":
+        return LocalOptimizer(**options)
+    return TinifyClient(tinify.key or "", **options)
+
+
+def optimize(file: Path, retry: int = 3, usage: Optional[QuotaUsage] = None) -> Optional[Path]:
+    """Optimize a given *file* using the Tinify API, and the key set by `validate_key()`.
+    Failed requests are retried up to *retry* times. Compressions made are kept into the *usage* file, if any.
+    Use a `TinifyClient` to optimize several files over kept alive connections.
+    """
+    with TinifyClient(tinify.key or "", retries=retry, usage=usage) as client:
+        return client.optimize(file)
 
-    try:
-        tinify.from_file(str(file)).to_file(str(output))
-    except (tinify.ServerError, tinify.ConnectionError):
-        # Network issue, retry
-        return optimize(file, retry=retry - 1)
 
-    return output
+def optimize_all(files: Iterable[Path], workers: int = 4, optimizer: str = "tinify", **options: Any) -> Results:
+    """Optimize *files* using the *optimizer*, created with given *options*, and *workers* threads.
+    Results are yielded in the files order.
+    """
+    with get_optimizer(optimizer, **options) as instance:
+        yield from instance.optimize_all(files, workers=workers)
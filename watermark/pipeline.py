@@ -0,0 +1,269 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import logging
+from io import BytesIO
+from pathlib import Path
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple
+
+from .conf import encoder_settings
+from .metrics import METRICS
+from .watermark import (
+    Plan,
+    UpToDate,
+    WatermarkTemplate,
+    encode_image,
+    encoder_options,
+    open_image,
+    plan_outputs,
+    write_file,
+    write_optimized,
+)
+
+if TYPE_CHECKING:
+    from .optimizer import Optimizer  # noqa: F401
+
+__all__ = ("STAGES", "Pipeline")
+
+# Stages of the pipeline, in order, and their default number of threads
+STAGES = {"read": 1, "watermark": 1, "encode": 1, "optimize": 4, "write": 1}
+
+# Seconds between two checks of the pipeline state, while waiting on a queue
+POLL_INTERVAL = 0.1
+
+
+class Job:
+    """A *file* going through the pipeline, at the given *index* of the batch."""
+
+    __slots__ = ("index", "file", "plan", "data", "img", "output", "done")
+
+    def __init__(self, index: int, file: Any) -> None:
+        self.index = index
+        self.file = file
+        self.plan: Optional[Plan] = None
+        self.data = b""
+        self.img: Any = None
+        self.output: Optional[Path] = None
+        self.done = False
+
+
+class Pipeline:
+    """Watermark files through concurrent stages, each one having its own threads:
+
+        - read: read source files;
+        - watermark: decode images, and apply the watermark *template*;
+        - encode: encode watermarked images in memory, using *settings* (see `add_watermark()`);
+        - optimize: optimize encoded images using the *optimizer*, if any;
+        - write: write final files.
+
+    Stages are connected by queues of *queue_size* items per thread of the next stage: a stage
+    faster than the next one waits for it, so that the memory stays flat, and the batch time
+    approaches the time of the slowest stage. *workers* sets the number of threads of stages.
+    """
+
+    def __init__(
+        self,
+        template: WatermarkTemplate,
+        settings: Dict[str, Any],
+        optimizer: Optional["Optimizer"] = None,
+        workers: Optional[Dict[str, int]] = None,
+        queue_size: int = 2,
+    ) -> None:
+        self.template = template
+        self.max_size = settings.get("max_size", 0)
+        self.output_format = settings.get("output_format", "")
+        self.encoder = encoder_settings(**(settings.get("encoder") or {}))
+        self.overwrite = settings.get("overwrite", False)
+        self.optimizer = optimizer
+        self.workers = {**STAGES, **(workers or {})}
+        self.queue_size = queue_size
+        self._stop = Event()
+        self._error: Optional[BaseException] = None
+
+    def run(self, files: Iterable[Any], ordered: bool = True) -> Generator[Tuple[Any, Optional[Path]], None, None]:
+        """Process *files*, results are yielded in the files order when *ordered* is True,
+        else as soon as they are completed.
+        """
+        funcs: Dict[str, Callable[[Job], None]] = {
+            "read": self._read,
+            "watermark": self._watermark,
+            "encode": self._encode,
+            "optimize": self._optimize,
+            "write": self._write,
+        }
+        stages = [name for name in STAGES if name != "optimize" or self.optimizer is not None]
+
+        queues: List[Queue] = [Queue(self.queue_size * self.workers[name]) for name in stages]
+        results: Queue = Queue(self.queue_size)
+        queues.append(results)
+
+        threads = [Thread(target=self._feed, args=(files, queues[0], self.workers[stages[0]]), daemon=True)]
+        for n, name in enumerate(stages):
+            count = self.workers[name]
+            consumers = self.workers[stages[n + 1]] if n + 1 < len(stages) else 1
+            remaining = [count]
+            lock = Lock()
+            for i in range(count):
+                args = (name, funcs[name], queues[n], queues[n + 1], consumers, remaining, lock)
+                threads.append(Thread(target=self._work, args=args, name=f"pipeline-{name}-{i}", daemon=True))
+
+        self._stop.clear()
+        self._error = None
+        for thread in threads:
+            thread.start()
+
+        try:
+            pending: Dict[int, Job] = {}
+            index = 0
+            while True:
+                job = self._get(results)
+                if job is None:
+                    break
+                if not ordered:
+                    yield job.file, job.output
+                    continue
+                pending[job.index] = job
+                while index in pending:
+                    job = pending.pop(index)
+                    index += 1
+                    yield job.file, job.output
+            if self._error is not None:
+                raise self._error
+        finally:
+            # Stop all threads when done, or when the batch is interrupted
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _feed(self, files: Iterable[Any], queue: Queue, consumers: int) -> None:
+        """Send *files* to the first stage."""
+        try:
+            for index, file in enumerate(files):
+                job = Job(index, file)
+                if isinstance(file, UpToDate):
+                    job.output = file.output
+                    job.done = True
+                if not self._put(queue, job):
+                    return
+        except Exception as exc:
+            self._error = exc
+        for _ in range(consumers):
+            self._put(queue, None)
+
+    def _work(
+        self,
+        name: str,
+        func: Callable[[Job], None],
+        inbox: Queue,
+        outbox: Queue,
+        consumers: int,
+        remaining: List[int],
+        lock: Lock,
+    ) -> None:
+        """Run a stage *func* on jobs from the *inbox*, and send them to the *outbox*.
+        The last thread of the stage to finish tells the *consumers* of the next stage there is nothing left.
+        """
+        while True:
+            job = self._get(inbox)
+            if job is None:
+                break
+            if not job.done:
+                try:
+                    func(job)
+                except Exception:
+                    logging.exception(f"Error while processing {job.file} ({name})")
+                    job.output = None
+                    job.done = True
+                if job.done:
+                    job.data, job.img = b"", None
+            if not self._put(outbox, job):
+                return
+
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for _ in range(consumers):
+            self._put(outbox, None)
+
+    def _get(self, queue: Queue) -> Any:
+        """Get the next item of a *queue*, None when the pipeline is stopped."""
+        while not self._stop.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                continue
+        return None
+
+    def _put(self, queue: Queue, item: Any) -> bool:
+        """Put an *item* into a *queue*, waiting for room. Return False when the pipeline is stopped."""
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _read(self, job: Job) -> None:
+        job.plan = plan = plan_outputs(job.file, self.output_format, self.optimizer, self.overwrite)
+        if plan.done is not None:
+            job.output = plan.done
+            job.done = True
+            return
+        with METRICS.timer("read"):
+            # The watermarked output of a previous run is only left to optimize
+            job.data = (plan.previous or job.file).read_bytes()
+
+    def _watermark(self, job: Job) -> None:
+        assert job.plan is not None
+        if job.plan.previous is not None:
+            return
+        try:
+            img = open_image(BytesIO(job.data), max_size=self.max_size, threads=self.template.threads)
+        except OSError:
+            logging.warning(f"Skipping unprocessable {job.file}")
+            job.done = True
+            return
+        job.data = b""
+        logging.info(f"Applying {len(self.template.layers)} watermark layer(s) on {job.file}")
+        job.img = self.template.apply(img)
+
+    def _encode(self, job: Job) -> None:
+        assert job.plan is not None
+        if job.plan.previous is not None:
+            return
+        fmt, options = encoder_options(job.img, job.plan.output_format, self.encoder)
+        job.data = encode_image(job.img, fmt, options)
+        job.img = None
+        job.output = job.plan.output
+
+    def _optimize(self, job: Job) -> None:
+        assert job.plan is not None and self.optimizer is not None
+        if job.plan.optimized is None:
+            return
+        result = self.optimizer.optimize_data(job.file, job.data)
+        if result is not None:
+            job.data, job.output = result, job.plan.optimized
+        elif job.plan.previous is not None:
+            # Nothing new to write
+            job.output = job.plan.previous
+            job.done = True
+        else:
+            logging.warning(f"Cannot optimize {job.file}, keeping the watermarked picture")
+
+    def _write(self, job: Job) -> None:
+        assert job.plan is not None and job.output is not None
+        if job.output == job.plan.optimized:
+            write_optimized(job.plan, job.data)
+        else:
+            write_file(job.output, job.data)
+        job.data = b""
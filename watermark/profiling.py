@@ -0,0 +1,206 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import heapq
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+from .conf import CONF
+
+__all__ = ("ENV_VAR", "Profiler", "checkpoint", "collapsed_stacks", "profile_folder", "track")
+
+# Environment variable enabling the profiling, its value is the folder where to save reports
+ENV_VAR = "WATERMARK_PROFILE"
+
+# Number of call sites reported for each image
+TOP_CALL_SITES = 10
+
+# The running profiler, if any
+_PROFILER: Optional["Profiler"] = None
+
+
+def profile_folder(folder: str = "") -> Optional[Path]:
+    """Get the folder where to save profiling reports, if the profiling is enabled.
+    The given *folder* comes first, then the environment variable, then the "profile_dir" option.
+    """
+    folder = folder or os.getenv(ENV_VAR, "") or CONF.profile_dir
+    return Path(folder).expanduser() if folder else None
+
+
+class Profiler:
+    """Profile a batch, and save reports into *folder* when done.
+
+    Reports are:
+        - a cProfile file (*.pstats), to be read with the pstats module, snakeviz, etc.;
+        - collapsed stacks (*.collapsed), to be read with flamegraph.pl, speedscope, etc.;
+        - allocations peaks by call site of the *slowest* images (*.memory.txt), traced using tracemalloc.
+
+    Only the current thread is profiled.
+    """
+
+    def __init__(self, folder: Path, slowest: int = 5, frames: int = 16) -> None:
+        # Profilers are only imported when needed
+        import cProfile
+        import tracemalloc
+
+        self.folder = folder
+        self.slowest = slowest
+        self.frames = frames
+        self.profile = cProfile.Profile()
+        self.reports: Dict[str, Path] = {}
+
+        # Slowest images: (duration, order, file, peak, top call sites)
+        self._images: List[Tuple[float, int, str, int, List[str]]] = []
+        self._snapshot: Any = None
+        self._snapshot_size = 0
+        self._started_tracing = False
+        self._tracemalloc: Any = tracemalloc
+
+    def __enter__(self) -> "Profiler":
+        global _PROFILER
+        tracemalloc = self._tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        _PROFILER = self
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        global _PROFILER
+        self.profile.disable()
+        _PROFILER = None
+        if self._started_tracing:
+            self._tracemalloc.stop()
+        self.save()
+
+    @contextmanager
+    def image(self, file: Path) -> Generator[None, None, None]:
+        """Measure the processing of one image."""
+        tracemalloc = self._tracemalloc
+        self._snapshot = None
+        self._snapshot_size = 0
+        tracemalloc.clear_traces()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.checkpoint()
+            _, peak = tracemalloc.get_traced_memory()
+            self._keep(duration, str(file), peak)
+
+    def checkpoint(self) -> None:
+        """Keep allocations of the current image, if there are more than at the previous checkpoint."""
+        current, _ = self._tracemalloc.get_traced_memory()
+        if current > self._snapshot_size:
+            self._snapshot = self._tracemalloc.take_snapshot()
+            self._snapshot_size = current
+
+    def _keep(self, duration: float, file: str, peak: int) -> None:
+        """Keep allocations of the image if it is one of the slowest."""
+        if not self.slowest:
+            return
+
+        item: Tuple[float, int, str, int, List[str]] = (duration, len(self._images), file, peak, [])
+        if len(self._images) >= self.slowest:
+            if duration <= self._images[0][0]:
+                return
+            heapq.heappop(self._images)
+
+        if self._snapshot is not None:
+            stats = self._snapshot.statistics("lineno")[:TOP_CALL_SITES]
+            item[4].extend(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {stat.traceback}" for stat in stats)
+        heapq.heappush(self._images, item)
+
+    def save(self) -> None:
+        """Save reports."""
+        import pstats
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        prefix = self.folder / f"watermark-{datetime.now():%Y%m%d-%H%M%S}"
+
+        self.reports["pstats"] = prefix.with_suffix(".pstats")
+        self.profile.dump_stats(str(self.reports["pstats"]))
+
+        self.reports["collapsed"] = prefix.with_suffix(".collapsed")
+        stats = pstats.Stats(self.profile)
+        lines = (f"{stack} {weight}" for stack, weight in sorted(collapsed_stacks(stats).items()))
+        self.reports["collapsed"].write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+        self.reports["memory"] = prefix.with_suffix(".memory.txt")
+        report = []
+        for duration, _, file, peak, sites in sorted(self._images, reverse=True):
+            report.append(f"{file}: {duration:.3f} s, allocations peak {peak / 1024:.1f} KiB")
+            report.extend(f"    {site}" for site in sites)
+        self.reports["memory"].write_text("\n".join(report) + "\n", encoding="utf-8")
+
+
+def collapsed_stacks(stats: Any, min_weight: int = 1) -> Dict[str, int]:
+    """Convert profile *stats* to collapsed stacks, weighted in microseconds.
+
+    cProfile only records callers of each function, not whole stacks: the time of a function
+    called from several places is split between them pro rata of the time spent from each caller.
+    Recursive calls are cut, and stacks lighter than *min_weight* are dropped.
+    """
+    entries = stats.stats
+    children: Dict[Any, Dict[Any, float]] = defaultdict(dict)
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, values in callers.items():
+            children[caller][func] = values[3]
+
+    def label(func: Tuple[str, int, str]) -> str:
+        filename, line, name = func
+        if filename == "~":
+            # Built-in
+            return name
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    result: Dict[str, int] = defaultdict(int)
+
+    def walk(func: Any, stack: List[str], seen: set, share: float) -> None:
+        _, _, own, cumulative, _ = entries[func]
+        stack = stack + [label(func)]
+        weight = int(own * share * 1_000_000)
+        if weight >= min_weight:
+            result[";".join(stack)] += weight
+
+        for child, edge in children.get(func, {}).items():
+            child_cumulative = entries[child][3]
+            if child in seen or not child_cumulative:
+                continue
+            child_share = share * edge / child_cumulative
+            if child_cumulative * child_share * 1_000_000 >= min_weight:
+                walk(child, stack, seen | {child}, child_share)
+
+    for func, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(func, [], {func}, 1.0)
+    return dict(result)
+
+
+@contextmanager
+def track(file: Path) -> Generator[None, None, None]:
+    """Measure the processing of one *file*, when profiling."""
+    if _PROFILER is None:
+        yield
+    else:
+        with _PROFILER.image(file):
+            yield
+
+
+def checkpoint() -> None:
+    """Keep the allocations of the current image, when profiling and if there are more than before."""
+    if _PROFILER is not None:
+        _PROFILER.checkpoint()
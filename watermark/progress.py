@@ -0,0 +1,97 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+__all__ = ("Progress",)
+
+
+class Progress:
+    """Progress of a batch of *total* files, and its statistics.
+
+    Updates are due at most every *interval* seconds, so that a GUI is not flooded with them.
+    The remaining time is estimated from the measured throughput, pauses are not counted.
+    """
+
+    def __init__(self, total: int = 0, interval: float = 0.25) -> None:
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.count = 0
+        self.size_before = 0
+        self.size_after = 0
+        self.skipped = 0
+
+        self._start = time.monotonic()
+        self._paused = 0.0
+        self._paused_at: Optional[float] = None
+        self._reported_at = float("-inf")
+
+    def add(self, source: Path, output: Optional[Path], skipped: bool = False) -> None:
+        """Count a *source* file, and its *output* if it was processed.
+        *skipped* tells the output was not optimized on purpose.
+        """
+        self.done += 1
+        if not output:
+            return
+        self.count += 1
+        self.size_before += source.stat().st_size
+        self.size_after += output.stat().st_size
+        if skipped:
+            self.skipped += 1
+
+    def pause(self) -> None:
+        """Stop the clock, until `resume()` is called."""
+        if self._paused_at is None:
+            self._paused_at = time.monotonic()
+
+    def resume(self) -> None:
+        """Restart the clock."""
+        if self._paused_at is not None:
+            self._paused += time.monotonic() - self._paused_at
+            self._paused_at = None
+
+    def elapsed(self) -> float:
+        """Get the processing time so far, without pauses."""
+        now = time.monotonic()
+        paused = self._paused
+        if self._paused_at is not None:
+            paused += now - self._paused_at
+        return now - self._start - paused
+
+    def eta(self) -> Optional[float]:
+        """Get the estimated remaining time, in seconds, None when it is not known yet."""
+        elapsed = self.elapsed()
+        if not self.done or not self.total or elapsed <= 0:
+            return None
+        return max(0, self.total - self.done) * elapsed / self.done
+
+    def due(self) -> bool:
+        """Check whether an update is due, it is then considered sent.
+        The last one is always due.
+        """
+        now = time.monotonic()
+        if now - self._reported_at < self.interval and self.done < self.total:
+            return False
+        self._reported_at = now
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Get the progress, and statistics, of the batch."""
+        return {
+            "done": self.done,
+            "total": self.total,
+            "count": self.count,
+            "size_before": self.size_before,
+            "size_after": self.size_after,
+            "skipped": self.skipped,
+            "eta": self.eta(),
+        }
@@ -0,0 +1,166 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os.path import expandvars
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from PIL import Image
+
+from .conf import encoder_settings
+from .constants import CONF_DIR
+from .metrics import METRICS
+from .watermark import encoder_options
+
+__all__ = ("USAGE_FILE", "QuotaUsage", "estimate_savings", "plan_quota")
+
+# The default file where monthly compressions are kept
+USAGE_FILE = f"{CONF_DIR}/tinify-usage.json"
+
+# Savings are estimated on a proxy of pictures, downscaled to fit in a square of that size
+PROXY_SIZE = 256
+
+# Tinify JPEG and WebP outputs are roughly encoded with that quality
+ESTIMATE_QUALITY = 75
+
+# Usage files are shared by all clients
+_LOCK = Lock()
+
+
+class QuotaUsage:
+    """Compressions made this month, by API key, kept into *file* across sessions.
+
+    Tinify reports the count in its responses only: the kept one tells how many compressions
+    are left before the first request of a session, and even when Tinify cannot be reached.
+    Keys are not stored, only a hash of them.
+    """
+
+    def __init__(self, file: Path = Path(USAGE_FILE)) -> None:
+        self.file = Path(expandvars(str(file))).expanduser()
+
+    @staticmethod
+    def month() -> str:
+        """Get the current month, counts are reset every month."""
+        return time.strftime("%Y-%m", time.gmtime())
+
+    def used(self, key: str) -> int:
+        """Get the number of compressions made this month using a given *key*."""
+        with _LOCK:
+            return self._count(self._read(), key)
+
+    def record(self, key: str, count: int) -> None:
+        """Record the number of compressions made this month using a given *key*.
+        Other clients may have recorded more since, the count can only increase.
+        """
+        with _LOCK:
+            usage = self._read()
+            count = max(count, self._count(usage, key))
+            usage[self._id(key)] = {"month": self.month(), "count": count}
+
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.file.with_name(f"{self.file.name}.{os.getpid()}.part")
+            tmp.write_text(json.dumps(usage, indent=2, sort_keys=True), encoding="utf-8")
+            os.replace(tmp, self.file)
+
+    @staticmethod
+    def _id(key: str) -> str:
+        """Get the identifier of a given *key*."""
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    def _count(self, usage: Dict[str, Any], key: str) -> int:
+        """Get the count of a given *key* this month, from the *usage* file content."""
+        entry = usage.get(self._id(key))
+        if not isinstance(entry, dict) or entry.get("month") != self.month():
+            return 0
+        try:
+            return max(0, int(entry.get("count", 0)))
+        except (TypeError, ValueError):
+            return 0
+
+    def _read(self) -> Dict[str, Any]:
+        """Read the usage file, a missing or broken one is empty."""
+        try:
+            usage = json.loads(self.file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return {}
+        return usage if isinstance(usage, dict) else {}
+
+
+def estimate_savings(file: Path, output_format: str = "", encoder: Optional[Dict[str, Any]] = None) -> int:
+    """Estimate the number of bytes optimizing a given *file* would save, without network.
+
+    A proxy of the picture is re-encoded like Tinify would: quantized to 256 colors for PNG,
+    with a lower quality otherwise. Encoded sizes are roughly proportional to the number of
+    pixels, and JPEG proxies are decoded at a reduced scale, so that the estimation is cheap.
+
+    When an *output_format* is given, the *file* is a source to watermark first: Tinify receives
+    its output, estimated by encoding the proxy as *output_format* using *encoder* settings.
+    """
+    with Image.open(file) as img:
+        fmt = img.format
+        pixels = img.size[0] * img.size[1]
+        img.thumbnail((PROXY_SIZE, PROXY_SIZE), Image.Resampling.BOX)
+        proxy_pixels = img.size[0] * img.size[1]
+
+        if output_format:
+            proxy = img.convert("RGB")
+            fmt, options = encoder_options(proxy, output_format, encoder_settings(**(encoder or {})))
+            output = BytesIO()
+            proxy.save(output, fmt, **options)
+            size = len(output.getvalue()) * pixels / proxy_pixels
+        else:
+            proxy = img
+            size = file.stat().st_size
+
+        buffer = BytesIO()
+        if fmt == "PNG":
+            proxy = proxy.convert("RGBA").quantize(256, method=Image.Quantize.FASTOCTREE)
+            proxy.save(buffer, "PNG", optimize=True)
+        else:
+            proxy.convert("RGB").save(buffer, "WEBP" if fmt == "WEBP" else "JPEG", quality=ESTIMATE_QUALITY)
+
+    return int(size - len(buffer.getvalue()) * pixels / proxy_pixels)
+
+
+def plan_quota(
+    files: List[Path],
+    remaining: int,
+    workers: int = 4,
+    output_format: str = "",
+    encoder: Optional[Dict[str, Any]] = None,
+) -> List[Path]:
+    """Choose the *files* to optimize using the *remaining* compressions, the ones with the largest
+    expected savings first. Savings are estimated using *workers* threads, and only when there are
+    not enough compressions for all files. *files* are sources to watermark first when an *output_format*
+    is given (see `estimate_savings()`).
+    """
+    if len(files) <= remaining:
+        return list(files)
+    if remaining <= 0:
+        return []
+
+    # Settings are read once, not by each thread
+    settings = encoder_settings(**(encoder or {}))
+
+    def savings(file: Path) -> int:
+        try:
+            return estimate_savings(file, output_format=output_format, encoder=settings)
+        except OSError:
+            return 0
+
+    with METRICS.timer("quota_plan"), ThreadPoolExecutor(max_workers=workers) as executor:
+        estimations = dict(zip(files, executor.map(savings, files)))
+    return sorted(files, key=estimations.__getitem__, reverse=True)[:remaining]
@@ -0,0 +1,186 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import base64
+import json
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import tinify
+
+__all__ = ("TinifyServer",)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # Set by TinifyServer
+    stand_in: "TinifyServer"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: _Server
+
+    # Keep connections alive
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *_: Any) -> None:
+        """Be quiet."""
+
+    def do_POST(self) -> None:  # noqa: N802
+        stand_in = self.server.stand_in
+        length = int(self.headers.get("Content-Length") or 0)
+        data = self.rfile.read(length)
+
+        error = stand_in.check(self.headers.get("Authorization", ""), self.client_address)
+        if error:
+            status, kind, message = error
+            headers = {}
+            if status == 429 and stand_in.retry_after is not None:
+                headers["Retry-After"] = str(stand_in.retry_after)
+            self._json(status, kind, message, headers=headers)
+        elif self.path != "/shrink":
+            self._json(404, "NotFound", "Unknown endpoint")
+        elif not data:
+            self._json(400, "InputMissing", "Input file is empty")
+        else:
+            location = stand_in.shrink(data)
+            self._json(201, headers={"Location": location}, body={"input": {"size": len(data)}})
+
+    def do_GET(self) -> None:  # noqa: N802
+        data = self.server.stand_in.outputs.get(self.path)
+        if data is None:
+            self._json(404, "NotFound", "Unknown output")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Compression-Count", str(self.server.stand_in.compression_count))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _json(
+        self,
+        status: int,
+        error: str = "",
+        message: str = "",
+        headers: Optional[Dict[str, str]] = None,
+        body: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        content = json.dumps(body or {"error": error, "message": message}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Compression-Count", str(self.server.stand_in.compression_count))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class TinifyServer:
+    """A local stand-in for the Tinify API, for tests and benchmarks.
+
+    Only the *key* is accepted. Each request waits for *latency* seconds, and images
+    are "compressed" using the *compress* function, they are returned as-is by default.
+    Statuses in *errors* are sent back, in order, instead of handling next requests;
+    429 errors come with a Retry-After header when *retry_after* is set.
+
+    Used as a context manager, the Tinify client is set up to use it.
+    """
+
+    def __init__(
+        self,
+        key: str = "stand-in",
+        latency: float = 0.0,
+        compress: Callable[[bytes], bytes] = bytes,
+        errors: Optional[List[int]] = None,
+        retry_after: Optional[float] = None,
+    ) -> None:
+        self.key = key
+        self.latency = latency
+        self.compress = compress
+        self.errors = list(errors or [])
+        self.retry_after = retry_after
+        self.compression_count = 0
+        self.outputs: Dict[str, bytes] = {}
+        self.requests = 0
+        self.clients: Set[Tuple[str, int]] = set()
+        self.max_concurrency = 0
+        self._concurrency = 0
+        self._lock = Lock()
+        self._patched: Dict[str, Any] = {}
+
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.stand_in = self
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        """The server URL."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "TinifyServer":
+        self._thread.start()
+        self._patched = {
+            "endpoint": tinify.Client.API_ENDPOINT,
+            "delay": tinify.Client.RETRY_DELAY,
+            "key": tinify.key,
+            "count": tinify.compression_count,
+        }
+        tinify.Client.API_ENDPOINT = self.endpoint
+        tinify.Client.RETRY_DELAY = 0
+        tinify.key = self.key
+        tinify.compression_count = 0
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        tinify.Client.API_ENDPOINT = self._patched["endpoint"]
+        tinify.Client.RETRY_DELAY = self._patched["delay"]
+        tinify.key = self._patched["key"]
+        tinify.compression_count = self._patched["count"]
+
+    def check(self, authorization: str, client: Tuple[str, int]) -> Optional[tuple]:
+        """Check a request: get the error to send back, if any."""
+        with self._lock:
+            self.requests += 1
+            self.clients.add(client)
+            self._concurrency += 1
+            self.max_concurrency = max(self.max_concurrency, self._concurrency)
+            status = self.errors.pop(0) if self.errors else 0
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self._concurrency -= 1
+
+        if status:
+            return status, "Mocked", f"Mock'ed error {status}"
+
+        expected = "Basic " + base64.b64encode(f"api:{self.key}".encode("utf-8")).decode("utf-8")
+        if authorization != expected:
+            return 401, "Unauthorized", "Credentials are invalid"
+        return None
+
+    def shrink(self, data: bytes) -> str:
+        """Compress an image, and get the location of the result."""
+        output = self.compress(data)
+        with self._lock:
+            self.compression_count += 1
+            location = f"/output/{self.compression_count}"
+            self.outputs[location] = output
+        return location
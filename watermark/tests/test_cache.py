@@ -0,0 +1,75 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import shutil
+import time
+
+from watermark.cache import OptimizationCache, get_cache
+from watermark.optimizer import TinifyClient
+from watermark.testing import TinifyServer
+from watermark.watermark import add_watermark
+
+
+def test_key():
+    key = OptimizationCache.key(b"data", {"optimizer": "tinify"})
+    assert key == OptimizationCache.key(b"data", {"optimizer": "tinify"})
+    assert key != OptimizationCache.key(b"data", {"optimizer": "local"})
+    assert key != OptimizationCache.key(b"other data", {"optimizer": "tinify"})
+
+
+def test_get_put(tmp_path):
+    cache = OptimizationCache(tmp_path)
+    assert cache.get("0" * 64) is None
+
+    cache.put("0" * 64, b"optimized")
+    assert cache.get("0" * 64) == b"optimized"
+
+    # Results are kept across runs
+    cache = OptimizationCache(tmp_path)
+    assert len(cache) == 1
+    assert cache.size == len(b"optimized")
+    assert cache.get("0" * 64) == b"optimized"
+
+
+def test_eviction(tmp_path):
+    cache = OptimizationCache(tmp_path, max_size=250)
+    for n in range(3):
+        cache.put(str(n) * 64, b"x" * 100)
+        time.sleep(0.01)
+    assert len(cache) == 2
+    assert cache.get("0" * 64) is None
+
+    # The least recently used is evicted
+    time.sleep(0.01)
+    assert cache.get("1" * 64)
+    cache.put("3" * 64, b"x" * 100)
+    assert cache.get("1" * 64)
+    assert cache.get("2" * 64) is None
+    assert cache.size == 200
+    assert len(list(tmp_path.glob("*/*"))) == 2
+
+
+def test_get_cache(tmp_path):
+    assert get_cache(str(tmp_path), 0) is None
+    assert get_cache(str(tmp_path), 1).max_size == 1024 * 1024
+
+
+def test_optimize_cached(tmp_path, png):
+    """Identical contents are optimized once."""
+    watermarked = add_watermark(png(tmp_path / "picture.png"), text="confidential")
+    copy = tmp_path / "copy" / watermarked.name
+    copy.parent.mkdir()
+    shutil.copyfile(watermarked, copy)
+
+    cache = OptimizationCache(tmp_path / "cache")
+    with TinifyServer(compress=lambda data: data[:-1]) as server, TinifyClient(cache=cache) as client:
+        results = dict(client.optimize_all([watermarked, copy], workers=1))
+        assert server.compression_count == 1
+
+    assert results[copy].read_bytes() == results[watermarked].read_bytes() == watermarked.read_bytes()[:-1]
@@ -0,0 +1,182 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import subprocess
+import sys
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+from watermark.cli import main
+from watermark.conf import CONF
+from watermark.testing import TinifyServer
+from watermark.utils import guess_output
+
+
+@pytest.fixture(autouse=True)
+def keep_conf():
+    """The CLI updates the configuration, restore it after each test."""
+    saved = dict(vars(CONF.load()))
+    yield
+    vars(CONF).clear()
+    vars(CONF).update(saved)
+
+
+def test_batch(tmp_path, png, picture, capsys):
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(3)]
+
+    assert main([str(tmp_path), "--text", "© Tiger-222", "--picture", picture, "--format", "png", "-j", "2"]) == 0
+
+    out = capsys.readouterr().out
+    for file in files:
+        output = guess_output(file, ext="png")
+        assert output.is_file()
+        assert f"{file} -> {output}" in out
+
+
+def test_batch_rerun(tmp_path, png, capsys):
+    """Outputs of previous runs are not watermarked, nor listed."""
+    file = png(tmp_path / "picture.png")
+    output = guess_output(file)
+
+    assert main([str(tmp_path), "--text", "foo"]) == 0
+    assert main([str(tmp_path), str(output), "--text", "foo"]) == 0
+
+    out = capsys.readouterr().out
+    assert out.count(f"OK   {file} -> {output}") == 2
+    assert f"{output} -> " not in out
+    assert not guess_output(output, optimized=True).exists()
+
+
+def test_batch_failure(tmp_path, png, capsys):
+    good = png(tmp_path / "good.png")
+    bad = tmp_path / "bad.jpg"
+    bad.write_bytes(b"not an image")
+
+    assert main([str(good), str(bad), "--text", "foo", "--quiet"]) == 1
+
+    out, err = capsys.readouterr()
+    assert not out
+    assert f"FAIL {bad}" in err
+    assert guess_output(good).is_file()
+
+
+def test_batch_manifest(tmp_path, png, capsys):
+    png(tmp_path / "picture.png")
+    args = [str(tmp_path), "--text", "foo", "--manifest", str(tmp_path / "manifest.db")]
+
+    assert main(args) == 0
+    output = guess_output(tmp_path / "picture.png")
+    mtime = output.stat().st_mtime_ns
+
+    assert main(args) == 0
+    assert output.stat().st_mtime_ns == mtime
+
+
+def test_batch_optimize(tmp_path, png, capsys):
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(3)]
+
+    with TinifyServer() as server:
+        args = [str(tmp_path), "--text", "foo", "--optimize", "--tinify-key", server.key, "--optimize-workers", "2"]
+        args += ["--cache-dir", str(tmp_path / "cache"), "--tinify-usage", str(tmp_path / "usage.json")]
+        assert main(args) == 0
+
+    out = capsys.readouterr().out
+    for file in files:
+        optimized = guess_output(guess_output(file), optimized=True)
+        assert optimized.is_file()
+        assert not guess_output(file).is_file()
+        assert f"{file} -> {optimized}" in out
+
+
+@pytest.mark.parametrize(
+    "args, workers",
+    [
+        ([], 1),
+        (["-j", "3"], 3),
+        (["--optimize"], 4),
+        (["--optimize", "--optimize-workers", "6"], 6),
+        (["--optimize", "-j", "2"], 2),
+    ],
+)
+def test_batch_workers(tmp_path, png, args, workers):
+    """An explicit -j is respected, even when optimizing."""
+    file = png(tmp_path / "picture.png")
+    args = [str(file), "--text", "foo", "--optimizer", "local", "--cache-size", "0"] + args
+
+    with patch("watermark.cli.apply_watermarks", return_value=iter([])) as apply:
+        assert main(args) == 0
+    assert apply.call_args[1]["workers"] == workers
+
+
+def test_batch_optimize_local(tmp_path, png):
+    file = png(tmp_path / "picture.png")
+    Image.linear_gradient("L").resize((800, 600)).save(file)
+
+    args = [str(file), "--text", "foo", "--quality", "95"]
+    assert main(args) == 0
+    watermarked = guess_output(file)
+    size = watermarked.stat().st_size
+
+    assert main(args + ["--optimize", "--optimizer", "local", "--cache-size", "0"]) == 0
+    assert guess_output(watermarked, optimized=True).stat().st_size < size
+    assert not watermarked.is_file()
+
+
+def test_batch_options(tmp_path, png):
+    file = png(tmp_path / "picture.png")
+    Image.new("RGB", (800, 600), "#336699").save(file)
+
+    assert main([str(file), "--text", "foo", "--pattern", "--max-size", "400", "--quality", "keep"]) == 0
+    with Image.open(guess_output(file)) as img:
+        assert img.size == (400, 300)
+    assert CONF.pattern
+
+
+def test_batch_nothing_to_do(tmp_path, capsys):
+    assert main([str(tmp_path), "--text", "", "--picture", ""]) == 2
+
+
+@pytest.mark.parametrize("arg", ["--quality=0", "--quality=best", "--format=gif"])
+def test_batch_bad_arguments(tmp_path, arg):
+    with pytest.raises(SystemExit) as exc:
+        main([str(tmp_path), "--text", "foo", arg])
+    assert exc.value.code == 2
+
+
+@pytest.mark.parametrize("content", [None, b"not an image"])
+def test_batch_bad_picture(tmp_path, png, capsys, content):
+    picture = tmp_path / "logo.png"
+    if content is not None:
+        picture.write_bytes(content)
+    file = png(tmp_path / "picture.png")
+
+    with pytest.raises(SystemExit) as exc:
+        main([str(file), "--picture", str(picture)])
+    assert exc.value.code == 2
+    assert "invalid watermark picture" in capsys.readouterr().err
+    assert not guess_output(file).exists()
+
+
+def test_batch_without_qt(tmp_path, png):
+    """The batch subcommand must not import Qt."""
+    file = png(tmp_path / "picture.png")
+    code = "\n".join(
+        [
+            "import runpy, sys",
+            f"sys.argv = ['watermark', 'batch', {str(file)!r}, '--text', 'foo']",
+            "try:",
+            "    runpy.run_module('watermark', run_name='__main__')",
+            "except SystemExit as exc:",
+            "    assert exc.code == 0",
+            "assert not any(name.startswith(('PyQt5', 'tendo', 'tinify')) for name in sys.modules)",
+        ]
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+    assert guess_output(file).is_file()
@@ -7,10 +7,13 @@ You can always get the latest version of this module at:
     https://github.com/BoboTiG/watermark-me
 If that URL should fail, try contacting the author.
 """
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isfile
 from types import SimpleNamespace
+from unittest.mock import patch
 
-from watermark.conf import read_config, save_config
+from watermark.conf import Config, read_config, save_config
 
 
 def test_read_file_ok(location):
@@ -40,5 +43,36 @@ def test_read_bad_text_color(location):
     assert config.text_color == "#ffffff"
 
 
+def test_read_bad_encoder_settings(tmp_path):
+    (tmp_path / "config.yml").write_text("output_format: gif\nquality: 101\n")
+    config = read_config(tmp_path)
+    assert config.output_format == "jpeg"
+    assert config.quality == 75
+
+
+def test_read_bad_optimizer(tmp_path):
+    (tmp_path / "config.yml").write_text("optimizer: zopfli\n")
+    config = read_config(tmp_path)
+    assert config.optimizer == "tinify"
+
+
+def test_read_quality_keep(tmp_path):
+    (tmp_path / "config.yml").write_text("output_format: webp\nquality: keep\n")
+    config = read_config(tmp_path)
+    assert config.output_format == "webp"
+    assert config.quality == "keep"
+
+
 def test_save(tmp_path):
     save_config(tmp_path / "conf_saved")
+
+
+def test_config_threads(tmp_path):
+    """Options are available to all threads, while the first one reads the configuration."""
+    def slow_read_config(folder):
+        time.sleep(0.05)
+        return read_config(folder)
+
+    conf = Config(str(tmp_path))
+    with patch("watermark.conf.read_config", new=slow_read_config), ThreadPoolExecutor(max_workers=8) as executor:
+        assert set(executor.map(lambda _: conf.quality, range(64))) == {75}
@@ -0,0 +1,89 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+# Modules that must not be imported with library modules, they are imported where needed:
+# wall-clock budgets are too flaky, the import time is kept low by checking what gets imported
+LAZY_IMPORTS = {
+    "watermark.watermark": (
+        "concurrent.futures",
+        "sqlite3",
+        "watermark.manifest",
+        "watermark.metrics",
+        "watermark.optimizer",
+        "watermark.pipeline",
+        "watermark.profiling",
+        "watermark.tiles",
+    ),
+    "watermark.cli": ("concurrent.futures", "sqlite3", "watermark.manifest", "watermark.optimizer", "watermark.tiles"),
+}
+
+# Modules only imported when needed
+LAZY_MODULES = ("tinify", "requests", "yaml", "PyQt5", "concurrent.futures.process")
+
+CHECK = """
+import sys
+from watermark.conf import CONF
+from watermark.translator import TR
+
+assert not vars(CONF), "the configuration must not be read on import"
+assert "_labels" not in vars(TR), "translations must not be loaded on import"
+lazy = [name for name in sys.argv[1:] if name in sys.modules]
+assert not lazy, f"modules imported too early: {lazy}"
+"""
+
+
+@pytest.fixture
+def env(tmp_path):
+    """Use an empty configuration folder, and do not measure the coverage: it imports sqlite3."""
+    env = {var: value for var, value in os.environ.items() if not var.startswith("COV_CORE_")}
+    for var in ("HOME", "XDG_CONFIG_HOME", "LOCALAPPDATA"):
+        env[var] = str(tmp_path / "conf")
+    return env
+
+
+def run(code, *args, env=None):
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code, *args],
+        env=env,
+        check=True,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+@pytest.mark.parametrize("module", sorted(LAZY_IMPORTS))
+def test_import_time(module, env):
+    stderr = run(f"import {module}", env=env).stderr
+
+    imported = set(re.findall(r"^import time:.*\|\s*([\w.]+)$", stderr, re.MULTILINE))
+    assert module in imported
+    early = sorted(imported.intersection(LAZY_IMPORTS[module] + LAZY_MODULES))
+    assert not early
+
+
+def test_import_conf_translator(env):
+    """Neither optional modules, nor translations, are imported with the configuration and the translator."""
+    stderr = run("import watermark.conf, watermark.translator", env=env).stderr
+
+    imported = re.findall(r"^import time:.*\|\s*([\w.]+)$", stderr, re.MULTILINE)
+    assert "watermark.translator" in imported
+    early = [name for name in imported if name.split(".")[0] in ("yaml", "tinify", "requests") or "i18n" in name]
+    assert not early
+
+
+def test_import_no_side_effect(env, tmp_path):
+    run(CHECK, *LAZY_MODULES, env=env)
+    assert not (tmp_path / "conf").exists()
@@ -0,0 +1,125 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import os
+from unittest.mock import patch
+
+import pytest
+from watermark.manifest import MANIFEST_NAME, Manifest
+from watermark.optimizer import TinifyClient
+from watermark.testing import TinifyServer
+from watermark.utils import guess_output
+from watermark.watermark import apply_watermarks
+
+
+def run(paths, manifest, text="foo", **kwargs):
+    """Apply watermarks and return processed files."""
+    processed = []
+
+    def add_watermark(file, **kwargs):
+        processed.append(file)
+        return original(file, **kwargs)
+
+    from watermark.watermark import add_watermark as original
+
+    with patch("watermark.watermark.add_watermark", new=add_watermark):
+        results = list(apply_watermarks(paths, text, "", manifest=manifest, **kwargs))
+
+    assert all(output for _, output in results)
+    return processed
+
+
+@pytest.fixture()
+def files(tmp_path, png):
+    return [png(tmp_path / f"picture-{n}.png") for n in range(4)]
+
+
+def test_manifest_skip_up_to_date(tmp_path, files):
+    with Manifest.for_folder(tmp_path) as manifest:
+        assert run([tmp_path], manifest) and (tmp_path / MANIFEST_NAME).is_file()
+
+    # Nothing changed, sources must not be opened
+    with Manifest.for_folder(tmp_path) as manifest, patch(
+        "watermark.watermark.open_image", side_effect=AssertionError
+    ):
+        assert not run([tmp_path], manifest)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_manifest_params_changed(tmp_path, files, workers):
+    with Manifest.for_folder(tmp_path) as manifest:
+        run(files, manifest, workers=workers)
+        assert not run(files, manifest, workers=workers)
+        assert sorted(run(files, manifest, text="bar", workers=workers)) == files
+        assert sorted(run(files, manifest, max_size=10, workers=workers)) == files
+
+
+def test_manifest_source_changed(tmp_path, files, png):
+    with Manifest.for_folder(tmp_path) as manifest:
+        run(files, manifest)
+
+        # Touched, but same content
+        os.utime(files[0], ns=(1, 1))
+
+        # Modified
+        png(files[1])
+        os.utime(files[1], ns=(1, 1))
+
+        assert run(files, manifest) == [files[1]]
+        assert not run(files, manifest)
+
+
+def test_manifest_output_truncated(tmp_path, files):
+    with Manifest.for_folder(tmp_path) as manifest:
+        results = dict(apply_watermarks(files, "foo", "", manifest=manifest))
+
+        results[files[2]].write_bytes(b"truncated")
+        results[files[3]].unlink()
+
+        assert run(files, manifest) == files[2:]
+
+
+def test_manifest_output_edited(tmp_path, files):
+    """An output modified in place, keeping its size, is processed again."""
+    with Manifest.for_folder(tmp_path) as manifest:
+        results = dict(apply_watermarks(files, "foo", "", manifest=manifest))
+
+        data = bytearray(results[files[1]].read_bytes())
+        data[-3] ^= 0xFF
+        results[files[1]].write_bytes(bytes(data))
+
+        assert run(files, manifest) == [files[1]]
+
+
+def test_manifest_same_outputs(tmp_path, files, monkeypatch):
+    """Up-to-date outputs are the same paths as outputs of a fresh run."""
+    monkeypatch.chdir(tmp_path)
+    relative = [file.relative_to(tmp_path) for file in files]
+
+    with Manifest.for_folder(tmp_path) as manifest:
+        fresh = list(apply_watermarks(relative, "foo", "", manifest=manifest))
+        assert list(apply_watermarks(relative, "foo", "", manifest=manifest)) == fresh
+
+
+def test_manifest_not_optimized(tmp_path, files):
+    """Files left unoptimized are not recorded, they are optimized at next run."""
+    with Manifest.for_folder(tmp_path) as manifest:
+        with TinifyServer(errors=[400] * len(files)), TinifyClient() as client:
+            results = dict(apply_watermarks(files, "foo", "", manifest=manifest, optimizer=client))
+        assert all(output == guess_output(file) for file, output in results.items())
+
+        with TinifyServer() as server, TinifyClient() as client:
+            results = dict(apply_watermarks(files, "foo", "", manifest=manifest, optimizer=client))
+            assert server.compression_count == len(files)
+        assert all(output == guess_output(guess_output(file), optimized=True) for file, output in results.items())
+
+        # Optimized outputs are up-to-date
+        with TinifyServer() as server, TinifyClient() as client:
+            assert run(files, manifest, optimizer=client) == []
+            assert server.requests == 0
@@ -0,0 +1,97 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import json
+
+import pytest
+from watermark.cli import main
+from watermark.metrics import METRICS, Histogram, Registry
+from watermark.watermark import add_watermark, apply_watermarks
+
+
+@pytest.fixture
+def metrics():
+    """Enable metrics for one test."""
+    METRICS.enabled = True
+    METRICS.reset()
+    yield METRICS
+    METRICS.enabled = False
+    METRICS.reset()
+
+
+def test_disabled():
+    registry = Registry()
+    with registry.timer("decode"):
+        registry.inc("files_processed")
+    assert registry.to_dict()["counters"] == {}
+    assert registry.to_dict()["stages"] == {}
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(2.65)
+    assert histogram.cumulative() == [2, 3, 4]
+
+
+def test_openmetrics():
+    registry = Registry()
+    registry.enabled = True
+    registry.inc("files_processed", 2)
+    registry.observe("decode", 0.002)
+
+    text = registry.to_openmetrics()
+    assert "# TYPE watermark_files_processed counter\nwatermark_files_processed_total 2\n" in text
+    assert '# TYPE watermark_stage_seconds histogram\n' in text
+    assert 'watermark_stage_seconds_bucket{stage="decode",le="0.001"} 0\n' in text
+    assert 'watermark_stage_seconds_bucket{stage="decode",le="0.0025"} 1\n' in text
+    assert 'watermark_stage_seconds_bucket{stage="decode",le="+Inf"} 1\n' in text
+    assert 'watermark_stage_seconds_count{stage="decode"} 1\n' in text
+    assert text.endswith("# EOF\n")
+
+
+def test_add_watermark_stages(tmp_path, png, picture, metrics):
+    file = png(tmp_path / "picture.png")
+    output = add_watermark(file, text="© Tiger-222", picture=picture)
+
+    stages = metrics.to_dict()["stages"]
+    for stage in ("decode", "fit_font", "render", "flatten", "blend", "encode", "write"):
+        assert stages[stage]["count"] >= 1, stage
+    assert metrics.counters["bytes_written"] == output.stat().st_size
+
+
+def test_apply_watermarks_counters(tmp_path, png, metrics):
+    for n in range(3):
+        png(tmp_path / f"picture-{n}.png")
+    (tmp_path / "bad.jpg").write_bytes(b"not an image")
+
+    results = list(apply_watermarks([tmp_path], "foo", ""))
+
+    assert len(results) == 4
+    assert metrics.counters["files_processed"] == 3
+    assert metrics.counters["files_failed"] == 1
+    assert metrics.to_dict()["stages"]["file"]["count"] == 4
+    assert metrics.rate("files_processed") > 0
+
+
+@pytest.mark.parametrize("name", ["metrics.json", "metrics.prom"])
+def test_cli_metrics(tmp_path, png, name):
+    png(tmp_path / "picture.png")
+    file = tmp_path / name
+
+    assert main([str(tmp_path / "picture.png"), "--text", "foo", "--metrics", str(file), "--quiet"]) == 0
+
+    content = file.read_text(encoding="utf-8")
+    if file.suffix == ".prom":
+        assert "watermark_files_processed_total 1" in content
+    else:
+        assert json.loads(content)["counters"]["files_processed"] == 1
+    METRICS.enabled = False
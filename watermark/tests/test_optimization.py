@@ -7,12 +7,29 @@ You can always get the latest version of this module at:
     https://github.com/BoboTiG/watermark-me
 If that URL should fail, try contacting the author.
 """
+import pickle
+import time
 from pathlib import Path
+from threading import Thread
 from unittest.mock import patch
 
+import pytest
 import tinify
-from watermark.optimizer import optimize, validate_key
-from watermark.watermark import add_watermark
+from PIL import Image
+from watermark.optimizer import (
+    LocalOptimizer,
+    Optimizer,
+    TinifyClient,
+    _update_compression_count,
+    bisect,
+    compression_count,
+    get_optimizer,
+    optimize,
+    validate_key,
+)
+from watermark.quota import QuotaUsage
+from watermark.testing import TinifyServer
+from watermark.watermark import add_watermark, apply_watermarks
 
 
 def test_optimize(tmp_path, png):
@@ -23,26 +40,40 @@ def test_optimize(tmp_path, png):
     watermarked = add_watermark(image, text="confidential")
     assert watermarked.is_file()
 
-    class SourceMocked:
-        @classmethod
-        def from_file(cls, path):
-            return cls()
+    with TinifyServer():
+        optimized = optimize(watermarked)
 
-        def to_file(self, path):
-            Path(path).touch()
+    assert optimized.is_file()
 
-    def from_file(path):
-        return SourceMocked.from_file(path)
+    # Already done
+    assert optimize(optimized).name == optimized.name
 
-    tinify.compression_count = 0
 
-    with patch.object(tinify, "from_file", new=from_file):
+def test_optimize_stand_in_server(tmp_path, png):
+    """Test the optimization through HTTP, against a local Tinify stand-in."""
+    watermarked = add_watermark(png(tmp_path / "picture.png"), text="confidential")
+
+    with TinifyServer(compress=lambda data: data[:-1], errors=[503]) as server:
+        assert validate_key(server.key)
+        assert not validate_key("invalid_key")
+
+        tinify.key = server.key
         optimized = optimize(watermarked)
+        assert tinify.compression_count == 1
 
-    assert optimized.is_file()
+    assert optimized.read_bytes() == watermarked.read_bytes()[:-1]
 
-    # Already done
-    assert optimize(optimized).name == optimized.name
+
+def test_optimize_scoped_client(tmp_path, png):
+    """Each call uses its own client: connections are closed, and compressions are kept into the usage file."""
+    watermarked = add_watermark(png(tmp_path / "picture.png"), text="confidential")
+    usage = QuotaUsage(tmp_path / "usage.json")
+
+    with TinifyServer() as server, patch("requests.Session.close") as close:
+        assert optimize(watermarked, usage=usage)
+        assert close.called
+
+    assert usage.used(server.key) == 1
 
 
 def test_optimize_no_more_compression_counts(tmp_path, png):
@@ -65,18 +96,147 @@ def test_optimize_retry(tmp_path, png):
     watermarked = add_watermark(image, text="confidential")
     assert watermarked.is_file()
 
-    class SourceMocked:
-        @classmethod
-        def from_file(cls, path):
-            raise tinify.ServerError("Mock'ed error")
+    with TinifyServer(errors=[500, 502, 503, 504]) as server:
+        assert optimize(watermarked) is None
+        assert server.requests == 4
 
-    def from_file(path):
-        return SourceMocked.from_file(path)
 
-    tinify.compression_count = 1
+def test_optimize_all(tmp_path, png):
+    """Test concurrent uploads, over kept alive connections."""
+    files = [add_watermark(png(tmp_path / f"picture-{n}.png"), text="confidential") for n in range(8)]
 
-    with patch.object(tinify, "from_file", new=from_file):
-        assert optimize(watermarked) is None
+    with TinifyServer(latency=0.05) as server, TinifyClient() as client:
+        results = list(client.optimize_all(files, workers=4))
+        assert server.max_concurrency > 1
+        assert len(server.clients) <= 4
+        assert tinify.compression_count == 8
+
+    assert [file for file, _ in results] == files
+    assert all(optimized and optimized.is_file() for _, optimized in results)
+
+
+def test_optimize_backoff(tmp_path, png):
+    """Test exponential backoff delays, with jitter."""
+    watermarked = add_watermark(png(tmp_path / "picture.png"), text="confidential")
+    delays = []
+
+    with TinifyServer(errors=[503, 503, 503]), TinifyClient(backoff=0.1, max_backoff=0.3) as client:
+        with patch("time.sleep", new=delays.append):
+            assert client.optimize(watermarked)
+
+    assert len(delays) == 3
+    assert all(0 <= delay <= limit for delay, limit in zip(delays, (0.1, 0.2, 0.3)))
+
+
+def test_optimize_rate_limited(tmp_path, png):
+    """Test the Retry-After header is respected."""
+    watermarked = add_watermark(png(tmp_path / "picture.png"), text="confidential")
+
+    with TinifyServer(errors=[429], retry_after=0.2) as server, TinifyClient() as client:
+        start = time.monotonic()
+        assert client.optimize(watermarked)
+        assert time.monotonic() - start >= 0.2
+        assert server.requests == 2
+
+
+def test_optimize_quota_exhausted(tmp_path, png):
+    """Test a rate limit without delay is the end of monthly compressions."""
+    watermarked = add_watermark(png(tmp_path / "picture.png"), text="confidential")
+
+    with TinifyServer(errors=[429]) as server, TinifyClient() as client:
+        assert client.optimize(watermarked) is None
+        assert server.requests == 1
+
+
+def test_compression_count_monotonic():
+    """Test concurrent responses cannot decrease the compression count."""
+    tinify.compression_count = 0
+    threads = [Thread(target=_update_compression_count, args=(str(n),)) for n in range(1, 51)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    _update_compression_count("10")
+    assert compression_count() == 50
+
+
+def photo(file: Path, quality: int = 95, optimize: bool = False) -> Path:
+    """Save a smooth picture, compressible like a photo."""
+    bands = [Image.linear_gradient("L"), Image.radial_gradient("L"), Image.effect_noise((256, 256), 8)]
+    img = Image.merge("RGB", bands)
+    img.resize((1200, 900), Image.Resampling.BICUBIC).save(file, quality=quality, optimize=optimize)
+    return file
+
+
+def test_bisect():
+    assert bisect(30, 95, lambda quality: quality >= 70) == 70
+    assert bisect(30, 95, lambda quality: False) == 95
+    assert bisect(30, 95, lambda quality: True) == 30
+
+
+def test_local_optimizer(tmp_path):
+    watermarked = photo(tmp_path / "picture-w.jpg")
+
+    with get_optimizer("local") as optimizer:
+        optimized = optimizer.optimize(watermarked)
+
+    assert optimized == tmp_path / "picture-wo.jpg"
+    assert optimized.stat().st_size < watermarked.stat().st_size
+    with Image.open(optimized) as img:
+        assert img.size == (1200, 900)
+
+
+def test_local_optimizer_error_budget(tmp_path):
+    watermarked = photo(tmp_path / "picture-w.jpg")
+    img = Image.open(watermarked).convert("RGB")
+
+    strict, loose = LocalOptimizer(max_error=1.0), LocalOptimizer(max_error=8.0)
+    assert strict.quality(img, "JPEG") > loose.quality(img, "JPEG")
+
+    quality = loose.quality(img, "JPEG")
+    assert loose.error(img.convert("L"), loose.encode(img, "JPEG", quality)) <= 8.0
+
+
+@pytest.mark.parametrize("target_size", [20_000, 40_000])
+def test_local_optimizer_target_size(tmp_path, target_size):
+    watermarked = photo(tmp_path / "picture-w.jpg")
+
+    data = LocalOptimizer(target_size=target_size).compress_file(watermarked, watermarked.read_bytes())
+
+    assert target_size * 0.5 < len(data) <= target_size
+
+
+def test_local_optimizer_nothing_won(tmp_path):
+    watermarked = photo(tmp_path / "picture-w.jpg", quality=20, optimize=True)
+
+    optimized = LocalOptimizer().optimize(watermarked)
+
+    assert optimized.read_bytes() == watermarked.read_bytes()
+
+
+def test_local_optimizer_unsupported(tmp_path, png):
+    assert LocalOptimizer().optimize(png(tmp_path / "picture-w.png")) is None
+
+    broken = tmp_path / "broken-w.jpg"
+    broken.write_bytes(b"not a picture")
+    assert LocalOptimizer().optimize(broken) is None
+
+
+def test_optimizer_abstract():
+    with pytest.raises(TypeError):
+        Optimizer()
+
+
+def test_get_optimizer_unknown():
+    with pytest.raises(ValueError):
+        get_optimizer("zopfli")
+
+
+def test_optimize_unsupported_format(tmp_path):
+    """Test a format Tinify cannot optimize."""
+    image = tmp_path / "picture-w.avif"
+    image.touch()
+    assert optimize(image) is None
 
 
 def test_validate_key_empty():
@@ -96,3 +256,52 @@ def test_validate_key_valid(mocked_validate):
     """Test valid key validation."""
     mocked_validate.return_value = True
     assert validate_key("valid_key")
+
+
+def test_add_watermark_optimized_in_memory(tmp_path, png):
+    """Only the optimized file is written."""
+    image = png(tmp_path / "picture.png")
+
+    with TinifyServer(compress=lambda data: data[:-1]) as server, TinifyClient() as client:
+        output = add_watermark(image, text="confidential", optimizer=client)
+        assert server.compression_count == 1
+
+    assert output == tmp_path / "picture-wo.jpg"
+    assert sorted(tmp_path.iterdir()) == sorted([image, output])
+
+
+def test_add_watermark_optimization_failure(tmp_path, png):
+    """The watermarked picture is written when the optimization fails."""
+    image = png(tmp_path / "picture.png")
+
+    with TinifyServer(errors=[429]), TinifyClient() as client:
+        output = add_watermark(image, text="confidential", optimizer=client)
+
+    assert output == tmp_path / "picture-w.jpg"
+    assert output.is_file()
+    assert not (tmp_path / "picture-wo.jpg").exists()
+
+    # Optimized at next run
+    with TinifyServer(), TinifyClient() as client:
+        assert add_watermark(image, text="confidential", optimizer=client) == tmp_path / "picture-wo.jpg"
+    assert not output.exists()
+
+
+@pytest.mark.parametrize("backend", ["thread", "process", "pipeline"])
+def test_apply_watermarks_optimized(tmp_path, backend):
+    files = [photo(tmp_path / f"picture-{n}.jpg") for n in range(3)]
+
+    with LocalOptimizer() as optimizer:
+        results = dict(apply_watermarks([tmp_path], "© Tiger-222", "", workers=2, backend=backend, optimizer=optimizer))
+
+    assert sorted(results) == files
+    assert all(output.name.endswith("-wo.jpg") and output.is_file() for output in results.values())
+    assert not list(tmp_path.glob("*-w.jpg"))
+
+
+def test_tinify_client_pickle():
+    client = TinifyClient("key", retries=5)
+    client.session
+    copy = pickle.loads(pickle.dumps(client))
+    assert (copy.key, copy.retries) == ("key", 5)
+    assert copy.session is not client.session
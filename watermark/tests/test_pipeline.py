@@ -0,0 +1,161 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from watermark.cli import main
+from watermark.manifest import Manifest
+from watermark.optimizer import TinifyClient
+from watermark.pipeline import Pipeline
+from watermark.testing import TinifyServer
+from watermark.utils import guess_output
+from watermark.watermark import WatermarkTemplate, apply_watermarks
+
+
+def pipeline_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-")]
+
+
+def test_pipeline_same_outputs(tmp_path, png):
+    """Outputs are the same as the ones of the thread backend."""
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(4)]
+    expected = {}
+    for file, output in apply_watermarks(files, "confidential", "", workers=2):
+        expected[file] = output.read_bytes()
+        output.unlink()
+
+    results = dict(
+        apply_watermarks(files, "confidential", "", backend="pipeline", stages={"watermark": 2, "write": 2})
+    )
+
+    assert {file: output.read_bytes() for file, output in results.items()} == expected
+    assert not pipeline_threads()
+
+
+def test_pipeline_optimized(tmp_path, png):
+    """Uploads of several files overlap, other stages keep going meanwhile."""
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(6)]
+
+    with TinifyServer(latency=0.1, compress=lambda data: data[:-1]) as server, TinifyClient() as client:
+        results = list(
+            apply_watermarks(files, "confidential", "", backend="pipeline", optimizer=client, stages={"optimize": 3})
+        )
+        assert server.max_concurrency > 1
+
+    assert [file for file, _ in results] == files
+    assert all(output == guess_output(guess_output(file), optimized=True) for file, output in results)
+    assert all(output.is_file() for _, output in results)
+    assert not list(tmp_path.glob("*-w.png"))
+
+
+def test_pipeline_optimize_previous(tmp_path, png):
+    """Watermarked outputs of previous runs are optimized by the optimize stage, not by the read one."""
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(3)]
+    list(apply_watermarks(files, "confidential", "", backend="pipeline"))
+    outputs = [guess_output(file) for file in files]
+    threads = set()
+
+    with TinifyServer(compress=lambda data: data[:-1]), TinifyClient() as client:
+        optimize_data = client.optimize_data
+
+        def optimize(file, data):
+            threads.add(threading.current_thread().name.rsplit("-", 1)[0])
+            return optimize_data(file, data)
+
+        with patch.object(client, "optimize_data", side_effect=optimize):
+            results = list(apply_watermarks(files, "confidential", "", backend="pipeline", optimizer=client))
+
+    assert threads == {"pipeline-optimize"}
+    assert [output for _, output in results] == [guess_output(output, optimized=True) for output in outputs]
+    assert all(output.is_file() for _, output in results)
+    assert not any(output.exists() for output in outputs)
+
+
+def test_pipeline_up_to_date(tmp_path, png):
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(3)]
+    with Manifest.for_folder(tmp_path) as manifest:
+        first = dict(apply_watermarks(files, "foo", "", backend="pipeline", manifest=manifest))
+    with Manifest.for_folder(tmp_path) as manifest, patch("watermark.pipeline.open_image", side_effect=AssertionError):
+        second = dict(apply_watermarks(files, "foo", "", backend="pipeline", manifest=manifest))
+
+    assert sorted(first) == files
+    assert second == first
+
+
+def test_pipeline_failure(tmp_path, png, location):
+    """A bad file, or an error in any stage, does not stop the batch."""
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(4)]
+    files.insert(1, location.parent / "conftest.py")
+    pipeline = Pipeline(WatermarkTemplate(text="foo"), {})
+
+    write = pipeline._write
+
+    def write_mocked(job):
+        if job.file == files[3]:
+            raise OSError("Mock'ed error")
+        write(job)
+
+    pipeline._write = write_mocked
+    results = list(pipeline.run(files))
+
+    assert [file for file, _ in results] == files
+    assert [output is None for _, output in results] == [False, True, False, True, False]
+    assert not pipeline_threads()
+
+
+def test_pipeline_interrupted(tmp_path, png):
+    """Stages stop when results are no longer wanted."""
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(20)]
+
+    results = apply_watermarks(files, "foo", "", backend="pipeline", ordered=False)
+    next(results)
+    results.close()
+
+    assert not pipeline_threads()
+    assert len(list(tmp_path.glob("*-w.png"))) < len(files)
+
+
+def test_pipeline_backpressure(tmp_path, png):
+    """A slow stage holds back previous ones, files do not pile up in memory."""
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(12)]
+    pipeline = Pipeline(WatermarkTemplate(text="foo"), {}, queue_size=1)
+    read, write = pipeline._read, pipeline._write
+    state = {"read": 0, "written": 0, "ahead": 0}
+
+    def read_counted(job):
+        read(job)
+        state["read"] += 1
+        state["ahead"] = max(state["ahead"], state["read"] - state["written"])
+
+    def write_slowly(job):
+        time.sleep(0.02)
+        write(job)
+        state["written"] += 1
+
+    pipeline._read, pipeline._write = read_counted, write_slowly
+    assert all(output for _, output in pipeline.run(files))
+
+    # At most one file per queue and per stage
+    assert state["ahead"] <= 8
+
+
+@pytest.mark.parametrize("stage", ["gpu=2", "write=0", "write"])
+def test_cli_bad_stage(tmp_path, stage):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path), "-t", "foo", "--backend", "pipeline", "--stage", stage])
+
+
+def test_cli_pipeline(tmp_path, png, capsys):
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(3)]
+    assert main([str(tmp_path), "-t", "foo", "--backend", "pipeline", "--stage", "watermark=2"]) == 0
+    assert all(guess_output(file).is_file() for file in files)
+    assert capsys.readouterr().out.count("OK") == 3
@@ -0,0 +1,83 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import cProfile
+import pstats
+from pathlib import Path
+
+from watermark import profiling
+from watermark.cli import main
+from watermark.conf import CONF
+from watermark.profiling import Profiler, collapsed_stacks, profile_folder
+from watermark.watermark import apply_watermarks
+
+
+def test_profile_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(CONF, "profile_dir", "")
+    monkeypatch.delenv(profiling.ENV_VAR, raising=False)
+    assert profile_folder() is None
+
+    monkeypatch.setattr(CONF, "profile_dir", str(tmp_path / "conf"))
+    assert profile_folder() == tmp_path / "conf"
+
+    monkeypatch.setenv(profiling.ENV_VAR, str(tmp_path / "env"))
+    assert profile_folder() == tmp_path / "env"
+
+    assert profile_folder(str(tmp_path / "arg")) == tmp_path / "arg"
+
+
+def test_collapsed_stacks():
+    def inner():
+        return sum(range(200_000))
+
+    def outer():
+        for _ in range(5):
+            inner()
+
+    profile = cProfile.Profile()
+    profile.runcall(outer)
+    stacks = collapsed_stacks(pstats.Stats(profile))
+
+    inner_stacks = [stack.split(";") for stack in stacks if stack.endswith("builtins.sum>")]
+    assert inner_stacks
+    assert all(stack[-3].startswith("outer ") and stack[-2].startswith("inner ") for stack in inner_stacks)
+
+    total = sum(stacks.values()) / 1_000_000
+    assert abs(total - pstats.Stats(profile).total_tt) < 0.01
+
+
+def test_profiler(tmp_path, png):
+    files = [png(tmp_path / f"picture-{n}.png") for n in range(3)]
+
+    with Profiler(tmp_path / "reports", slowest=2) as profiler:
+        results = dict(apply_watermarks(files, "© Tiger-222", ""))
+    assert all(results.values())
+    assert profiling._PROFILER is None
+
+    stats = pstats.Stats(str(profiler.reports["pstats"]))
+    assert any(name == "add_watermark" for _, _, name in stats.stats)
+
+    lines = profiler.reports["collapsed"].read_text(encoding="utf-8").splitlines()
+    assert any("add_watermark (watermark.py" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+    report = profiler.reports["memory"].read_text(encoding="utf-8")
+    reported = [line.split(":")[0] for line in report.splitlines() if not line.startswith(" ")]
+    assert len(reported) == 2
+    assert all(Path(file) in files for file in reported)
+
+
+def test_cli_profile(tmp_path, png, capsys):
+    png(tmp_path / "picture.png")
+    folder = tmp_path / "reports"
+
+    assert main([str(tmp_path / "picture.png"), "--text", "foo", "--profile", str(folder), "-j", "2"]) == 0
+
+    assert sorted(file.suffix for file in folder.iterdir()) == [".collapsed", ".pstats", ".txt"]
+    assert "processed one by one" in capsys.readouterr().err
@@ -0,0 +1,83 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+from unittest.mock import patch
+
+from watermark.progress import Progress
+
+
+class Clock:
+    """A fake monotonic clock."""
+
+    def __init__(self) -> None:
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_progress(tmp_path):
+    source = tmp_path / "picture.png"
+    source.write_bytes(b"x" * 100)
+    output = tmp_path / "picture-w.jpg"
+    output.write_bytes(b"x" * 60)
+
+    progress = Progress(total=3)
+    progress.add(source, output)
+    progress.add(source, None)
+    progress.add(source, output, skipped=True)
+
+    assert progress.snapshot() == {
+        "done": 3,
+        "total": 3,
+        "count": 2,
+        "size_before": 200,
+        "size_after": 120,
+        "skipped": 1,
+        "eta": 0.0,
+    }
+
+
+def test_progress_throttled(tmp_path):
+    """Updates are rate limited, the last one is always sent."""
+    clock = Clock()
+    with patch("time.monotonic", new=clock):
+        progress = Progress(total=3, interval=0.25)
+        assert progress.due()
+        progress.add(tmp_path, None)
+        assert not progress.due()
+
+        clock.now += 0.3
+        assert progress.due()
+        progress.add(tmp_path, None)
+        assert not progress.due()
+        progress.add(tmp_path, None)
+        assert progress.due()
+
+
+def test_progress_eta(tmp_path):
+    """The remaining time is estimated from the throughput, pauses are not counted."""
+    clock = Clock()
+    with patch("time.monotonic", new=clock):
+        progress = Progress(total=10)
+        assert progress.eta() is None
+
+        clock.now += 2
+        progress.add(tmp_path, None)
+        progress.add(tmp_path, None)
+        assert progress.eta() == 8.0
+
+        progress.pause()
+        clock.now += 60
+        assert progress.eta() == 8.0
+        progress.resume()
+        assert progress.elapsed() == 2.0
+
+        clock.now += 2
+        assert progress.eta() == 16.0
@@ -0,0 +1,180 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+from unittest.mock import patch
+
+import pytest
+
+from watermark.cli import main
+from watermark.metrics import METRICS
+from watermark.optimizer import TinifyClient
+from watermark.quota import QuotaUsage, estimate_savings, plan_quota
+from watermark.testing import TinifyServer
+from watermark.tests.test_optimization import photo
+from watermark.utils import guess_output
+from watermark.watermark import apply_watermarks
+
+
+def test_usage(tmp_path):
+    usage = QuotaUsage(tmp_path / "usage.json")
+    assert usage.used("key") == 0
+
+    usage.record("key", 42)
+    assert QuotaUsage(tmp_path / "usage.json").used("key") == 42
+    assert usage.used("other key") == 0
+    assert "key" not in usage.file.read_text(encoding="utf-8")
+
+    # Counts can only increase, other clients may have made more compressions
+    usage.record("key", 10)
+    assert usage.used("key") == 42
+
+    # Counts are reset every month
+    with patch.object(QuotaUsage, "month", return_value="1970-01"):
+        assert usage.used("key") == 0
+
+
+def test_usage_broken(tmp_path):
+    usage = QuotaUsage(tmp_path / "usage.json")
+    usage.file.write_text("[not a usage file", encoding="utf-8")
+    assert usage.used("key") == 0
+    usage.record("key", 1)
+    assert usage.used("key") == 1
+
+
+def test_estimate_savings(tmp_path):
+    """Pictures already compressed are expected to save less."""
+    heavy = estimate_savings(photo(tmp_path / "heavy.jpg", quality=98))
+    light = estimate_savings(photo(tmp_path / "light.jpg", quality=60, optimize=True))
+    assert heavy > light
+    assert heavy > 0
+
+
+def test_estimate_savings_output(tmp_path):
+    """Sources are estimated on their output: Tinify receives the re-encoded picture, not the source."""
+    source = photo(tmp_path / "picture.png")
+    assert estimate_savings(source, output_format="jpeg") < estimate_savings(source) // 10
+
+    # Sources encoded alike have alike outputs
+    other = photo(tmp_path / "picture.jpg", quality=98)
+    assert estimate_savings(other, output_format="jpeg") == pytest.approx(
+        estimate_savings(source, output_format="jpeg"), rel=0.1
+    )
+
+
+def test_plan_quota(tmp_path):
+    files = [photo(tmp_path / f"picture-{quality}.jpg", quality=quality) for quality in (60, 98, 80)]
+
+    # Enough compressions, nothing is estimated
+    with patch("watermark.quota.estimate_savings", side_effect=AssertionError):
+        assert plan_quota(files, 3) == files
+        assert plan_quota(files, 0) == []
+
+    assert plan_quota(files, 2) == [files[1], files[2]]
+
+
+def test_plan_streamed(tmp_path):
+    """Files are only listed, and ranked, when there are not enough compressions for all of them."""
+    files = [photo(tmp_path / f"picture-{quality}.jpg", quality=quality) for quality in (60, 98, 80)]
+
+    with TinifyServer(), TinifyClient(limit=3) as client:
+        with patch("watermark.quota.estimate_savings", side_effect=AssertionError):
+            assert client.plan(files) is files
+            assert list(client.plan(iter(files))) == files
+            assert client._planned is None
+
+            client.limit = 0
+            stream = iter(files)
+            assert client.plan(stream) is stream
+
+        client.limit = 2
+        assert list(client.plan(iter(files))) == files
+        assert client._planned == {files[1], files[2]}
+
+
+def test_plan_sources(tmp_path):
+    """All sources are candidates when their output can be optimized, whatever their format."""
+    files = [photo(tmp_path / "picture.jpeg"), photo(tmp_path / "picture.tif"), photo(tmp_path / "picture-w.jpg")]
+
+    with TinifyServer(), TinifyClient(limit=1) as client:
+        assert client.plan(files, output_format="jpeg") == files
+        assert len(client._planned) == 1 and client._planned < set(files[:2])
+
+        # Outputs cannot be optimized
+        client.extensions = ("png",)
+        assert client.plan(files, output_format="jpeg") is files
+        assert client._planned is None
+
+
+def test_optimize_largest_savings_first(tmp_path):
+    """Remaining compressions are spent on pictures saving the most, others are skipped."""
+    files = [photo(tmp_path / f"picture-{quality}.jpg", quality=quality) for quality in (60, 98, 80)]
+    usage = QuotaUsage(tmp_path / "usage.json")
+    METRICS.enabled = True
+    METRICS.reset()
+
+    try:
+        with TinifyServer(compress=lambda data: data[:-1]) as server:
+            with TinifyClient(limit=1, usage=usage) as client:
+                results = dict(apply_watermarks([tmp_path], "foo", "", optimizer=client))
+                assert server.compression_count == 1
+                assert client.skipped == {files[0], files[2]}
+            assert METRICS.counters["files_skipped_quota"] == 2
+    finally:
+        METRICS.enabled = False
+        METRICS.reset()
+
+    assert results[files[1]] == guess_output(guess_output(files[1]), optimized=True)
+    assert results[files[0]] == guess_output(files[0])
+
+    # The usage is kept for next sessions, even before Tinify reports it
+    assert usage.used(client.key) == 1
+    with TinifyClient(client.key, limit=1, usage=usage) as client:
+        assert client.remaining() == 0
+
+
+def test_cli_quota(tmp_path, capsys):
+    files = [photo(tmp_path / f"picture-{quality}.jpg", quality=quality) for quality in (60, 98)]
+    usage = tmp_path / "usage.json"
+
+    with TinifyServer() as server:
+        QuotaUsage(usage).record(server.key, 499)
+        args = [str(tmp_path), "--text", "foo", "--optimize", "--tinify-key", server.key]
+        assert main(args + ["--tinify-usage", str(usage), "--cache-size", "0"]) == 0
+
+    out = capsys.readouterr().out
+    assert f"SKIP {files[0]}" in out
+    assert f"OK   {files[1]}" in out
+    assert QuotaUsage(usage).used(server.key) == 500
+
+
+def test_skipped_process_backend(tmp_path):
+    """Files skipped by copies of the client used by worker processes are known to the parent process."""
+    files = [photo(tmp_path / f"picture-{quality}.jpg", quality=quality) for quality in (60, 98, 80)]
+
+    with TinifyServer() as server, TinifyClient(limit=0) as client:
+        results = dict(apply_watermarks([tmp_path], "foo", "", workers=2, backend="process", optimizer=client))
+        assert server.requests == 0
+
+    assert client.skipped == set(files)
+    assert all(output == guess_output(file) for file, output in results.items())
+
+
+def test_usage_process_backend(tmp_path):
+    """Compressions made by copies of the client used by worker processes are counted by the parent process."""
+    for n in range(4):
+        photo(tmp_path / f"picture-{n}.jpg")
+    usage = QuotaUsage(tmp_path / "usage.json")
+
+    with TinifyServer() as server:
+        with TinifyClient(usage=usage) as client:
+            results = dict(apply_watermarks([tmp_path], "foo", "", workers=2, backend="process", optimizer=client))
+            assert client.used() == server.compression_count == 4
+
+    assert all(output.stem.endswith("-wo") for output in results.values())
+    assert usage.used(client.key) == 4
@@ -0,0 +1,52 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+import pytest
+from PIL import Image, ImageChops
+from watermark.tiles import bands, resize
+from watermark.watermark import PictureLayer, TextLayer, WatermarkTemplate
+
+
+@pytest.mark.parametrize(
+    "top, bottom, count, expected",
+    [
+        (0, 10, 1, [(0, 10)]),
+        (0, 10, 3, [(0, 4), (4, 7), (7, 10)]),
+        (5, 7, 4, [(5, 6), (6, 7)]),
+        (0, 0, 4, [(0, 0)]),
+    ],
+)
+def test_bands(top, bottom, count, expected):
+    assert bands(top, bottom, count) == expected
+
+
+@pytest.mark.parametrize("size", [(640, 480), (123, 457), (1000, 1)])
+def test_resize_parallel_same_as_serial(size):
+    """Bands must be seamless, up to rounding errors."""
+    img = Image.effect_noise((2000, 1500), 60).convert("RGB")
+    expected = resize(img, size)
+    result = resize(img, size, threads=4)
+    assert result.size == size
+    diff = ImageChops.difference(result, expected)
+    assert max(high for _, high in diff.getextrema()) <= 1
+
+
+@pytest.mark.parametrize("memory_budget", [0, 200 * 1024])
+def test_template_threads_same_as_serial(picture, memory_budget):
+    layers = [
+        TextLayer("© Tiger-222", anchor="top-left", scale=0.5),
+        PictureLayer(picture, anchor="bottom-right"),
+    ]
+    img = Image.effect_noise((1600, 1200), 60).convert("RGB")
+
+    expected = WatermarkTemplate(layers=layers, memory_budget=memory_budget).apply(img.copy())
+    template = WatermarkTemplate(layers=layers, memory_budget=memory_budget, threads=3)
+    result = template.apply(img)
+
+    assert ImageChops.difference(result, expected).getbbox() is None
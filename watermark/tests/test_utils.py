@@ -10,7 +10,7 @@ If that URL should fail, try contacting the author.
 from pathlib import Path
 
 import pytest
-from watermark.utils import guess_output, sizeof_fmt
+from watermark.utils import duration_fmt, guess_output, scan_dir, sizeof_fmt
 
 
 @pytest.mark.parametrize(
@@ -26,6 +26,11 @@ def test_guess_output(file, expected, optimized):
     assert guess_output(file, optimized=optimized) == expected
 
 
+def test_guess_output_extension():
+    assert guess_output(Path("file.jpg"), ext="webp") == Path("file-w.webp")
+    assert guess_output(Path("file-w.png"), optimized=True, ext="png") == Path("file-wo.png")
+
+
 @pytest.mark.parametrize(
     "size, result",
     [
@@ -52,3 +57,37 @@ def test_sizeof_fmt(size, result):
 
 def test_sizeof_fmt_custom_suffix():
     assert sizeof_fmt(168_963_795_964, suffix="o") == "157.4 Gio"
+
+
+@pytest.mark.parametrize(
+    "seconds, result", [(0, "0:00"), (0.2, "0:01"), (65, "1:05"), (3723.2, "1:02:04"), (-1, "0:00")]
+)
+def test_duration_fmt(seconds, result):
+    assert duration_fmt(seconds) == result
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_scan_dir(tmp_path, threads):
+    """Test folders scanning, extensions are case insensitive."""
+    expected = {
+        tmp_path / "a.jpg",
+        tmp_path / "B.JPG",
+        tmp_path / "c.Png",
+        tmp_path / "folder" / "d.png",
+        tmp_path / "folder" / "sub-folder" / "e.jpg",
+        tmp_path / "folder.jpg" / "f.jpg",
+    }
+    ignored = {
+        tmp_path / "g.gif",
+        tmp_path / "jpg",
+        tmp_path / "folder" / "h.jpg.txt",
+    }
+    for file in expected | ignored:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.touch()
+
+    assert set(scan_dir(tmp_path, ("jpg", "png"), threads=threads)) == expected
+
+
+def test_scan_dir_unreadable(tmp_path):
+    assert not list(scan_dir(tmp_path / "inexistant", ("jpg",)))
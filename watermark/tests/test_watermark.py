@@ -7,7 +7,26 @@ You can always get the latest version of this module at:
     https://github.com/BoboTiG/watermark-me
 If that URL should fail, try contacting the author.
 """
-from watermark.watermark import add_watermark, apply_watermarks
+import multiprocessing
+import os
+from unittest.mock import patch
+
+import pytest
+from PIL import Image, ImageChops
+from watermark.conf import default_font
+from watermark.watermark import (
+    add_watermark,
+    apply_watermarks,
+    fit_font_size,
+    is_supported,
+    anchor_position,
+    load_font,
+    open_image,
+    PatternLayer,
+    PictureLayer,
+    TextLayer,
+    WatermarkTemplate,
+)
 from watermark.utils import guess_output
 
 
@@ -85,6 +104,144 @@ def test_apply_watermark(tmp_path, location, picture, png):
         assert guess_output(file).is_file()
 
 
+@pytest.mark.parametrize("backend", ["thread", "process", "pipeline"])
+@pytest.mark.parametrize("ordered", [True, False])
+def test_apply_watermarks_parallel(tmp_path, location, picture, png, backend, ordered):
+    """Test parallel backends, a bad file must not break the pool."""
+    paths = [png(tmp_path / f"picture-{n}.png") for n in range(8)]
+    paths.insert(3, location.parent / "conftest.py")
+
+    text = "www.arresto-momentum.com"
+    results = list(
+        apply_watermarks(
+            paths, text=text, picture=picture, workers=3, backend=backend, ordered=ordered
+        )
+    )
+
+    if ordered:
+        assert [file for file, _ in results] == paths
+    else:
+        assert sorted(file for file, _ in results) == sorted(paths)
+
+    for file, output in results:
+        if file.suffix == ".py":
+            assert output is None
+        else:
+            assert output == guess_output(file)
+            assert output.is_file()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_apply_watermarks_error(tmp_path, png, workers):
+    """An unexpected error on one file must not stop the batch."""
+    paths = [png(tmp_path / f"picture-{n}.png") for n in range(4)]
+
+    def add_watermark_mocked(file, **kwargs):
+        if file == paths[1]:
+            raise MemoryError("Mock'ed error")
+        return add_watermark(file, **kwargs)
+
+    with patch("watermark.watermark.add_watermark", new=add_watermark_mocked):
+        results = dict(apply_watermarks(paths, "foo", "", workers=workers))
+
+    assert results[paths[1]] is None
+    assert all(results[path] for path in paths if path != paths[1])
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="workers must inherit the mock")
+@pytest.mark.parametrize("ordered", [True, False])
+def test_apply_watermarks_worker_died(tmp_path, png, ordered):
+    """A worker process dying on one file must not stop the batch, only that file fails."""
+    paths = [png(tmp_path / f"picture-{n}.png") for n in range(6)]
+
+    def add_watermark_mocked(file, **kwargs):
+        if file == paths[2]:
+            os._exit(1)
+        return add_watermark(file, **kwargs)
+
+    with patch("watermark.watermark.add_watermark", new=add_watermark_mocked):
+        results = list(apply_watermarks(paths, "foo", "", workers=2, backend="process", ordered=ordered))
+
+    assert sorted(file for file, _ in results) == paths
+    assert [file for file, output in results if output is None] == [paths[2]]
+    assert all(guess_output(path).is_file() for path in paths if path != paths[2])
+
+
+def test_apply_watermarks_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        list(apply_watermarks([tmp_path], "foo", "", workers=2, backend="gpu"))
+
+
+@pytest.mark.parametrize("ext", ["jpg", "png"])
+def test_open_image_max_size(tmp_path, ext):
+    """Images must be downscaled to fit in the maximum size, keeping the ratio."""
+    file = tmp_path / f"picture.{ext}"
+    Image.effect_noise((3000, 1000), 60).convert("RGB").save(file)
+
+    assert open_image(file).size == (3000, 1000)
+    assert open_image(file, max_size=4000).size == (3000, 1000)
+
+    img = open_image(file, max_size=512)
+    assert img.mode == "RGB"
+    assert img.size == (512, 171)
+
+
+def test_apply_watermarks_max_size(tmp_path):
+    """The maximum size must be used for all files."""
+    paths = []
+    for n in range(3):
+        paths.append(tmp_path / f"picture-{n}.jpg")
+        Image.new("RGB", (1200, 1600)).save(paths[-1])
+
+    for _, output in apply_watermarks(paths, "foo", "", max_size=800, workers=2):
+        assert Image.open(output).size == (600, 800)
+
+
+@pytest.mark.parametrize("output_format", ["jpeg", "png", "webp", "avif"])
+def test_output_format(tmp_path, png, output_format):
+    """Test output formats, unsupported ones fallback to JPEG."""
+    image = png(tmp_path / "picture.png")
+
+    output = add_watermark(image, text="foo", output_format=output_format)
+
+    expected = output_format if is_supported(output_format) else "jpeg"
+    assert output == guess_output(image, ext={"jpeg": "jpg"}.get(expected, expected))
+    assert Image.open(output).format == expected.upper()
+
+
+def test_encoder_settings(tmp_path):
+    """Test JPEG encoder settings."""
+    image = tmp_path / "picture.jpg"
+    Image.effect_noise((640, 480), 60).convert("RGB").save(image, quality=95)
+
+    output = add_watermark(
+        image,
+        text="foo",
+        encoder={"quality": 50, "progressive": True, "optimize": True, "subsampling": 0},
+    )
+    img = Image.open(output)
+    assert img.info["progressive"]
+    assert output.stat().st_size < image.stat().st_size
+    output.unlink()
+
+    # Keep the source quality
+    output = add_watermark(image, text="foo", encoder={"quality": "keep"})
+    assert Image.open(output).quantization == Image.open(image).quantization
+
+    # The source quality cannot be kept for other formats
+    output = add_watermark(image, text="foo", output_format="png", encoder={"quality": "keep"})
+    assert output.suffix == ".png"
+
+
+def test_apply_watermarks_tile_threads(tmp_path):
+    """Huge images can be split into tiles processed in parallel."""
+    paths = [tmp_path / "picture.jpg"]
+    Image.new("RGB", (1200, 1600)).save(paths[0])
+
+    results = list(apply_watermarks(paths, "foo", "", max_size=800, tile_threads=4))
+    assert Image.open(results[0][1]).size == (600, 800)
+
+
 def test_file_not_an_image(location):
     """Test a file that is not an image."""
     img = add_watermark(location.parent / "conftest.py", text="foo")
@@ -95,3 +252,219 @@ def test_file_not_found(location):
     """Test a file that does not exist."""
     img = add_watermark(location.parent / "inexistant.png", text="foo")
     assert img is None
+
+
+@pytest.mark.parametrize("width", [1, 10, 64, 640, 1024, 6000])
+def test_fit_font_size(width):
+    """The fitted size must be the smallest one filling the width."""
+    text = "www.arresto-momentum.com"
+    font = default_font()
+
+    def span(size):
+        n_width, n_height = load_font(font, size).getsize(text)
+        return n_width + n_height
+
+    size = fit_font_size(text, width, font)
+    assert span(size) >= width
+    if size > 1:
+        assert span(size - 1) < width
+
+
+def test_load_font_cached():
+    """Fonts must be loaded only once."""
+    font = default_font()
+    load_font.cache_clear()
+
+    for _ in range(3):
+        fit_font_size("confidential", 640, font)
+
+    info = load_font.cache_info()
+    assert info.misses < 15
+    assert info.hits > info.misses
+
+
+def test_template_overlays_cache():
+    """Overlays must be flattened once per image size."""
+    template = WatermarkTemplate(text="confidential", cache_size=2)
+
+    for size in [(320, 200), (320, 200), (200, 320), (320, 200), (64, 64), (1, 1)]:
+        img = template.apply(Image.new("RGB", size))
+        assert img.size == size
+
+    assert template.hits == 2
+    assert template.misses == 4
+    assert list(template._overlays) == [(64, 64), (1, 1)]
+
+
+def test_picture_layer_decoded_once(picture):
+    """The picture watermark must be decoded only once."""
+    layer = PictureLayer(picture, opacity=0.5)
+    assert layer.picture.mode == "RGBA"
+
+    original = Image.open(picture).convert("RGBA")
+    assert layer.picture.getchannel("A").getextrema()[1] < original.getchannel("A").getextrema()[1]
+
+    img = Image.new("RGB", (640, 480))
+    assert WatermarkTemplate(layers=[layer]).apply(img).size == img.size
+
+
+def test_template_blends_only_the_watermark_region(picture):
+    """Pixels outside of the overlay bounding box must be left untouched, in place."""
+    template = WatermarkTemplate(text="confidential", picture=picture)
+    img = Image.new("RGB", (2000, 1000), "#336699")
+
+    assert template.apply(img) is img
+
+    overlay, (x, y) = template.overlay(img.size)
+    assert overlay.size[0] < img.size[0] and overlay.size[1] < img.size[1]
+    bbox = (x, y, x + overlay.size[0], y + overlay.size[1])
+
+    untouched = Image.new("RGB", img.size, "#336699")
+    untouched.paste(img.crop(bbox), bbox[:2])
+    assert untouched.tobytes() == img.tobytes()
+
+
+def test_template_layers_stack(picture):
+    """Several layers must be flattened into one overlay covering all of them."""
+    layers = [
+        TextLayer("© Tiger-222", anchor="bottom-left", margin=10, scale=0.3),
+        PictureLayer(picture, anchor="top-right", opacity=1.0),
+        TextLayer("www.arresto-momentum.com", anchor="bottom-right", margin=10, scale=0.3),
+    ]
+    template = WatermarkTemplate(layers=layers)
+    size = (1600, 1200)
+
+    overlay, (x, y) = template.overlay(size)
+    assert (x, y) == (10, 0)
+    assert overlay.size[0] == size[0] - 10
+    assert y + overlay.size[1] <= size[1]
+
+    # Same as applying layers one after the other
+    img = Image.new("RGB", size, "#336699")
+    template.apply(img)
+    expected = Image.new("RGB", size, "#336699")
+    for layer in layers:
+        WatermarkTemplate(layers=[layer]).apply(expected)
+    diff = ImageChops.difference(img, expected)
+    assert max(high for _, high in diff.getextrema()) <= 2
+
+
+def test_template_memory_budget(picture):
+    """Strips must fit in the memory budget, and give the same result as the whole overlay."""
+    layers = [
+        TextLayer("© Tiger-222", anchor="top-left", scale=0.3),
+        PictureLayer(picture, anchor="bottom-right"),
+    ]
+    size = (3000, 2000)
+    budget = 3000 * 4 * 64
+
+    template = WatermarkTemplate(layers=layers)
+    assert not template.use_strips(size)
+    expected = template.apply(Image.new("RGB", size, "#336699"))
+
+    template = WatermarkTemplate(layers=layers, memory_budget=budget)
+    assert template.use_strips(size)
+
+    strips = list(template.strips(size))
+    assert all(overlay.size[0] * overlay.size[1] * 4 <= budget for overlay, _ in strips)
+
+    # Strips between the text and the picture are skipped
+    text_height = layers[0].bbox(size)[3]
+    picture_height = layers[1].picture.size[1]
+    assert sum(overlay.size[1] for overlay, _ in strips) < text_height + picture_height + 2 * 64
+
+    img = template.apply(Image.new("RGB", size, "#336699"))
+    diff = ImageChops.difference(img, expected)
+    assert max(high for _, high in diff.getextrema()) <= 2
+    assert template.misses == 0
+
+
+def test_template_memory_budget_text():
+    """A text layer larger than the memory budget must never be rendered whole."""
+    size = (6000, 1000)
+    budget = 6000 * 4 * 32
+    template = WatermarkTemplate(text="© Tiger-222", memory_budget=budget)
+    expected = WatermarkTemplate(text="© Tiger-222").apply(Image.new("RGB", size, "#336699"))
+
+    img = Image.new("RGB", size, "#336699")
+    buffers = []
+    new = Image.new
+
+    def record(mode, size, *args, **kwargs):
+        buffer = new(mode, size, *args, **kwargs)
+        buffers.append(len(buffer.getbands()) * size[0] * size[1])
+        return buffer
+
+    with patch("watermark.watermark.Image.new", side_effect=record):
+        template.apply(img)
+
+    box = template.layers[0].bbox(size)
+    assert (box[2] - box[0]) * (box[3] - box[1]) * 4 > 4 * budget
+    assert buffers
+    assert max(buffers) <= budget
+    assert ImageChops.difference(img, expected).getbbox() is None
+
+
+def test_pattern_layer():
+    """The pattern must cover the whole image, from a tile rendered once per image width."""
+    layer = PatternLayer("© Tiger-222", opacity=0.5)
+    size = (1600, 1200)
+
+    overlay, position = layer.layer(size)
+    assert position == (0, 0)
+    assert overlay.size == size
+    assert layer.bbox(size) == (0, 0, *size)
+
+    # Every part of the image is covered by some text
+    tile = layer.tile(size[0])
+    for x in range(0, size[0] - tile.size[0], tile.size[0]):
+        for y in range(0, size[1] - tile.size[1], tile.size[1]):
+            assert overlay.crop((x, y, x + tile.size[0], y + tile.size[1])).getextrema()[3][1] > 0
+
+    # A region is the same as a crop of the whole pattern
+    box = (123, 456, 789, 1011)
+    region, position = layer.region(size, box)
+    assert position == box[:2]
+    assert region.tobytes() == overlay.crop(box).tobytes()
+
+    # The tile is reused for other images of the same width
+    layer.layer((1600, 900))
+    assert layer.tile(size[0]) is tile
+
+
+def test_template_pattern(picture):
+    """Pattern watermarks blended strip by strip must give the same result as the whole overlay."""
+    template = WatermarkTemplate(text="© Tiger-222", picture=picture, pattern=True)
+    assert isinstance(template.layers[0], PatternLayer)
+
+    size = (2000, 1500)
+    expected = template.apply(Image.new("RGB", size, "#336699"))
+
+    template = WatermarkTemplate(text="© Tiger-222", picture=picture, pattern=True, memory_budget=2000 * 4 * 64)
+    assert template.use_strips(size)
+    img = template.apply(Image.new("RGB", size, "#336699"))
+    diff = ImageChops.difference(img, expected)
+    assert max(high for _, high in diff.getextrema()) <= 2
+
+
+@pytest.mark.parametrize(
+    "anchor, position",
+    [
+        ("top-left", (5, 5)),
+        ("top", (45, 5)),
+        ("top-right", (85, 5)),
+        ("left", (5, 20)),
+        ("center", (45, 20)),
+        ("right", (85, 20)),
+        ("bottom-left", (5, 35)),
+        ("bottom", (45, 35)),
+        ("bottom-right", (85, 35)),
+    ],
+)
+def test_anchor_position(anchor, position):
+    assert anchor_position(anchor, (100, 50), (10, 10), margin=5) == position
+
+
+def test_anchor_unknown():
+    with pytest.raises(ValueError):
+        TextLayer("confidential", anchor="middle")
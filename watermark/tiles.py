@@ -0,0 +1,77 @@
+"""
+GUI to watermark your pictures with text and/or another picture.
+
+This module is maintained by Mickaël Schoentgen <contact@tiger-222.fr>.
+
+You can always get the latest version of this module at:
+    https://github.com/BoboTiG/watermark-me
+If that URL should fail, try contacting the author.
+"""
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, Iterable, List, Tuple
+
+from PIL import Image
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor  # noqa: F401
+
+__all__ = ("bands", "executor", "map_tiles", "resize")
+
+# When downscaling, the image is first reduced to this factor of the final size, then resampled
+REDUCING_GAP = 2.0
+
+
+@lru_cache(maxsize=None)
+def executor(threads: int) -> "ThreadPoolExecutor":
+    """Get the shared pool of *threads* threads working on tiles of a same image.
+    Pillow releases the GIL while pasting and resampling, so tiles are really processed in parallel.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix="tile")
+
+
+def map_tiles(threads: int, func: Callable[..., Any], tiles: Iterable[Any]) -> List[Any]:
+    """Call *func* on all *tiles* using *threads* threads, and wait for all of them."""
+    if threads <= 1:
+        return [func(tile) for tile in tiles]
+    return list(executor(threads).map(func, tiles))
+
+
+def bands(top: int, bottom: int, count: int) -> List[Tuple[int, int]]:
+    """Split rows from *top* to *bottom* into *count* bands of the same height, or almost."""
+    count = max(1, min(count, bottom - top))
+    height, rest = divmod(bottom - top, count)
+    result = []
+    for n in range(count):
+        end = top + height + (1 if n < rest else 0)
+        result.append((top, end))
+        top = end
+    return result
+
+
+def resize(img: Image.Image, size: Tuple[int, int], threads: int = 1) -> Image.Image:
+    """Downscale a given *img* to the given *size*.
+    The image is first reduced, then resampled band by band using *threads* threads.
+    Bands are resampled using the whole image as source, so there is no seam between them.
+    """
+    factor = (
+        max(1, int(img.size[0] / size[0] / REDUCING_GAP)),
+        max(1, int(img.size[1] / size[1] / REDUCING_GAP)),
+    )
+    if factor != (1, 1):
+        img = img.reduce(factor)
+
+    if threads <= 1:
+        return img.resize(size)
+
+    scale = img.size[1] / size[1]
+    result = Image.new(img.mode, size)
+
+    def resample(band: Tuple[int, int]) -> None:
+        top, bottom = band
+        box = (0, top * scale, img.size[0], bottom * scale)
+        result.paste(img.resize((size[0], bottom - top), box=box), (0, top))
+
+    map_tiles(threads, resample, bands(0, size[1], threads))
+    return result
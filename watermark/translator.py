@@ -13,19 +13,35 @@ import json
 import re
 from contextlib import suppress
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from .conf import CONF
 from .constants import DATA_DIR
 
 
 class Translator:
-    def __init__(self, path: Path, lang: str = "") -> None:
+    """Translations found in *path*, in the given *lang*, or the configured one by default.
+    Translation files are only read on first use.
+    """
+
+    def __init__(self, path: Path, lang: Optional[str] = None) -> None:
+        self._path = path
+        self._lang = lang
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called until translations are loaded
+        if name not in ("locale", "langs", "_labels", "_current", "_fallback"):
+            raise AttributeError(name)
+        self._load()
+        return getattr(self, name)
+
+    def _load(self) -> None:
+        """Load translations."""
         self.locale = ""
         self._labels: Dict[str, Dict[str, str]] = {}
 
         # Load from JSON
-        for translation in path.iterdir():
+        for translation in self._path.iterdir():
             label = translation.stem
             self._labels[label] = json.loads(translation.read_text(encoding="utf-8"))
 
@@ -35,6 +51,7 @@ class Translator:
             self.langs[key] = (key, self._labels[key]["LANGUAGE"])
 
         # Select one
+        lang = CONF.lang if self._lang is None else self._lang
         try:
             self.set(lang)
         except ValueError:
@@ -77,4 +94,4 @@ class Translator:
                 self.locale = lang
 
 
-TR = Translator(DATA_DIR / "i18n", lang=CONF.lang)
+TR = Translator(DATA_DIR / "i18n")
@@ -7,17 +7,21 @@ You can always get the latest version of this module at:
     https://github.com/BoboTiG/watermark-me
 If that URL should fail, try contacting the author.
 """
+import logging
+import math
+import os
 from pathlib import Path
+from typing import Generator, Iterable, List, Tuple
 
 
-def guess_output(file: Path, optimized: bool = False) -> Path:
+def guess_output(file: Path, optimized: bool = False, ext: str = "jpg") -> Path:
     """Guess the output filename from a given *file*.
     "-w" is added when the file is being watermarked.
     "-wo" is added when the file is being optimized.
 
     "-o" and "-ow" cannot exist because the watermarking is always done first.
 
-    A filename for a JEPG is returned.
+    A filename with the given *ext* extension is returned, a JPEG one by default.
     """
     basename = file.stem
 
@@ -27,7 +31,63 @@ def guess_output(file: Path, optimized: bool = False) -> Path:
     elif not basename.endswith("-w"):
         basename += "-w"
 
-    return file.with_name(f"{basename}.jpg")
+    return file.with_name(f"{basename}.{ext}")
+
+
+def _scan(folder: str, suffixes: Tuple[str, ...]) -> Tuple[List[str], List[str]]:
+    """List files matching given *suffixes*, and sub-folders, of a given *folder*.
+    The type of an entry is known from the folder listing, there is no additional stat() call.
+    Symlinks to folders are not followed.
+    """
+    files: List[str] = []
+    folders: List[str] = []
+
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.name.lower().endswith(suffixes) and entry.is_file():
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        logging.warning(f"Skipping unreadable folder {folder}")
+
+    return files, folders
+
+
+def scan_dir(
+    folder: Path, extensions: Iterable[str], threads: int = 1
+) -> Generator[Path, None, None]:
+    """Yield files with one of the given *extensions*, case insensitive, from a given *folder*.
+    The tree is walked only once, using several *threads* to scan sub-folders concurrently
+    can help on network shares.
+    """
+    suffixes = tuple(f".{ext.lower()}" for ext in extensions)
+
+    if threads <= 1:
+        folders = [str(folder)]
+        while folders:
+            files, subfolders = _scan(folders.pop(), suffixes)
+            yield from map(Path, files)
+            folders.extend(reversed(subfolders))
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(_scan, str(folder), suffixes)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                pending.update(
+                    executor.submit(_scan, subfolder, suffixes)
+                    for subfolder in subfolders
+                )
+                yield from map(Path, files)
 
 
 def sizeof_fmt(num: int, suffix: str = "B") -> str:
@@ -51,3 +111,19 @@ def sizeof_fmt(num: int, suffix: str = "B") -> str:
             return f"{val:3.1f} {unit}{suffix}"
         val /= 1024.0
     return f"{val:,.1f} Yi{suffix}"
+
+
+def duration_fmt(seconds: float) -> str:
+    """
+    Human readable version of a duration, rounded up to the second.
+    Examples:
+        >>> duration_fmt(65)
+        "1:05"
+        >>> duration_fmt(3723.2)
+        "1:02:04"
+    """
+    minutes, secs = divmod(math.ceil(max(seconds, 0)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
@@ -8,116 +8,1180 @@ You can always get the latest version of this module at:
 If that URL should fail, try contacting the author.
 """
 import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import suppress
+from functools import lru_cache, partial
+from io import BytesIO
+from itertools import islice
 from pathlib import Path
-from typing import Any, Generator, List, Optional, Tuple
+from threading import Lock
+from typing import IO, TYPE_CHECKING, Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple, Union
 
 from PIL import Image, ImageDraw, ImageEnhance, ImageFont
 
-from .conf import CONF
-from .utils import guess_output
+from .conf import CONF, DEFAULT_QUALITY, OUTPUT_FORMATS, encoder_settings
+from .utils import guess_output, scan_dir
 
+if TYPE_CHECKING:
+    from concurrent.futures import Executor  # noqa: F401
 
-def add_watermark(image: Path, text: str = "", picture: str = "") -> Optional[Path]:
+    from .manifest import Manifest  # noqa: F401
+    from .optimizer import Optimizer  # noqa: F401
+
+# A rendered watermark layer and its position on the image
+Layer = Tuple[Image.Image, Tuple[int, int]]
+
+# Size of an image
+Size = Tuple[int, int]
+
+# A region of an image: left, top, right and bottom
+Box = Tuple[int, int, int, int]
+
+# Font size used to measure the text before scaling it to the wanted width
+FONT_REFERENCE_SIZE = 100
+
+# Results of a batch: the source file and the watermarked one, if any
+Results = Generator[Tuple[Path, Optional[Path]], None, None]
+
+# Options not changing outputs
+RUNTIME_OPTIONS = ("memory_budget", "overwrite", "threads")
+
+# Parallel batch backends
+BACKENDS = ("thread", "process", "pipeline")
+
+# The template and optimizer of a worker process, see init_worker()
+_WORKER_TEMPLATE: Optional["WatermarkTemplate"] = None
+_WORKER_OPTIMIZER: Optional["Optimizer"] = None
+
+# Where a layer can be placed on the image
+ANCHORS = (
+    "top-left",
+    "top",
+    "top-right",
+    "left",
+    "center",
+    "right",
+    "bottom-left",
+    "bottom",
+    "bottom-right",
+)
+
+
+def anchor_position(
+    anchor: str, size: Size, box: Size, margin: int = 0
+) -> Tuple[float, float]:
+    """Compute the position of a *box* placed at the given *anchor* on an image of the given *size*."""
+    if anchor not in ANCHORS:
+        raise ValueError(f"Unknown anchor {anchor!r}")
+
+    if anchor.endswith("left"):
+        x: float = margin
+    elif anchor.endswith("right"):
+        x = size[0] - box[0] - margin
+    else:
+        x = (size[0] - box[0]) / 2
+
+    if anchor.startswith("top"):
+        y: float = margin
+    elif anchor.startswith("bottom"):
+        y = size[1] - box[1] - margin
+    else:
+        y = (size[1] - box[1]) / 2
+
+    return x, y
+
+
+class WatermarkLayer(ABC):
+    """One watermark of the stack, placed at a given *anchor* with its own *opacity*.
+    Rendered layers are kept in a bounded cache indexed by the image size.
+    """
+
+    def __init__(
+        self,
+        opacity: Optional[float] = None,
+        anchor: str = "center",
+        margin: int = 0,
+        cache_size: int = 4,
+    ) -> None:
+        if anchor not in ANCHORS:
+            raise ValueError(f"Unknown anchor {anchor!r}")
+
+        self.opacity = CONF.opacity if opacity is None else opacity
+        self.anchor = anchor
+        self.margin = margin
+
+        # Rendered layers, the most recently used last
+        self.cache_size = cache_size
+        self._rendered: "OrderedDict[Size, Layer]" = OrderedDict()
+
+    @abstractmethod
+    def render(self, size: Size) -> Layer:
+        """Render the layer, limited to its bounding box, for an image of the given *size*."""
+
+    def layer(self, size: Size) -> Layer:
+        """Get the rendered layer, and its position, for an image of the given *size*."""
+        from .metrics import METRICS
+
+        try:
+            layer = self._rendered[size]
+        except KeyError:
+            with METRICS.timer("render"):
+                layer = self._rendered[size] = self.render(size)
+            if len(self._rendered) > self.cache_size:
+                self._rendered.popitem(last=False)
+        else:
+            self._rendered.move_to_end(size)
+        return layer
+
+    def bbox(self, size: Size) -> Box:
+        """Get the bounding box of the layer on an image of the given *size*."""
+        img, (x, y) = self.layer(size)
+        return x, y, x + img.size[0], y + img.size[1]
+
+    def region(self, size: Size, box: Box) -> Optional[Layer]:
+        """Get the part of the layer within a given *box*, and its position, for an image of the given *size*."""
+        img, (x, y) = self.layer(size)
+        left, top = max(box[0], x), max(box[1], y)
+        right, bottom = min(box[2], x + img.size[0]), min(box[3], y + img.size[1])
+        if left >= right or top >= bottom:
+            return None
+        return img.crop((left - x, top - y, right - x, bottom - y)), (left, top)
+
+
+class TextLayer(WatermarkLayer):
+    """A *text* watermark, its font size is computed to fill the given *scale* of the image width.
+    Its bounding box is computed from the font metrics, and parts of the text are rendered without the whole layer.
+    """
+
+    def __init__(
+        self,
+        text: str,
+        font: str = "",
+        color: str = "",
+        scale: float = 1.0,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.text = text
+        self.font = font or CONF.font
+        self.color = color or CONF.text_color
+        self.scale = scale
+
+        # Fonts, and bounding boxes, the most recently used last
+        self._placements: "OrderedDict[Size, Tuple[ImageFont.FreeTypeFont, Box]]" = OrderedDict()
+
+    def placement(self, size: Size) -> Tuple[ImageFont.FreeTypeFont, Box]:
+        """Get the font, and the bounding box of the text, for an image of the given *size*."""
+        try:
+            placement = self._placements[size]
+        except KeyError:
+            font_size = fit_font_size(self.text, int(size[0] * self.scale), self.font)
+            n_font = load_font(self.font, font_size)
+            n_width, n_height = n_font.getsize(self.text)
+            x, y = anchor_position(self.anchor, size, (n_width, n_height), self.margin)
+            left, top = int(x), int(y)
+            placement = self._placements[size] = n_font, (left, top, left + n_width + 1, top + n_height + 1)
+            if len(self._placements) > self.cache_size:
+                self._placements.popitem(last=False)
+        else:
+            self._placements.move_to_end(size)
+        return placement
+
+    def bbox(self, size: Size) -> Box:
+        return self.placement(size)[1]
+
+    def region(self, size: Size, box: Box) -> Optional[Layer]:
+        """Render the part of the text within a given *box*, and get its position, for an image of the given *size*."""
+        bbox = self.bbox(size)
+        left, top = max(box[0], bbox[0]), max(box[1], bbox[1])
+        right, bottom = min(box[2], bbox[2]), min(box[3], bbox[3])
+        if left >= right or top >= bottom:
+            return None
+        return self._draw(size, (left, top, right, bottom)), (left, top)
+
+    def render(self, size: Size) -> Layer:
+        box = self.bbox(size)
+        return self._draw(size, box), box[:2]
+
+    def _draw(self, size: Size, box: Box) -> Image.Image:
+        """Draw the part of the text within a given *box* of an image of the given *size*."""
+        n_font, (x, y, _, _) = self.placement(size)
+        watermark_img = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(watermark_img, "RGBA")
+        draw.text((x - box[0], y - box[1]), self.text, font=n_font, fill=self.color)
+
+        alpha = watermark_img.split()[3]
+        alpha = ImageEnhance.Brightness(alpha).enhance(self.opacity)
+        watermark_img.putalpha(alpha)
+
+        return watermark_img
+
+
+class PatternLayer(TextLayer):
+    """A *text* watermark repeated over the whole image, rotated by *angle* degrees.
+
+    The rotated text is rendered once as a tile, its font size computed to fill the given *scale*
+    of the image width, and *spacing* is the blank space around the text, relative to the text size.
+    The image is then covered by copies of the tile, every other row shifted by half a tile.
+    """
+
+    def __init__(
+        self,
+        text: str,
+        angle: float = 30.0,
+        scale: float = 0.25,
+        spacing: float = 0.5,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(text, scale=scale, **kwargs)
+        self.angle = angle
+        self.spacing = spacing
+        self._tiles: "OrderedDict[int, Image.Image]" = OrderedDict()
+
+    def tile(self, width: int) -> Image.Image:
+        """Get the pattern tile for an image of the given *width*."""
+        try:
+            tile = self._tiles[width]
+        except KeyError:
+            tile = self._tiles[width] = self._render_tile(width)
+            if len(self._tiles) > self.cache_size:
+                self._tiles.popitem(last=False)
+        else:
+            self._tiles.move_to_end(width)
+        return tile
+
+    def _render_tile(self, width: int) -> Image.Image:
+        """Render the rotated text, with blank space around."""
+        font_size = fit_font_size(self.text, max(1, int(width * self.scale)), self.font)
+        n_font = load_font(self.font, font_size)
+        n_width, n_height = n_font.getsize(self.text)
+
+        margin = (int(n_width * self.spacing / 2), int(n_height * self.spacing / 2))
+        text_img = Image.new("RGBA", (n_width + 2 * margin[0], n_height + 2 * margin[1]), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(text_img, "RGBA")
+        draw.text(margin, self.text, font=n_font, fill=self.color)
+
+        alpha = text_img.split()[3]
+        alpha = ImageEnhance.Brightness(alpha).enhance(self.opacity)
+        text_img.putalpha(alpha)
+
+        return text_img.rotate(self.angle, resample=Image.Resampling.BICUBIC, expand=True)
+
+    def bbox(self, size: Size) -> Box:
+        return 0, 0, size[0], size[1]
+
+    def region(self, size: Size, box: Box) -> Optional[Layer]:
+        """Cover the given *box* with tiles, tiles are copied, not blended."""
+        tile = self.tile(size[0])
+        width, height = tile.size
+        left, top = max(box[0], 0), max(box[1], 0)
+        right, bottom = min(box[2], size[0]), min(box[3], size[1])
+        if left >= right or top >= bottom:
+            return None
+
+        img = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        for row in range(top // height, (bottom - 1) // height + 1):
+            shift = (width // 2) * (row % 2)
+            y = row * height - top
+            for column in range((left + shift) // width - 1, (right + shift) // width + 1):
+                img.paste(tile, (column * width - shift - left, y))
+
+        return img, (left, top)
+
+    def render(self, size: Size) -> Layer:
+        layer = self.region(size, (0, 0, size[0], size[1]))
+        if layer is None:
+            return Image.new("RGBA", (0, 0)), (0, 0)
+        return layer
+
+
+class PictureLayer(WatermarkLayer):
+    """A *picture* watermark, decoded and with its opacity adjusted only once."""
+
+    def __init__(self, picture: str, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+
+        with Image.open(picture) as watermark_img:
+            watermark_img = watermark_img.convert("RGBA")
+
+        alpha = watermark_img.split()[3]
+        if self.opacity:
+            alpha = ImageEnhance.Brightness(alpha).enhance(self.opacity)
+
+        # Historically, the picture was pasted onto an opaque RGBA copy of the image, and that copy
+        # was then used as its own mask. That double blending is baked into the alpha channel
+        # to keep the same rendering: a -> a * (1 - a + a²)
+        alpha = alpha.point(
+            [round(a * (1 - a / 255 + (a / 255) ** 2)) for a in range(256)]
+        )
+        watermark_img.putalpha(alpha)
+
+        self.picture = watermark_img
+
+    def render(self, size: Size) -> Layer:
+        x, y = anchor_position(self.anchor, size, self.picture.size, self.margin)
+        return self.picture, (int(x), int(y))
+
+
+class WatermarkTemplate:
+    """A stack of watermark layers built once, then reused for a whole batch of images.
+
+    The *text*, *picture*, *font*, *text_color* and *opacity* arguments are shortcuts to the
+    centered text and picture layers, any number of additional *layers* can be stacked above.
+    The text is repeated over the whole image when *pattern* is True.
+    All layers are flattened into one overlay, kept in a bounded cache indexed by the image size,
+    and the overlay is blended into the image at once.
+
+    When the overlay would take more than *memory_budget* bytes, layers are flattened and blended
+    strip by strip instead, each strip fitting in the budget. Strips without any layer are skipped.
+
+    With several *threads*, the overlay is split into bands blended in parallel into the image,
+    and images are resampled band by band too.
+    """
+
+    def __init__(
+        self,
+        text: str = "",
+        picture: str = "",
+        font: str = "",
+        text_color: str = "",
+        opacity: Optional[float] = None,
+        pattern: bool = False,
+        layers: Optional[List[WatermarkLayer]] = None,
+        memory_budget: int = 0,
+        threads: int = 1,
+        cache_size: int = 4,
+    ) -> None:
+        self.memory_budget = memory_budget
+        self.threads = threads
+        self.layers: List[WatermarkLayer] = []
+        if text:
+            text_layer = PatternLayer if pattern else TextLayer
+            self.layers.append(
+                text_layer(text, font=font, color=text_color, opacity=opacity)
+            )
+        if picture:
+            self.layers.append(PictureLayer(picture, opacity=opacity))
+        self.layers.extend(layers or [])
+
+        # Flattened overlays, the most recently used last
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._overlays: "OrderedDict[Size, Tuple[Layer, List[Layer]]]" = OrderedDict()
+
+        # The template can be shared between threads, layers are rendered one at a time
+        self._lock = Lock()
+
+    def _flatten(self, size: Size) -> Layer:
+        """Flatten all layers into one overlay for an image of the given *size*."""
+        from .metrics import METRICS
+
+        with METRICS.timer("flatten"):
+            return self._flatten_layers(size)
+
+    def _flatten_layers(self, size: Size) -> Layer:
+        """See `_flatten()`."""
+        layers = [layer.layer(size) for layer in self.layers]
+        if len(layers) == 1:
+            return layers[0]
+
+        # The overlay covers the union of all layers bounding boxes
+        left = min(x for _, (x, _) in layers)
+        top = min(y for _, (_, y) in layers)
+        right = max(x + img.size[0] for img, (x, _) in layers)
+        bottom = max(y + img.size[1] for img, (_, y) in layers)
+
+        overlay = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        for img, (x, y) in layers:
+            overlay.alpha_composite(img, dest=(x - left, y - top))
+
+        return overlay, (left, top)
+
+    def _split(self, layer: Layer) -> List[Layer]:
+        """Split the *layer* into bands, one per thread."""
+        overlay, (x, y) = layer
+        if self.threads <= 1:
+            return [layer]
+
+        from .tiles import bands
+
+        return [
+            (overlay.crop((0, top, overlay.size[0], bottom)), (x, y + top))
+            for top, bottom in bands(0, overlay.size[1], self.threads)
+        ]
+
+    def _cached(self, size: Size) -> Tuple[Layer, List[Layer]]:
+        """Get the overlay, and its bands, from the cache."""
+        with self._lock:
+            try:
+                cached = self._overlays[size]
+            except KeyError:
+                self.misses += 1
+                layer = self._flatten(size)
+                cached = layer, self._split(layer)
+                self._overlays[size] = cached
+                if len(self._overlays) > self.cache_size:
+                    self._overlays.popitem(last=False)
+            else:
+                self.hits += 1
+                self._overlays.move_to_end(size)
+        return cached
+
+    def overlay(self, size: Size) -> Layer:
+        """Get the flattened overlay, and its position, for an image of the given *size*."""
+        return self._cached(size)[0]
+
+    def covered(self, size: Size) -> Optional[Box]:
+        """Get the region of an image of the given *size* covered by layers."""
+        with self._lock:
+            boxes = [layer.bbox(size) for layer in self.layers]
+
+        left = max(0, min(box[0] for box in boxes))
+        top = max(0, min(box[1] for box in boxes))
+        right = min(size[0], max(box[2] for box in boxes))
+        bottom = min(size[1], max(box[3] for box in boxes))
+        if left >= right or top >= bottom:
+            return None
+        return left, top, right, bottom
+
+    def strips(self, size: Size) -> Generator[Layer, None, None]:
+        """Flatten layers strip by strip, for an image of the given *size*.
+        Each strip overlay fits in the memory budget.
+        """
+        covered = self.covered(size)
+        if not covered:
+            return
+
+        # Strips are processed in parallel, they must all fit in the budget
+        left, top, right, bottom = covered
+        height = max(1, self.memory_budget // (4 * (right - left) * self.threads))
+
+        for y in range(top, bottom, height):
+            box = (left, y, right, min(y + height, bottom))
+            with self._lock:
+                parts = [layer.region(size, box) for layer in self.layers]
+            layers = [part for part in parts if part]
+            if not layers:
+                continue
+            if len(layers) == 1:
+                yield layers[0]
+                continue
+
+            overlay = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+            for img, position in layers:
+                overlay.alpha_composite(img, dest=(position[0] - left, position[1] - y))
+            yield overlay, (left, y)
+
+    def use_strips(self, size: Size) -> bool:
+        """Check if the overlay for an image of the given *size* would not fit in the memory budget."""
+        if not self.memory_budget:
+            return False
+        covered = self.covered(size)
+        if not covered:
+            return False
+        return (covered[2] - covered[0]) * (covered[3] - covered[1]) * 4 > self.memory_budget
+
+    def apply(self, img: Image.Image) -> Image.Image:
+        """Add all watermarks to a given *img*, in place.
+        Only the region behind the overlay is blended, in a single pass, or strip by strip
+        when the overlay does not fit in the memory budget.
+        """
+        if not self.layers:
+            return img
+
+        from .metrics import METRICS
+        from .tiles import map_tiles
+
+        # The image is shared between threads, be sure it is loaded first
+        img.load()
+
+        if self.use_strips(img.size):
+            # Strips are flattened while blending
+            with METRICS.timer("blend"):
+                strips = self.strips(img.size)
+                while True:
+                    chunk = list(islice(strips, self.threads))
+                    if not chunk:
+                        break
+                    map_tiles(self.threads, lambda strip: _paste(img, strip), chunk)
+        else:
+            _, parts = self._cached(img.size)
+            with METRICS.timer("blend"):
+                map_tiles(self.threads, lambda part: _paste(img, part), parts)
+        return img
+
+
+def _paste(img: Image.Image, layer: Layer) -> None:
+    """Blend a given RGBA *layer* into the *img* at its position, in place."""
+    overlay, position = layer
+    img.paste(overlay, position, mask=overlay)
+
+
+def add_watermark(
+    image: Path,
+    text: str = "",
+    picture: str = "",
+    template: Optional[WatermarkTemplate] = None,
+    max_size: int = 0,
+    output_format: str = "",
+    encoder: Optional[Dict[str, Any]] = None,
+    overwrite: bool = False,
+    optimizer: Optional["Optimizer"] = None,
+) -> Optional[Path]:
     """Add a given picture *watermark* and/or a given *text* to a given *image*
     using the specified *opacity*.
+    A prepared *template* can be passed to reuse watermark layers across several images.
+    If *max_size* is set, the image is downscaled to fit in a square of that size before being watermarked.
+    The image is saved using the *output_format*, and *encoder* settings overriding the configuration ones.
+    An existing output is kept, unless *overwrite* is True.
+
+    When an *optimizer* is given, the image is encoded in memory, optimized from there, and only
+    the optimized file is written. The watermarked one is written instead if the optimization fails.
     Source: https://gist.github.com/makmac213/a4ab09f5a042c5477037
     """
-    output = guess_output(image)
+    plan = plan_outputs(image, output_format, optimizer, overwrite)
+    if plan.done is not None:
+        return plan.done
+    if plan.previous is not None and optimizer is not None:
+        result = optimizer.optimize_data(image, plan.previous.read_bytes())
+        if result is None:
+            return plan.previous
+        return write_optimized(plan, result)
+    output, optimized = plan.output, plan.optimized
+    if optimized is None:
+        optimizer = None
 
-    # We should not erase old work, stop here.
-    if output.is_file():
-        logging.info(f"{image} already processed")
-        return output
+    if template is None:
+        template = WatermarkTemplate(text=text, picture=picture)
 
     try:
-        with image.open("rb") as finput:
-            img = Image.open(finput).convert("RGB")
+        img = open_image(image, max_size=max_size, threads=template.threads)
     except OSError:
         logging.warning(f"Skipping unprocessable {image}")
         return None
 
-    if text:
-        logging.info(f"Applying text watermark {text!r} on {image}")
-        img = add_text_watermark(img, text)
-    if picture:
-        logging.info(f"Applying picture watermark {picture!r} on {image}")
-        img = add_picture_watermark(img, picture)
+    logging.info(f"Applying {len(template.layers)} watermark layer(s) on {image}")
+    img = template.apply(img)
+
+    from .profiling import checkpoint
+
+    checkpoint()
 
-    img.save(output, "JPEG")
+    fmt, options = encoder_options(img, plan.output_format, encoder_settings(**(encoder or {})))
+
+    if optimizer is not None and optimized is not None:
+        data = encode_image(img, fmt, options)
+        del img
+        result = optimizer.optimize_data(image, data)
+        if result is None:
+            logging.warning(f"Cannot optimize {image}, keeping the watermarked picture")
+        else:
+            output, data = optimized, result
+        write_file(output, data)
+        return output
+
+    # Write to a temporary file first, so that an interrupted save does not leave a truncated output
+    tmp = output.with_name(f"{output.name}.part")
+    from .metrics import METRICS
+
+    try:
+        if METRICS.enabled:
+            _save_timed(img, tmp, fmt, options)
+        else:
+            img.save(tmp, fmt, **options)
+        os.replace(tmp, output)
+    finally:
+        with suppress(FileNotFoundError):
+            tmp.unlink()
     return output
 
 
-def add_picture_watermark(img: Image, watermark: str) -> Image:
-    """Add a given picture *watermark* to a given *img* using the specified *opacity*.
-    Source: https://gist.github.com/makmac213/a4ab09f5a042c5477037
+class Plan:
+    """Outputs of a source image: the watermarked file, and the optimized one when optimizing,
+    encoded using the *output_format*. *done* is the result of a previous run, if any.
+    *previous* is the watermarked output of a previous run, left to optimize.
     """
-    watermark_img = Image.open(watermark)
 
+    __slots__ = ("output_format", "output", "optimized", "done", "previous")
+
+    def __init__(
+        self, output_format: str, output: Path, optimized: Optional[Path], done: Optional[Path]
+    ) -> None:
+        self.output_format = output_format
+        self.output = output
+        self.optimized = optimized
+        self.done = done
+        self.previous: Optional[Path] = None
+
+
+def plan_outputs(
+    image: Path, output_format: str = "", optimizer: Optional["Optimizer"] = None, overwrite: bool = False
+) -> Plan:
+    """Get outputs of a given *image*, see `add_watermark()` for parameters.
+    An output of a previous run, made without optimization or when it failed, is left to optimize.
+    Only the file system is checked, files are not read.
     """
-    # Resize to 25% of real dimensions
-    w = int(watermark_img.size[0] * 0.25)
-    h = int(watermark_img.size[1] * 0.25)
-    watermark_img = watermark_img.resize((w, h), Image.ANTIALIAS)
+    output_format = output_format or CONF.output_format
+    if not is_supported(output_format):
+        logging.warning(f"Unsupported output format {output_format!r}, using JPEG")
+        output_format = "jpeg"
+
+    ext = OUTPUT_FORMATS[output_format]
+    output = guess_output(image, ext=ext)
+    if optimizer is not None and ext not in optimizer.extensions:
+        optimizer = None
+    optimized = guess_output(output, optimized=True, ext=ext) if optimizer is not None else None
+    plan = Plan(output_format, output, optimized, None)
+
+    # We should not erase old work, stop here.
+    if output == image or image == optimized:
+        logging.info(f"{image} already processed")
+        plan.done = image
+    elif not overwrite:
+        if optimized is not None and optimized.is_file():
+            logging.info(f"{image} already processed")
+            plan.done = optimized
+        elif output.is_file():
+            logging.info(f"{image} already processed")
+            if optimized is not None:
+                plan.previous = output
+            else:
+                plan.done = output
+    return plan
+
+
+def write_optimized(plan: Plan, data: bytes) -> Path:
+    """Write the optimized file of a *plan*, whose content is *data*, and get it.
+    The watermarked output of a previous run is then removed.
     """
+    assert plan.optimized is not None
+    write_file(plan.optimized, data)
+    if plan.previous is not None:
+        plan.previous.unlink()
+    return plan.optimized
 
-    if CONF.opacity:
-        alpha = watermark_img.split()[3]
-        alpha = ImageEnhance.Brightness(alpha).enhance(CONF.opacity)
-        watermark_img.putalpha(alpha)
 
-    # Center
-    position = (
-        int((img.size[0] - watermark_img.size[0]) / 2),
-        int((img.size[1] - watermark_img.size[1]) / 2),
-    )
+def encode_image(img: Image.Image, fmt: str, options: Dict[str, Any]) -> bytes:
+    """Encode a given *img* in memory, as *fmt* using the encoder *options*."""
+    from .metrics import METRICS
+
+    with METRICS.timer("encode"):
+        buffer = BytesIO()
+        img.save(buffer, fmt, **options)
+        return buffer.getvalue()
+
+
+def write_file(file: Path, data: bytes) -> None:
+    """Write *data* into a given *file*, through a temporary file so that an interrupted write
+    does not leave a truncated file.
+    """
+    from .metrics import METRICS
+
+    tmp = file.with_name(f"{file.name}.part")
+    try:
+        with METRICS.timer("write"):
+            tmp.write_bytes(data)
+            os.replace(tmp, file)
+    finally:
+        with suppress(FileNotFoundError):
+            tmp.unlink()
+    METRICS.inc("bytes_written", len(data))
+
+
+def _save_timed(img: Image.Image, file: Path, fmt: str, options: Dict[str, Any]) -> None:
+    """Save an *img*, and record encoding and writing times apart."""
+    from .metrics import METRICS, TimedWriter
+
+    start = time.perf_counter()
+    fh = file.open("wb")
+    writer = TimedWriter(fh)
+    try:
+        img.save(writer, fmt, **options)
+    finally:
+        encoded = time.perf_counter()
+        fh.close()
+    end = time.perf_counter()
+
+    METRICS.observe("encode", encoded - start - writer.elapsed)
+    METRICS.observe("write", writer.elapsed + end - encoded)
+    METRICS.inc("bytes_written", file.stat().st_size)
+
+
+def is_supported(output_format: str) -> bool:
+    """Check if Pillow can encode the given *output_format*."""
+    Image.init()
+    return output_format in OUTPUT_FORMATS and output_format.upper() in Image.SAVE
+
+
+def encoder_options(
+    img: Image.Image, output_format: str, settings: Dict[str, Any]
+) -> Tuple[str, Dict[str, Any]]:
+    """Get the Pillow format name and encoder options to save a given *img* as *output_format*.
+    The "keep" quality reuses the source quantization tables and subsampling, it is only
+    available for JPEG files saved as JPEG.
+    """
+    quality = settings["quality"]
+    if quality == "keep" and not (output_format == "jpeg" and img.format == "JPEG"):
+        quality = DEFAULT_QUALITY
+
+    options: Dict[str, Any]
+    if output_format == "jpeg":
+        options = {
+            "quality": quality,
+            "progressive": settings["progressive"],
+            "optimize": settings["optimize"],
+        }
+        if quality != "keep":
+            options["subsampling"] = settings["subsampling"]
+    elif output_format == "png":
+        options = {
+            "compress_level": settings["compress_level"],
+            "optimize": settings["optimize"],
+        }
+    else:
+        options = {"quality": quality}
+
+    return output_format.upper(), options
+
+
+def open_image(image: Union[Path, IO[bytes]], max_size: int = 0, threads: int = 1) -> Image.Image:
+    """Decode a given *image*, a file or a file object, as RGB.
+    If *max_size* is set, the image is downscaled to fit in a square of that size:
+    JPEG files are decoded at the smallest DCT scale keeping at least that size, and the image
+    is then reduced and resampled to the final size, using *threads* threads.
+    """
+    from .metrics import METRICS
+
+    with METRICS.timer("decode"):
+        return _open_image(image, max_size, threads)
+
 
-    final = Image.new("RGBA", img.size, (0, 0, 0, 0))
-    final.paste(img, (0, 0))
-    final.paste(watermark_img, position, mask=watermark_img)
+def _open_image(image: Union[Path, IO[bytes]], max_size: int, threads: int) -> Image.Image:
+    """See `open_image()`."""
+    from .tiles import REDUCING_GAP, resize
 
-    return Image.composite(final, img, final)
+    with (image.open("rb") if isinstance(image, Path) else image) as finput:
+        img = Image.open(finput)
+
+        if max_size and max(img.size) > max_size:
+            ratio = max_size / max(img.size)
+            img.draft("RGB", (int(img.size[0] * ratio), int(img.size[1] * ratio)))
+
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        else:
+            img.load()
+
+    if max_size and max(img.size) > max_size:
+        if threads > 1:
+            ratio = max_size / max(img.size)
+            size = (max(1, round(img.size[0] * ratio)), max(1, round(img.size[1] * ratio)))
+            img = resize(img, size, threads=threads)
+        else:
+            img.thumbnail((max_size, max_size), reducing_gap=REDUCING_GAP)
+
+    return img
+
+
+def add_picture_watermark(img: Image, watermark: str) -> Image:
+    """Add a given picture *watermark* to a given *img* using the specified *opacity*.
+    The *img* is modified in place.
+    Source: https://gist.github.com/makmac213/a4ab09f5a042c5477037
+    """
+    return WatermarkTemplate(picture=watermark).apply(img)
 
 
 def add_text_watermark(img: Image, watermark: str) -> Image:
     """Add a given text *watermark* to a given *img* using the specified *opacity* and *font*.
     *font* is the full path to the TrueType file.
+    The *img* is modified in place.
     Source: http://www.pythoncentral.io/watermark-images-python-2x/
     """
-    watermark_img = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    return WatermarkTemplate(text=watermark).apply(img)
 
-    size = 2
-    n_font = ImageFont.truetype(CONF.font, size)
-    n_width, n_height = n_font.getsize(watermark)
 
-    while n_width + n_height < watermark_img.size[0]:
-        size += 2
-        n_font = ImageFont.truetype(CONF.font, size)
-        n_width, n_height = n_font.getsize(watermark)
+@lru_cache(maxsize=64)
+def load_font(
+    font: str, size: int, layout_engine: Optional[int] = None
+) -> ImageFont.FreeTypeFont:
+    """Load the TrueType *font* file at the given *size*.
+    Loaded fonts are kept in a LRU cache, use `load_font.cache_info()` to get hits and misses.
+    """
+    return ImageFont.truetype(font, size, layout_engine=layout_engine)
 
-    draw = ImageDraw.Draw(watermark_img, "RGBA")
-    draw.text(
-        ((watermark_img.size[0] - n_width) / 2, (watermark_img.size[1] - n_height) / 2),
-        # ((watermark_img.size[0] - n_width) / 2, 10),
-        watermark,
-        font=n_font,
-        fill=CONF.text_color,
-    )
 
-    alpha = watermark_img.split()[3]
-    alpha = ImageEnhance.Brightness(alpha).enhance(CONF.opacity)
-    watermark_img.putalpha(alpha)
+def fit_font_size(
+    text: str, width: int, font: str, layout_engine: Optional[int] = None
+) -> int:
+    """Find the smallest *font* size for a given *text* to fill the given *width*.
 
-    return Image.composite(watermark_img, img, watermark_img)
+    Glyphs scale linearly, so the size is first estimated from the text metrics at
+    a reference size. Hinting makes that estimation slightly off, it is then refined
+    using a bisection bounded around the estimation.
+    """
+    from .metrics import METRICS
 
+    with METRICS.timer("fit_font"):
+        return _fit_font_size(text, width, font, layout_engine)
 
-def apply_watermarks(
-    paths: List[Path], text: str, picture: str, **kwargs: Any
-) -> Generator[Tuple[Path, Optional[Path]], None, None]:
-    """Apply watermark(s) on given files."""
+
+def _fit_font_size(text: str, width: int, font: str, layout_engine: Optional[int]) -> int:
+    """See `fit_font_size()`."""
+
+    def span(size: int) -> int:
+        n_width, n_height = load_font(font, size, layout_engine).getsize(text)
+        return n_width + n_height
+
+    reference = span(FONT_REFERENCE_SIZE)
+    if not reference:
+        return 1
+
+    estimation = FONT_REFERENCE_SIZE * width / reference
+    low = max(1, int(estimation * 0.9))
+    high = max(2, int(estimation * 1.1) + 1)
+
+    # Widen bounds in the unlikely case the estimation was too far
+    while low > 1 and span(low) >= width:
+        low //= 2
+    if span(low) >= width:
+        return low
+    while span(high) < width:
+        high *= 2
+
+    # Here, span(low) < width <= span(high)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if span(middle) < width:
+            low = middle
+        else:
+            high = middle
+
+    return high
+
+
+def init_worker(options: Dict[str, Any], optimizer: Optional["Optimizer"] = None) -> None:
+    """Prepare a worker process: watermark layers and the font are loaded only once per worker,
+    and the *optimizer* is reused for all files.
+    """
+    global _WORKER_TEMPLATE, _WORKER_OPTIMIZER
+    _WORKER_TEMPLATE = WatermarkTemplate(**options)
+    _WORKER_OPTIMIZER = optimizer
+    if options.get("text"):
+        load_font(options["font"], FONT_REFERENCE_SIZE)
+
+
+def process_file(
+    file: Path,
+    template: Optional[WatermarkTemplate] = None,
+    optimizer: Optional["Optimizer"] = None,
+    **kwargs: Any,
+) -> Optional[Path]:
+    """Watermark one *file* from a worker. Any error is logged, it must not break the pool."""
+    from .metrics import METRICS
+    from .profiling import track
+
+    try:
+        with METRICS.timer("file"), track(file):
+            return add_watermark(
+                file,
+                template=template or _WORKER_TEMPLATE,
+                optimizer=optimizer or _WORKER_OPTIMIZER,
+                **kwargs,
+            )
+    except Exception:
+        logging.exception(f"Error while processing {file}")
+        return None
+
+
+def process_worker_file(file: Path, **kwargs: Any) -> Tuple[Optional[Path], Dict[str, Any]]:
+    """Watermark one *file* from a worker process, see `process_file()`.
+    Side effects of the worker optimizer are sent back too, the parent one merges them (see `Optimizer.changes()`).
+    """
+    output = process_file(file, **kwargs)
+    return output, _WORKER_OPTIMIZER.changes() if _WORKER_OPTIMIZER is not None else {}
+
+
+def iter_files(
+    paths: List[Path], scan_threads: int = 1, skip_outputs: bool = False
+) -> Generator[Path, None, None]:
+    """Yield files to process from given *paths*, folders are browsed recursively
+    using *scan_threads* threads.
+    Outputs of previous runs, "-w" and "-wo" files, are not yielded when *skip_outputs* is True.
+    """
     for path in paths:
+        files: Iterable[Path]
         if path.is_file():
-            yield path, add_watermark(path, text=text, picture=picture)
+            files = (path,)
         elif path.is_dir():
-            for ext in CONF.extensions:
-                for file in path.glob(f"**/*.{ext}"):
-                    yield file, add_watermark(file, text=text, picture=picture)
+            files = scan_dir(path, CONF.extensions, threads=scan_threads)
+        else:
+            continue
+        for file in files:
+            if not (skip_outputs and file.stem.endswith(("-w", "-wo"))):
+                yield file
+
+
+def apply_watermarks(
+    paths: List[Path],
+    text: str,
+    picture: str,
+    workers: int = 1,
+    backend: str = "thread",
+    ordered: bool = True,
+    scan_threads: int = 1,
+    max_size: int = 0,
+    output_format: str = "",
+    encoder: Optional[Dict[str, Any]] = None,
+    manifest: Optional["Manifest"] = None,
+    tile_threads: int = 1,
+    optimizer: Optional["Optimizer"] = None,
+    stages: Optional[Dict[str, int]] = None,
+    skip_outputs: bool = False,
+    **kwargs: Any,
+) -> Results:
+    """Apply watermark(s) on given files.
+    Watermark layers are prepared once and reused for all files.
+
+    Files are processed in parallel when there are several *workers*:
+        - the "thread" *backend* relies on Pillow releasing the GIL while decoding and encoding;
+        - the "process" *backend* uses a pool where each worker prepares watermark layers once;
+        - the "pipeline" *backend* overlaps reading, watermarking, encoding, optimizing and writing
+          files in concurrent stages, *stages* sets the number of threads per stage (see `pipeline.Pipeline`).
+          Watermarking and encoding stages use *workers* threads by default.
+    Results are yielded in the files order when *ordered* is True, else as soon as they are completed.
+    Folders are scanned using *scan_threads* threads, outputs of previous runs are skipped when *skip_outputs* is True.
+    Images are downscaled to fit in a square of *max_size*, if set.
+    Images are saved using the *output_format*, and *encoder* settings overriding the configuration ones.
+
+    Each image can also be split into tiles processed by *tile_threads* threads, useful for huge images.
+
+    When an *optimizer* is given, watermarked images are optimized in memory, and only optimized
+    files are written (see `add_watermark()`). The "process" *backend* uses a copy of it in each worker,
+    side effects of copies, like skipped files, are merged into it (see `Optimizer.merge()`).
+    The optimizer may plan the batch first, e.g. to spend a limited quota (see `Optimizer.plan()`).
+
+    When a *manifest* is given, only files whose source or watermark parameters changed since
+    the last run are processed, others are skipped without being opened. Files left unoptimized
+    are not recorded, they are processed again at next run (see `is_final()`).
+
+    When metrics are enabled, files are counted and stages are timed into `metrics.METRICS`.
+    Stages of files processed by the "process" *backend* are not, only the parent process is measured.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}")
+
+    from .metrics import METRICS
+
+    options = {
+        "text": text,
+        "picture": picture,
+        "font": CONF.font,
+        "text_color": CONF.text_color,
+        "opacity": CONF.opacity,
+        "pattern": CONF.pattern,
+        "memory_budget": CONF.memory_budget * 1024 * 1024,
+        "threads": tile_threads,
+    }
+    settings: Dict[str, Any] = {
+        "max_size": max_size,
+        "output_format": output_format or CONF.output_format,
+        "encoder": encoder_settings(**(encoder or {})),
+    }
+    files: Iterable[Any] = iter_files(paths, scan_threads=scan_threads, skip_outputs=skip_outputs)
+
+    if manifest is not None:
+        settings["overwrite"] = True
+        values = {
+            key: value
+            for key, value in {**options, **settings}.items()
+            if key not in RUNTIME_OPTIONS
+        }
+        if optimizer is not None:
+            values["optimizer"] = optimizer.settings()
+
+        from .manifest import params_hash
+
+        params = params_hash(values)
+        files = _skip_up_to_date(files, manifest, params)
+
+    if optimizer is not None:
+        files = optimizer.plan(files, output_format=settings["output_format"], encoder=settings["encoder"])
+
+    if backend == "pipeline":
+        from .pipeline import Pipeline
+
+        template = WatermarkTemplate(**options)
+        threads = {"watermark": max(workers, 1), "encode": max(workers, 1), **(stages or {})}
+        results = Pipeline(template, settings, optimizer=optimizer, workers=threads).run(files, ordered)
+    elif workers <= 1:
+        template = WatermarkTemplate(**options)
+        results = _run_sequential(files, template, {**settings, "optimizer": optimizer})
+    else:
+        new_executor: Callable[[], "Executor"]
+        task: Callable[..., Any] = process_file
+        if backend == "thread":
+            from concurrent.futures import ThreadPoolExecutor
+
+            new_executor = partial(ThreadPoolExecutor, max_workers=workers)
+            template = WatermarkTemplate(**options)
+            settings.update(template=template, optimizer=optimizer)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            new_executor = partial(
+                ProcessPoolExecutor, max_workers=workers, initializer=init_worker, initargs=(options, optimizer)
+            )
+            task = process_worker_file
+        results = _run_parallel(new_executor, task, files, settings, workers * 2, ordered)
+        if backend == "process":
+            results = _merge_changes(results, optimizer)
+
+    for file, output in results:
+        if isinstance(file, UpToDate):
+            METRICS.inc("files_skipped")
+            yield file.source, file.output
+            continue
+        METRICS.inc("files_processed" if output else "files_failed")
+        if manifest is not None and output and output != file and is_final(output, optimizer):
+            manifest.record(file, params, output)
+        yield file, output
+
+
+def is_final(output: Path, optimizer: Optional["Optimizer"] = None) -> bool:
+    """Check that nothing is left to do on a given *output*: it was optimized, or there is nothing to optimize.
+    A watermarked output left when the optimization failed, or was skipped, is optimized at next run.
+    """
+    if optimizer is None or output.suffix[1:] not in optimizer.extensions:
+        return True
+    return not output.stem.endswith("-w")
+
+
+class UpToDate:
+    """A *source* file skipped because its *output* is up-to-date."""
+
+    def __init__(self, source: Path, output: Path) -> None:
+        self.source = source
+        self.output = output
+
+
+def _skip_up_to_date(
+    files: Iterable[Path], manifest: "Manifest", params: str
+) -> Generator[Any, None, None]:
+    """Wrap files whose output is up-to-date, according to the *manifest*.
+    Outputs of previous runs are wrapped too, there is nothing to do with them.
+    """
+    for file in files:
+        if file.stem.endswith(("-w", "-wo")):
+            yield UpToDate(file, file)
+            continue
+        output = manifest.lookup(file, params)
+        yield UpToDate(file, output) if output else file
+
+
+def _run_sequential(
+    files: Iterable[Any], template: WatermarkTemplate, settings: Dict[str, Any]
+) -> Generator[Tuple[Any, Optional[Path]], None, None]:
+    """Process *files* one after the other."""
+    for file in files:
+        if isinstance(file, UpToDate):
+            yield file, file.output
+        else:
+            yield file, process_file(file, template=template, **settings)
+
+
+def _merge_changes(
+    results: Iterable[Tuple[Any, Any]], optimizer: Optional["Optimizer"]
+) -> Generator[Tuple[Any, Optional[Path]], None, None]:
+    """Merge side effects of worker optimizers, sent with *results* of `process_worker_file()`, into the *optimizer*."""
+    for file, result in results:
+        if isinstance(result, tuple):
+            result, changes = result
+            if optimizer is not None:
+                optimizer.merge(changes)
+        yield file, result
+
+
+def _run_parallel(
+    new_executor: Callable[[], "Executor"],
+    task: Callable[..., Any],
+    files: Iterable[Any],
+    settings: Dict[str, Any],
+    window: int,
+    ordered: bool,
+) -> Generator[Tuple[Any, Optional[Path]], None, None]:
+    """Submit *files* to a pool created by *new_executor*, keeping at most *window* files in flight.
+    Files are processed by *task*, called with given *settings*.
+
+    When a worker process dies, the pool is broken and results of all files in flight are lost:
+    the pool is then recreated, and these files are processed again one by one, so that only
+    the file making the worker die fails.
+    """
+    from concurrent.futures import FIRST_COMPLETED, Future, wait
+    from concurrent.futures.process import BrokenProcessPool
+
+    pending: Dict[Future, Any] = {}
+    executor = new_executor()
+
+    def recover() -> None:
+        """Recreate the broken pool, and process files whose result was lost again."""
+        nonlocal executor, pending
+        executor.shutdown(wait=True)
+        executor = new_executor()
+
+        recovered: Dict[Future, Any] = {}
+        for future, file in pending.items():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                recovered[future] = file
+                continue
+            retried: Future = Future()
+            try:
+                retried.set_result(executor.submit(task, file, **settings).result())
+            except BrokenProcessPool:
+                logging.error(f"Error while processing {file}: the worker process died")
+                retried.set_result(None)
+                executor.shutdown(wait=True)
+                executor = new_executor()
+            recovered[retried] = file
+        pending = recovered
+
+    def completed() -> Generator[Tuple[Any, Optional[Path]], None, None]:
+        if ordered:
+            done = [next(iter(pending))]
+        else:
+            done = list(wait(pending, return_when=FIRST_COMPLETED).done)
+        for future in done:
+            try:
+                output = future.result()
+            except BrokenProcessPool:
+                recover()
+                return
+            except Exception:
+                logging.exception(f"Error while processing {pending[future]}")
+                output = None
+            yield pending.pop(future), output
+
+    try:
+        for file in files:
+            if isinstance(file, UpToDate):
+                # Nothing to do, but keep the order
+                future: Future = Future()
+                future.set_result(file.output)
+            else:
+                try:
+                    future = executor.submit(task, file, **settings)
+                except BrokenProcessPool:
+                    recover()
+                    future = executor.submit(task, file, **settings)
+            pending[future] = file
+            while len(pending) >= window:
+                yield from completed()
+        while pending:
+            yield from completed()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)